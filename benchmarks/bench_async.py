@@ -0,0 +1,115 @@
+'''
+ Benchmark of the synchronous (spotipy + threads) and asyncio (AsyncSpotify) crawls
+ against a local fake Spotify Web API server.
+
+Both crawls request the playlists of all users, the tracks of all playlists, then the audio
+analysis and audio features of all unique tracks. The server delays every response by --latency
+seconds to stand in for the round trip to the real API. The asyncio crawl also checks that
+its results equal the synchronous ones.
+
+Usage, from the repository root:
+
+    python -m benchmarks.bench_async
+    python -m benchmarks.bench_async --users 20 --latency 0.1 --concurrency 256 --throttle-every 500
+'''
+import argparse
+import asyncio
+import sys
+import time
+
+import spotipy
+
+from benchmarks.fake_server import FakeSpotifyServer
+from cap_package import AsyncSpotify as asp
+from cap_package import RequestScheduler as rs
+from cap_package import SpotipyCollect as sc
+from cap_package import SpotipyCollectPub as scp
+
+
+def sync_crawl(sp, users, workers):
+
+    playlists = scp.get_public_playlists(sp, users)
+    tracks_df = scp.get_tracks_df(sp, scp.user_plid_pair(users, playlists), workers=workers)
+    ids = list(tracks_df['id'])
+    analysis = sc.get_tracks_analysis(sp, ids, workers=workers)
+    features = sc.get_tracks_features(sp, ids, workers=workers)
+
+    return playlists, tracks_df, analysis, features
+
+
+async def async_crawl(sp, users):
+
+    playlists = await asp.get_public_playlists(sp, users)
+    tracks_df = await asp.get_tracks_df(sp, scp.user_plid_pair(users, playlists))
+    ids = list(tracks_df['id'])
+    analysis, features = await asyncio.gather(asp.get_tracks_analysis(sp, ids), asp.get_tracks_features(sp, ids))
+
+    return playlists, tracks_df, analysis, features
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark synchronous and asyncio crawls on a fake server.')
+    parser.add_argument('--users', type=int, default=4, help='number of users (default 4)')
+    parser.add_argument('--playlists', type=int, default=3, help='playlists per user (default 3)')
+    parser.add_argument('--tracks', type=int, default=50, help='tracks per playlist (default 50)')
+    parser.add_argument('--segments', type=int, default=300, help='segments per track analysis (default 300)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per response (default 0.05)')
+    parser.add_argument('--workers', type=int, default=sc.HOST_CONCURRENCY,
+                        help='threads of the synchronous crawl (default {})'.format(sc.HOST_CONCURRENCY))
+    parser.add_argument('--concurrency', type=int, default=asp.CONCURRENCY,
+                        help='requests in flight of the asyncio crawl (default {})'.format(asp.CONCURRENCY))
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every n-th request with 429')
+    parser.add_argument('--skip-sync', action='store_true', help='only run the asyncio crawl')
+    args = parser.parse_args(argv)
+
+    users = ['user{}'.format(u) for u in range(args.users)]
+    server = FakeSpotifyServer(n_users=args.users, n_playlists=args.playlists, n_tracks=args.tracks,
+                               n_segments=args.segments, overlap=args.tracks // 5, latency=args.latency,
+                               throttle_every=args.throttle_every)
+    base_url = server.start_thread()
+
+    try:
+        sync_result = None
+        if not args.skip_sync:
+            sp = spotipy.Spotify(auth='token')
+            sp.prefix = base_url
+            # throttled requests are retried by a scheduler (instead of spotipy), admitting requests
+            # as fast as they are made
+            sp = rs.ScheduledSpotify(sp, rs.RequestScheduler(rate=1e6, backoff=0.05))
+
+            start = time.perf_counter()
+            requests = server.requests
+            sync_result = sync_crawl(sp, users, args.workers)
+            secs = time.perf_counter() - start
+            print('sync   ({:>3} threads)    {:>8.2f} s {:>8} requests {:>10.1f} requests/s'.format(
+                args.workers, secs, server.requests - requests, (server.requests - requests) / secs))
+
+        async def run():
+            async with asp.AsyncSpotify('token', base_url=base_url, concurrency=args.concurrency,
+                                        backoff=0.05) as sp:
+                result = await async_crawl(sp, users)
+            return result, sp.stats()
+
+        start = time.perf_counter()
+        requests = server.requests
+        async_result, stats = asyncio.run(run())
+        secs = time.perf_counter() - start
+        print('asyncio ({:>4} in flight) {:>8.2f} s {:>8} requests {:>10.1f} requests/s'.format(
+            args.concurrency, secs, server.requests - requests, (server.requests - requests) / secs))
+        print('asyncio client counters:', stats)
+
+    finally:
+        server.stop_thread()
+
+    if sync_result is not None:
+        same = (sync_result[0] == async_result[0] and sync_result[1].equals(async_result[1])
+                and sync_result[2] == async_result[2] and sync_result[3] == async_result[3])
+        print('results equal:', same)
+        return 0 if same else 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+'''
+ Benchmarks of the collect -> store stage on StubSpotify (synthetic responses, no network).
+
+Benchmarks:
+    stream      peak traced memory of stream_dataset and of get_folder_analysis + create_dataset
+                for a growing number of playlists (20 tracks each)
+    dedup       API calls, files, size and time of get_folder_analysis + create_dataset (dedup off)
+                and build_track_index + get_index_analysis + create_index_dataset (dedup on),
+                for 3 fully overlapping playlists of 40 tracks
+    update      time of update_dataset (with its track metadata table) for a growing number of
+                playlists of 5 short tracks
+
+StubSpotify serves the same tracks for every playlist id, so playlists fully overlap.
+
+Usage, from the repository root:
+
+    python -m benchmarks.bench_collect
+    python -m benchmarks.bench_collect stream --playlists 4 8 40
+    python -m benchmarks.bench_collect update --playlists 100 500
+'''
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.synthetic import StubSpotify
+from cap_package import SpotipyCollect as sc
+
+BENCHMARKS = ('stream', 'dedup', 'update')
+
+
+def playlists(n):
+
+    return [('Playlist {}'.format(i), 'playlist{:0>14d}'.format(i)) for i in range(n)]
+
+
+def dir_files(path):
+    '''
+    returns : number and total size (bytes) of parquet files under path
+    '''
+    files = list(path.rglob('*.parquet'))
+
+    return len(files), sum(f.stat().st_size for f in files)
+
+
+def peak_memory(func):
+    '''
+    returns : peak traced memory (bytes) while running func
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_stream(n_playlists, workers=4):
+
+    print('{:>10} {:>24} {:>24}'.format('playlists', 'stream_dataset MB', 'in memory MB'))
+    df_names = sc.frame_names(segments=True, tempo=False, sections=True)
+
+    for n in n_playlists:
+
+        pls = playlists(n)
+
+        with tempfile.TemporaryDirectory() as d:
+            stream = peak_memory(lambda: sc.stream_dataset(StubSpotify(n_tracks=20, n_segments=300), Path(d),
+                                                           pl_name_id=pls, workers=workers))
+
+        def in_memory():
+            fa = sc.get_folder_analysis(StubSpotify(n_tracks=20, n_segments=300), pl_name_id=pls, workers=workers)
+            sc.create_dataset(fa, Path(d), df_names=df_names)
+
+        with tempfile.TemporaryDirectory() as d:
+            memory = peak_memory(in_memory)
+
+        print('{:>10} {:>24.1f} {:>24.1f}'.format(n, stream / 2**20, memory / 2**20))
+
+
+def bench_dedup(workers=4):
+
+    print('{:>6} {:>10} {:>8} {:>10} {:>10}'.format('dedup', 'API calls', 'files', 'MB', 'seconds'))
+    df_names = sc.frame_names(segments=True, tempo=False, sections=True)
+    pls = playlists(3)
+
+    for dedup in (False, True):
+
+        sp = StubSpotify(n_tracks=40, n_segments=300)
+
+        with tempfile.TemporaryDirectory() as d:
+            start = time.perf_counter()
+            if dedup:
+                index = sc.build_track_index(sp, pl_name_id=pls, workers=workers)
+                index_analysis = sc.get_index_analysis(sp, index, workers=workers)
+                sc.create_index_dataset(index_analysis, index, Path(d), df_names=df_names)
+            else:
+                folder_analysis = sc.get_folder_analysis(sp, pl_name_id=pls, workers=workers)
+                sc.create_dataset(folder_analysis, Path(d), df_names=df_names)
+            secs = time.perf_counter() - start
+            files, size = dir_files(Path(d))
+
+        print('{:>6} {:>10} {:>8} {:>10.1f} {:>10.2f}'.format(str(dedup), sp.calls, files, size / 2**20, secs))
+
+
+def bench_update(n_playlists, workers=4):
+
+    print('{:>10} {:>12}'.format('playlists', 'seconds'))
+
+    for n in n_playlists:
+
+        with tempfile.TemporaryDirectory() as d:
+            start = time.perf_counter()
+            sc.update_dataset(StubSpotify(n_tracks=5, n_segments=10), Path(d), pl_name_id=playlists(n),
+                              workers=workers)
+            secs = time.perf_counter() - start
+
+        print('{:>10} {:>12.2f}'.format(n, secs))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark collecting and storing on StubSpotify data.')
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+                        help='benchmarks to run: {} (default all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--playlists', type=int, nargs='+', default=None,
+                        help='numbers of playlists of stream and update (default 4 40, and 100 500)')
+    parser.add_argument('--workers', type=int, default=4, help='fetch threads (default 4)')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    if 'stream' in args.benchmarks:
+        bench_stream(args.playlists or [4, 40], workers=args.workers)
+
+    if 'dedup' in args.benchmarks:
+        bench_dedup(workers=args.workers)
+
+    if 'update' in args.benchmarks:
+        bench_update(args.playlists or [100, 500], workers=args.workers)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+'''
+ Benchmarks of the collect -> store -> transform pipeline.
+
+Stages (in pipeline order):
+    track_anlaysis_to_df, get_segments      conversion of audio analysis responses
+    create_dataset                          parquet files per track
+    read_dataset, read_dataset_threads      reading them back (serially, and with 4 threads)
+    split_columns, transform_dataset        model inputs
+    get_segsec_stats                        feature statistics
+
+Synthetic corpora are sized relative to the bundled Dataset1.2 (13 playlists, 372 tracks). They are
+processed playlist by playlist so that 100x fits in memory, and responses are cycled from a pool of
+generated tracks (generation is not timed). With --dataset the reading and transform stages also run
+on a real dataset tree.
+
+For every stage the report shows time per track, peak traced memory (measured on a separate run of
+the first playlist, tracemalloc slows everything down) and files per second for storage stages.
+
+Usage, from the repository root:
+
+    python -m benchmarks.bench_pipeline --scale 1 10
+    python -m benchmarks.bench_pipeline --scale 10 --dataset Dataset1.2 --save-baseline
+    python -m benchmarks.bench_pipeline --scale 10 --threshold 1.5
+
+Results are compared with benchmarks/baseline.json; the exit status is 1 if a stage is slower or uses
+more memory than its baseline times the threshold. Baselines are machine specific, save them on the
+machine the benchmarks are compared on.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.synthetic import synthetic_analysis, synthetic_corpus
+from cap_package import DatasetStore as ds
+from cap_package import ReadTransform as rt
+from cap_package import SpotipyCollect as sc
+
+BASELINE = Path(__file__).with_name('baseline.json')
+# Default ratio over the baseline reported as a regression
+THRESHOLD = 1.3
+# Number of distinct synthetic tracks responses are cycled from
+POOL_SIZE = 64
+
+PITCH_COLS = ['pitch_{:0>2d}'.format(i + 1) for i in range(12)]
+TIMBRE_COLS = ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+
+
+class Stages:
+    '''
+    Accumulates time, tracks, files and peak memory of stages over playlists.
+    '''
+
+    def __init__(self, memory=False):
+
+        self.memory = memory
+        self.results = {}
+
+    def run(self, name, func, tracks, files=0):
+
+        res = self.results.setdefault(name, {'seconds': 0.0, 'tracks': 0, 'files': 0, 'peak_bytes': 0})
+
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            out = func()
+            res['peak_bytes'] = max(res['peak_bytes'], tracemalloc.get_traced_memory()[1] - base)
+            return out
+
+        start = time.perf_counter()
+        out = func()
+        res['seconds'] += time.perf_counter() - start
+        res['tracks'] += tracks
+        res['files'] += files
+
+        return out
+
+
+def transform_stages(stages, dataset):
+    '''
+    Transform stages on the output of read_dataset (segments and sections).
+    '''
+    for pl in dataset:
+
+        segs = [df for _, df in pl[1]]
+        secs = [df[['start', 'duration', 'loudness', 'key']] for _, df in pl[2]]
+
+        split = stages.run('split_columns', lambda: [
+            rt.split_columns(df, PITCH_COLS, TIMBRE_COLS).assign(start=df['start']) for df in segs], len(segs))
+
+        timbre = [df[TIMBRE_COLS] for df in split]
+        mins = [min(t[c].min() for t in timbre) for c in TIMBRE_COLS]
+        maxs = [max(t[c].max() for t in timbre) for c in TIMBRE_COLS]
+
+        stages.run('transform_dataset', lambda: rt.transform_dataset(split, mins, maxs, seed=0), len(split))
+        stages.run('get_segsec_stats', lambda: rt.get_segsec_stats(split, secs), len(split))
+
+
+def synthetic_run(corpus, pool, work_dir, memory=False):
+    '''
+    Run all stages on a synthetic corpus.
+
+    corpus : Dict returned by synthetic_corpus
+    pool : list of synthetic analysis responses
+    work_dir : pathlib.Path - directory for the dataset files
+    memory : Default False. True - measure peak memory of the first playlist instead of time
+    returns : Dict of stage results
+    '''
+    stages = Stages(memory)
+    df_names = sc.frame_names(segments=True, tempo=True, sections=True)
+
+    for n, (pl, seeds) in enumerate(corpus.items()):
+
+        if memory and n > 0:
+            break
+
+        analyses = [pool[s % len(pool)] for s in seeds]
+        names = ['track_{:0>6d}'.format(s) for s in seeds]
+
+        stages.run('track_anlaysis_to_df', lambda: [sc.track_anlaysis_to_df(track_analysis=a) for a in analyses],
+                   len(analyses))
+        tracks = stages.run('get_segments', lambda: {
+            name: sc.get_segments(a, tempo=True, sections=True) for name, a in zip(names, analyses)}, len(analyses))
+
+        stages.run('create_dataset', lambda: sc.create_dataset({pl: tracks}, work_dir, df_names=df_names),
+                   len(tracks), files=len(tracks) * len(df_names))
+
+        stages.run('read_dataset', lambda: rt.read_dataset(work_dir, sections=True, playlists=[pl]),
+                   len(seeds), files=2 * len(seeds))
+        dataset = stages.run('read_dataset_threads', lambda: rt.read_dataset(work_dir, sections=True, playlists=[pl],
+                                                                             workers=4),
+                             len(seeds), files=2 * len(seeds))
+
+        transform_stages(stages, dataset)
+
+        if not memory:
+            shutil.rmtree(work_dir.joinpath(pl))
+
+    return stages.results
+
+
+def dataset_run(path_, memory=False):
+    '''
+    Run the reading and transform stages on a dataset tree (e.g. Dataset1.2).
+    '''
+    stages = Stages(memory)
+    pl_path = path_.joinpath('user_playlists')
+    playlists = sorted(p.name for p in ds.playlist_folders(pl_path))
+
+    for n, pl in enumerate(playlists):
+
+        if memory and n > 0:
+            break
+
+        count = len(list(pl_path.joinpath(pl).glob('*_segments.parquet')))
+        stages.run('read_dataset', lambda: rt.read_dataset(pl_path, sections=True, playlists=[pl]),
+                   count, files=2 * count)
+        dataset = stages.run('read_dataset_threads', lambda: rt.read_dataset(pl_path, sections=True, playlists=[pl],
+                                                                             workers=4),
+                             count, files=2 * count)
+
+        transform_stages(stages, dataset)
+
+    return stages.results
+
+
+def measure(run, *args):
+    '''
+    Time all stages, then measure their peak memory on a separate run.
+    returns : Dict - key : stage name : value - ms_per_track, peak_mb and files_per_sec (storage stages)
+    '''
+    timed = run(*args)
+
+    tracemalloc.start()
+    try:
+        traced = run(*args, memory=True)
+    finally:
+        tracemalloc.stop()
+
+    report = {}
+    for name, res in timed.items():
+
+        report[name] = {'ms_per_track': round(1000 * res['seconds'] / max(res['tracks'], 1), 4),
+                        'peak_mb': round(traced.get(name, {}).get('peak_bytes', 0) / 1024 ** 2, 3)}
+        if res['files']:
+            report[name]['files_per_sec'] = round(res['files'] / res['seconds'], 1)
+
+    return report
+
+
+def compare(results, baseline, threshold):
+    '''
+    Stages slower or using more memory than baseline * threshold.
+    returns : list of (corpus, stage, measure, baseline value, value) tuples
+    '''
+    regressions = []
+
+    for corpus, stages in results.items():
+        for stage, res in stages.items():
+
+            base = baseline.get(corpus, {}).get(stage)
+            if base is None:
+                continue
+
+            for key in ('ms_per_track', 'peak_mb'):
+                if base.get(key) and res[key] > base[key] * threshold:
+                    regressions.append((corpus, stage, key, base[key], res[key]))
+
+    return regressions
+
+
+def print_report(results):
+
+    for corpus, stages in results.items():
+
+        print('\n{}'.format(corpus))
+        print('  {:<24}{:>14}{:>12}{:>12}'.format('stage', 'ms/track', 'peak MB', 'files/s'))
+        for stage, res in stages.items():
+            print('  {:<24}{:>14.3f}{:>12.2f}{:>12}'.format(stage, res['ms_per_track'], res['peak_mb'],
+                                                           res.get('files_per_sec', '')))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the collect -> store -> transform pipeline.')
+    parser.add_argument('--scale', type=float, nargs='*', default=[1, 10],
+                        help='synthetic corpus sizes relative to Dataset1.2 (default 1 10)')
+    parser.add_argument('--dataset', type=Path, default=None,
+                        help='also benchmark reading/transform stages on this dataset tree, e.g. Dataset1.2')
+    parser.add_argument('--baseline', type=Path, default=BASELINE, help='baseline json file')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='ratio over the baseline reported as a regression (default {})'.format(THRESHOLD))
+    parser.add_argument('--output', type=Path, default=None, help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    pool = [synthetic_analysis(seed) for seed in range(POOL_SIZE)]
+    results = {}
+
+    for scale in args.scale:
+
+        work_dir = Path(tempfile.mkdtemp(prefix='cap_bench_'))
+        try:
+            results['synthetic_{:g}x'.format(scale)] = measure(synthetic_run, synthetic_corpus(scale), pool, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.dataset is not None:
+        results[args.dataset.name] = measure(dataset_run, args.dataset)
+
+    print_report(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.save_baseline:
+        baseline = {}
+        if args.baseline.exists():
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+
+        baseline.update(results)
+        baseline['machine'] = {'platform': platform.platform(), 'python': platform.python_version(),
+                               'cpus': os.cpu_count()}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print('\nBaseline saved to', args.baseline)
+        return 0
+
+    if not args.baseline.exists():
+        print('\nNo baseline at', args.baseline)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.threshold)
+    for corpus, stage, key, base, value in regressions:
+        print('REGRESSION {} {} {}: {} -> {} (x{:.2f})'.format(corpus, stage, key, base, value, value / base))
+
+    if not regressions:
+        print('\nNo regressions over baseline x{}'.format(args.threshold))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
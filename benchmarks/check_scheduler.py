@@ -0,0 +1,68 @@
+'''
+ Check of RequestScheduler with a real spotipy object against the local fake Spotify server.
+
+The server answers one request with 429 and 'Retry-After: 2', and a later one with 503. The scheduler must
+see both with their real status: the throttled request waits for Retry-After, the server error is
+retried with backoff and not counted as throttled, and spotipy itself retries nothing (the server
+gets exactly one extra request per error).
+
+Usage, from the repository root:
+
+    python -m benchmarks.check_scheduler
+'''
+import sys
+import time
+
+import spotipy
+
+from benchmarks.fake_server import FakeSpotifyServer, playlist_id, track_id
+from cap_package import RequestScheduler as rs
+
+# Retry-After (seconds) sent with the 429 response
+RETRY_AFTER = 2
+
+
+def check(name, ok):
+
+    print('{:<50} {}'.format(name, 'ok' if ok else 'FAILED'))
+    return ok
+
+
+def main():
+
+    # request 2 is throttled, its retry (request 3) succeeds
+    server = FakeSpotifyServer(n_users=1, n_playlists=1, n_tracks=10, n_segments=10,
+                               throttle_every=2, retry_after=RETRY_AFTER)
+    base_url = server.start_thread()
+
+    try:
+        sp = spotipy.Spotify(auth='token')
+        sp.prefix = base_url
+        sp = rs.ScheduledSpotify(sp, rs.RequestScheduler(rate=100, backoff=0.05))
+
+        sp.playlist_items(playlist_id(0))
+        start = time.perf_counter()
+        tracks = sp.playlist_items(playlist_id(0))
+        secs = time.perf_counter() - start
+        throttled = server.requests
+
+        # request 4 fails with 503, its retry (request 5) succeeds
+        server.throttle_every = 0
+        server.error_every = 4
+        analysis = sp.audio_analysis(track_id(0))
+        stats = sp.scheduler.stats()
+
+    finally:
+        server.stop_thread()
+
+    ok = [check('responses returned', 'items' in tracks and 'segments' in analysis),
+          check('waited for Retry-After ({:.2f} s)'.format(secs), secs >= RETRY_AFTER),
+          check('one request per attempt ({} requests)'.format(server.requests),
+                throttled == 3 and server.requests == 5),
+          check('counters {}'.format(stats), stats == {'requests': 5, 'throttled': 1, 'retried': 2, 'failed': 0})]
+
+    return 0 if all(ok) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+'''
+ Local fake Spotify Web API server serving synthetic data.
+
+ Function/Class definitions : FakeSpotifyServer, playlist_id, track_id
+
+Serves the endpoints used by cap_package (user playlists, playlist tracks, audio analysis,
+audio features, albums) under http://127.0.0.1:<port>/v1/, for exercising AsyncSpotify and
+spotipy without network access:
+
+    async with FakeSpotifyServer(n_users=10, latency=0.05) as server:
+        async with AsyncSpotify('token', base_url=server.base_url) as sp:
+            ...
+
+For spotipy, create it with auth='token' and set its prefix to server.base_url. Every user has
+n_playlists playlists of n_tracks tracks. Tracks of consecutive playlists overlap by 'overlap'
+tracks, so crawls see shared tracks like on real data.
+'''
+import asyncio
+import json
+import threading
+
+from aiohttp import web
+
+from benchmarks.synthetic import synthetic_analysis
+
+# Number of distinct synthetic analysis responses served, cycled by track number
+POOL_SIZE = 64
+
+
+def playlist_id(n):
+
+    return 'playlist{:0>14d}'.format(n)
+
+
+def track_id(n):
+
+    return 'track{:0>17d}'.format(n)
+
+
+class FakeSpotifyServer:
+    '''
+    aiohttp server of synthetic Spotify Web API responses.
+
+    n_users : Default 10. Number of users ('user0', 'user1', ...)
+    n_playlists : Default 5. Number of playlists of every user
+    n_tracks : Default 100. Number of tracks of every playlist
+    n_segments : Default 900. Number of segments of every track analysis
+    overlap : Default 0. Number of tracks shared by consecutive playlists
+    latency : Default 0. Seconds every response is delayed by (the server handles requests concurrently)
+    throttle_every : Default 0 - never. Every throttle_every-th request gets a 429 response
+    retry_after : Default 0. Retry-After header (seconds) of throttled responses
+    error_every : Default 0 - never. Every error_every-th request gets a 503 response
+    port : Default 0 - any free port
+    '''
+
+    def __init__(self, n_users=10, n_playlists=5, n_tracks=100, n_segments=900, overlap=0, latency=0.0,
+                 throttle_every=0, retry_after=0, error_every=0, port=0):
+
+        self.n_users = n_users
+        self.n_playlists = n_playlists
+        self.n_tracks = n_tracks
+        self.n_segments = n_segments
+        self.overlap = overlap
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.error_every = error_every
+        self.port = port
+
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._analysis = {}
+        self._runner = None
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.add_routes([web.get('/v1/users/{user}/playlists', self.user_playlists),
+                             web.get('/v1/playlists/{playlist_id}/tracks', self.playlist_tracks),
+                             web.get('/v1/playlists/{playlist_id}/items', self.playlist_tracks),
+                             web.get('/v1/audio-analysis/{track_id}', self.audio_analysis),
+                             web.get('/v1/audio-features', self.audio_features),
+                             web.get('/v1/audio-features/', self.audio_features),
+                             web.get('/v1/albums', self.albums),
+                             web.get('/v1/albums/', self.albums)])
+
+    @property
+    def base_url(self):
+
+        return 'http://127.0.0.1:{}/v1/'.format(self.port)
+
+    async def start(self):
+
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+        return self.base_url
+
+    async def close(self):
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        await self.close()
+        return False
+
+    def start_thread(self):
+        '''
+        Run the server on an event loop in a background thread, for synchronous clients (spotipy).
+        returns : base url
+        '''
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+        return self.base_url
+
+    def stop_thread(self):
+
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+
+        self.requests += 1
+        n = self.requests
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.throttle_every and n % self.throttle_every == 0:
+            self.throttled += 1
+            return web.json_response({'error': {'status': 429, 'message': 'API rate limit exceeded'}}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+
+        if self.error_every and n % self.error_every == 0:
+            self.errors += 1
+            return web.json_response({'error': {'status': 503, 'message': 'Service unavailable'}}, status=503)
+
+        return await handler(request)
+
+    def _page(self, request, total, item, url):
+
+        limit = int(request.query.get('limit', 20))
+        offset = int(request.query.get('offset', 0))
+        end = min(offset + limit, total)
+
+        return {'href': url.format(offset, limit), 'items': [item(i) for i in range(offset, end)],
+                'limit': limit, 'offset': offset, 'total': total,
+                'next': url.format(end, limit) if end < total else None,
+                'previous': url.format(max(offset - limit, 0), limit) if offset else None}
+
+    async def user_playlists(self, request):
+
+        user = request.match_info['user']
+        if not user.startswith('user') or int(user[4:]) >= self.n_users:
+            raise web.HTTPNotFound()
+
+        first = int(user[4:]) * self.n_playlists
+
+        def item(i):
+            return {'id': playlist_id(first + i), 'name': 'Playlist {} of {}'.format(i, user),
+                    'description': 'Synthetic playlist {}'.format(first + i),
+                    'tracks': {'total': self.n_tracks}, 'owner': {'id': user}}
+
+        url = self.base_url + 'users/' + user + '/playlists?offset={}&limit={}'
+
+        return web.json_response(self._page(request, self.n_playlists, item, url))
+
+    async def playlist_tracks(self, request):
+
+        pl = request.match_info['playlist_id']
+        first = int(pl[-8:]) * (self.n_tracks - self.overlap)
+
+        def item(i):
+            n = first + i
+            return {'track': {'name': 'Track {}'.format(n), 'id': track_id(n),
+                              'artists': [{'name': 'Artist {}'.format(n % 17)}],
+                              'album': {'id': 'album{:0>17d}'.format(n // 10), 'name': 'Album {}'.format(n // 10)},
+                              'duration_ms': 240000, 'popularity': n % 100}}
+
+        url = self.base_url + 'playlists/' + pl + '/tracks?offset={}&limit={}'
+
+        return web.json_response(self._page(request, self.n_tracks, item, url))
+
+    async def audio_analysis(self, request):
+
+        seed = int(request.match_info['track_id'][-8:]) % POOL_SIZE
+
+        if seed not in self._analysis:
+            self._analysis[seed] = json.dumps(synthetic_analysis(seed, n_segments=self.n_segments),
+                                              separators=(',', ':'))
+
+        return web.Response(text=self._analysis[seed], content_type='application/json')
+
+    async def audio_features(self, request):
+
+        ids = request.query.get('ids', '').split(',')
+
+        return web.json_response({'audio_features': [
+            {'id': t, 'danceability': 0.6, 'energy': 0.8, 'key': 5, 'loudness': -7.0, 'mode': 1,
+             'speechiness': 0.05, 'acousticness': 0.01, 'instrumentalness': 0.9, 'liveness': 0.1,
+             'valence': 0.3, 'tempo': 126.0, 'duration_ms': 240000, 'time_signature': 4}
+            for t in ids]})
+
+    async def albums(self, request):
+
+        ids = request.query.get('ids', '').split(',')
+
+        return web.json_response({'albums': [{'id': a, 'name': 'Album {}'.format(int(a[-8:])), 'genres': []}
+                                              for a in ids]})
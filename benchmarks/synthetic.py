@@ -0,0 +1,111 @@
+'''
+ Synthetic Spotify Web API data for benchmarks.
+
+ Function/Class definitions : synthetic_analysis, synthetic_corpus, StubSpotify
+
+Audio analysis responses follow the layout of the audio-analysis endpoint
+(https://developer.spotify.com/documentation/web-api/reference/tracks/get-audio-analysis/)
+with sizes close to a 4-5 minute track. They are seeded, so every run sees the same data.
+'''
+import numpy as np
+
+
+def synthetic_analysis(seed, n_segments=900, n_sections=12):
+    '''
+    Audio analysis response of a synthetic track.
+
+    seed : seed of the track (e.g. its position in the corpus)
+    n_segments : Default 900. Number of segments
+    n_sections : Default 12. Number of sections
+    returns : Dict - same keys and nesting as the audio-analysis endpoint response
+    '''
+    rng = np.random.default_rng(seed)
+
+    durations = rng.uniform(0.05, 0.6, n_segments).round(5)
+    starts = np.concatenate([[0], np.cumsum(durations)[:-1]]).round(5)
+    length = float(starts[-1] + durations[-1])
+
+    confidence = rng.random(n_segments).round(3)
+    pitches = rng.random((n_segments, 12)).round(3)
+    timbre = np.column_stack([rng.normal(45, 6, n_segments), rng.normal(0, 60, (n_segments, 11))]).round(3)
+    loudness = rng.uniform(-30, -3, (n_segments, 3)).round(3)
+
+    segments = [{'start': float(starts[i]), 'duration': float(durations[i]), 'confidence': float(confidence[i]),
+                 'loudness_start': float(loudness[i, 0]), 'loudness_max_time': 0.02,
+                 'loudness_max': float(loudness[i, 1]), 'loudness_end': float(loudness[i, 2]),
+                 'pitches': pitches[i].tolist(), 'timbre': timbre[i].tolist()}
+                for i in range(n_segments)]
+
+    # sections of random lengths covering the track
+    bounds = np.sort(rng.uniform(0, length, n_sections - 1)).round(5)
+    sec_starts = np.concatenate([[0], bounds])
+    sec_durations = np.diff(np.concatenate([sec_starts, [length]]))
+    keys = rng.integers(0, 12, n_sections)
+
+    sections = [{'start': float(sec_starts[i]), 'duration': float(sec_durations[i]), 'confidence': 0.6,
+                 'loudness': float(rng.uniform(-20, -5)), 'tempo': 126.0, 'tempo_confidence': 0.5,
+                 'key': int(keys[i]), 'key_confidence': 0.5, 'mode': int(rng.integers(0, 2)), 'mode_confidence': 0.5,
+                 'time_signature': 4, 'time_signature_confidence': 1.0}
+                for i in range(n_sections)]
+
+    beats = [{'start': round(i * 0.476, 5), 'duration': 0.476, 'confidence': 0.5} for i in range(int(length / 0.476))]
+
+    return {'meta': {'analyzer_version': '4.0.0', 'status_code': 0},
+            'track': {'duration': length, 'tempo': 126.0, 'tempo_confidence': 0.7, 'key': int(keys[0]),
+                      'mode': 1, 'time_signature': 4, 'loudness': -8.0, 'num_samples': int(length * 22050)},
+            'bars': beats[::4], 'beats': beats, 'sections': sections, 'segments': segments,
+            'tatums': beats}
+
+
+def synthetic_corpus(scale=1.0, playlists=13, tracks=372):
+    '''
+    Layout of a synthetic corpus - the bundled Dataset1.2 has 13 playlists of 372 tracks in total.
+
+    scale : Default 1. Corpus size relative to Dataset1.2
+    returns : Dict - key : playlist name : value - list of track seeds
+    '''
+    per_playlist = max(1, int(round(tracks * scale / playlists)))
+
+    return {'Playlist {:0>2d}'.format(p): list(range(p * per_playlist, (p + 1) * per_playlist))
+            for p in range(playlists)}
+
+
+class StubSpotify:
+    '''
+    In-memory stand-in for a spotipy object serving synthetic responses, for benchmarks without network.
+
+    n_tracks : Default 250. Number of tracks of every playlist
+    n_segments : Default 900. Number of segments of every track analysis
+    '''
+    prefix = 'https://api.spotify.com/v1/'
+
+    def __init__(self, n_tracks=250, n_segments=900):
+
+        self.n_tracks = n_tracks
+        self.n_segments = n_segments
+        self.calls = 0
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None,
+                        additional_types=('track',)):
+
+        self.calls += 1
+        items = [{'track': {'name': 'Track {}'.format(i), 'id': 'track{:0>18d}'.format(i),
+                            'artists': [{'name': 'Artist {}'.format(i % 17)}]}}
+                 for i in range(offset, min(offset + limit, self.n_tracks))]
+
+        return {'items': items, 'total': self.n_tracks, 'offset': offset, 'limit': limit}
+
+    def audio_analysis(self, track_id):
+
+        self.calls += 1
+
+        return synthetic_analysis(int(track_id[-8:]), n_segments=self.n_segments)
+
+    def audio_features(self, tracks):
+
+        self.calls += 1
+
+        return [{'id': t, 'danceability': 0.6, 'energy': 0.8, 'key': 5, 'loudness': -7.0, 'mode': 1,
+                 'speechiness': 0.05, 'acousticness': 0.01, 'instrumentalness': 0.9, 'liveness': 0.1,
+                 'valence': 0.3, 'tempo': 126.0, 'duration_ms': 300000, 'time_signature': 4}
+                for t in tracks]
@@ -0,0 +1,605 @@
+'''
+ Asyncio client of the Spotify Web API and async variants of the crawl functions.
+
+ Function/Class definitions : AsyncSpotify, get_public_playlists, get_playlist_items, get_tracks,
+                              get_tracks_df, get_tracks_analysis, get_tracks_features, get_albums,
+                              get_playlist_analysis, get_folder_analysis, get_folder_features
+
+Hierachy:
+- AsyncSpotify > arg(token or spotipy auth manager) or AsyncSpotify.from_spotipy(spotipy object)
+  - endpoints : user_playlists, next, playlist_tracks, audio_analysis, audio_features, albums
+- get_folder_analysis > get_playlist_analysis > get_tracks > get_playlist_items
+                                              > get_tracks_analysis
+                                              > get_segments (SpotipyCollect)
+- get_folder_features > get_tracks, get_tracks_features
+- get_tracks_df > get_tracks (one per playlist of users from get_public_playlists)
+
+Endpoint methods have the names, arguments and return values of the spotipy methods, as
+coroutines. All requests of a client share one pool of keep-alive connections and at most
+'concurrency' of them are in flight at once, so whole crawls can be issued together from one
+thread:
+
+    async def crawl():
+        async with AsyncSpotify.from_spotipy(spc.spotipy_client_cred(client_id, client_secret)) as sp:
+            playlists = await get_public_playlists(sp, usernames)
+            ...
+
+    asyncio.run(crawl())
+
+The crawl functions return the same values as their synchronous versions in SpotipyCollect and
+SpotipyCollectPub. Throttled (HTTP 429) requests honour Retry-After and pause every request of the
+client, transient failures are retried with backoff as in RequestScheduler.
+'''
+from cap_package import Instrument as ins
+from cap_package import RequestScheduler as rs
+from cap_package import SpotipyCollect as sc
+import aiohttp
+import asyncio
+import pandas as pd
+from pandas import json_normalize
+import random
+import re
+import spotipy
+import time
+
+# Default number of requests in flight at once, also the size of the connection pool
+CONCURRENCY = 64
+# Maximum number of playlists the user playlists endpoint returns in one request
+USER_PLAYLISTS_LIMIT = 50
+# Maximum number of albums the albums endpoint takes in one request
+ALBUMS_LIMIT = 20
+
+
+def _get_id(type_, id_):
+    '''
+    Id of a Spotify URI, URL or id.
+    '''
+    if id_.startswith('spotify:'):
+        return id_.split(':')[-1]
+
+    match = re.search(r'open\.spotify\.com/{}/([A-Za-z0-9]+)'.format(type_), id_)
+    if match is not None:
+        return match.group(1)
+
+    return id_
+
+
+class AsyncSpotify:
+    '''
+    Asyncio client of the Spotify Web API endpoints used by cap_package.
+
+    Use it as an async context manager, or call close when done.
+
+    Parameters
+    ----------
+    auth : str or spotipy auth manager
+        access token, or an auth manager (e.g. spotipy.SpotifyClientCredentials) the token is
+        requested from. Tokens of auth managers are refreshed when they expire.
+    base_url : str, optional
+        Default 'https://api.spotify.com/v1/'. Prefix of all endpoints (e.g. a local test server).
+    concurrency : int, optional
+        Default CONCURRENCY (64). Maximum number of requests in flight at once.
+    max_retries : int, optional
+        Default 5. Number of retries before a request is counted as failed and the error raised.
+    backoff : float, optional
+        Default 1. Base of exponential backoff in seconds.
+    max_backoff : float, optional
+        Default 60. Upper bound of a single backoff in seconds.
+    timeout : float, optional
+        Default 30. Seconds a single request may take.
+    '''
+
+    def __init__(self, auth=None, base_url='https://api.spotify.com/v1/', concurrency=CONCURRENCY,
+                 max_retries=5, backoff=1.0, max_backoff=60.0, timeout=30.0):
+
+        self.auth = auth
+        self.prefix = base_url if base_url.endswith('/') else base_url + '/'
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self._session = None
+        self._semaphore = None
+        self._paused_until = 0.0
+        self._token = None
+        self._token_time = 0.0
+
+        self.counters = {'requests': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+
+    @classmethod
+    def from_spotipy(cls, spotipyUserAuth, **kwargs):
+        '''
+        Client using the token or auth manager (and prefix) of a spotipy object.
+
+        Parameters
+        ----------
+        spotipyUserAuth : spotipy object
+            returned by 'spotipy_userauth' or 'spotipy_client_cred' function (ScheduledSpotify too).
+        kwargs :
+            other arguments of AsyncSpotify
+        '''
+        spotify = getattr(spotipyUserAuth, 'spotipy', spotipyUserAuth)
+        kwargs.setdefault('base_url', spotify.prefix)
+
+        return cls(spotify._auth or spotify.auth_manager, **kwargs)
+
+    async def __aenter__(self):
+
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        await self.close()
+        return False
+
+    async def open(self):
+        '''
+        Create the connection pool, called on the first request if not called before.
+        '''
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        '''
+        Returns
+        -------
+        counters : Dict
+            number of requests, throttled (429) responses, retries and failed requests
+        '''
+        return dict(self.counters)
+
+    async def _access_token(self, refresh=False):
+
+        if isinstance(self.auth, str) or self.auth is None:
+            return self.auth
+
+        # auth managers cache the token themselves, asking them once a minute is enough
+        if refresh or self._token is None or time.monotonic() - self._token_time > 60:
+
+            def request():
+                try:
+                    return self.auth.get_access_token(as_dict=False)
+                except TypeError:
+                    return self.auth.get_access_token()
+
+            self._token = await asyncio.get_running_loop().run_in_executor(None, request)
+            self._token_time = time.monotonic()
+
+        return self._token
+
+    def backoff_delay(self, attempt):
+        '''
+        Jittered exponential backoff delay for a retry attempt (starting at 0).
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def _get(self, url, params=None):
+        '''
+        GET a url (or path relative to the prefix) and return the parsed json response.
+        '''
+        if self._session is None:
+            await self.open()
+
+        if not url.startswith('http'):
+            url = self.prefix + url
+
+        attempt = 0
+        refreshed = False
+
+        while True:
+            wait = self._paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            token = await self._access_token()
+            headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+
+            try:
+                async with self._semaphore:
+                    self.counters['requests'] += 1
+
+                    async with self._session.get(url, params=params, headers=headers) as response:
+
+                        if response.status < 400:
+                            return await response.json(content_type=None)
+
+                        try:
+                            msg = (await response.json(content_type=None))['error']['message']
+                        except Exception:
+                            msg = response.reason
+                        error = spotipy.SpotifyException(response.status, -1, '{}:\n {}'.format(response.url, msg),
+                                                         headers=dict(response.headers))
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    self.counters['failed'] += 1
+                    raise
+
+                await asyncio.sleep(self.backoff_delay(attempt))
+
+            else:
+                if error.http_status == 401 and not refreshed and not isinstance(self.auth, str):
+                    # expired token, retried once with a new one
+                    refreshed = True
+                    await self._access_token(refresh=True)
+                    continue
+
+                if error.http_status not in rs.RETRY_STATUS or attempt >= self.max_retries:
+                    self.counters['failed'] += 1
+                    raise error
+
+                if error.http_status == 429:
+                    self.counters['throttled'] += 1
+                    wait = rs.retry_after(error)
+                    if wait is None:
+                        wait = self.backoff_delay(attempt)
+                    else:
+                        # small jitter so that paused requests do not all retry at the same instant
+                        wait += random.uniform(0, self.backoff)
+                    self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                else:
+                    await asyncio.sleep(self.backoff_delay(attempt))
+
+            attempt += 1
+            self.counters['retried'] += 1
+
+    # --------------------------------------------------------------------------------
+    #  Endpoints (same arguments and return values as spotipy)
+    # --------------------------------------------------------------------------------
+
+    async def user_playlists(self, user, limit=50, offset=0):
+
+        return await self._get('users/{}/playlists'.format(user), params={'limit': limit, 'offset': offset})
+
+    async def next(self, result):
+
+        if result['next']:
+            return await self._get(result['next'])
+
+        return None
+
+    async def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None,
+                              additional_types=('track',)):
+
+        params = {'limit': limit, 'offset': offset, 'additional_types': ','.join(additional_types)}
+        if fields is not None:
+            params['fields'] = fields
+        if market is not None:
+            params['market'] = market
+
+        return await self._get('playlists/{}/tracks'.format(_get_id('playlist', playlist_id)), params=params)
+
+    async def audio_analysis(self, track_id):
+
+        return await self._get('audio-analysis/{}'.format(_get_id('track', track_id)))
+
+    async def audio_features(self, tracks=[]):
+
+        if isinstance(tracks, str):
+            tracks = [tracks]
+
+        results = await self._get('audio-features', params={'ids': ','.join(_get_id('track', t) for t in tracks)})
+
+        return results['audio_features'] if 'audio_features' in results else results
+
+    async def albums(self, albums, market=None):
+
+        params = {'ids': ','.join(_get_id('album', a) for a in albums)}
+        if market is not None:
+            params['market'] = market
+
+        return await self._get('albums', params=params)
+
+
+# --------------------------------------------------------------------------------
+#  Async crawl functions
+# --------------------------------------------------------------------------------
+
+
+async def _fetch_cached(cache, endpoint, ids, request):
+    '''
+    ResponseCache.fetch with a coroutine requesting the missing responses.
+    Cache lookups and writes (SQLite) run in the default executor, not on the event loop.
+    '''
+    ids = list(ids)
+
+    if cache is None:
+        return await request(ids)
+
+    loop = asyncio.get_running_loop()
+    found, missing = await loop.run_in_executor(None, cache.lookup, endpoint, ids)
+
+    if missing:
+        fetched = dict(zip(missing, await request(missing)))
+        await loop.run_in_executor(None, cache.put_many, endpoint, fetched)
+        found.update(fetched)
+
+    return [found[id_] for id_ in ids]
+
+
+async def get_public_playlists(sp, usernames, keys=('id', 'name', 'description')):
+    '''
+    Get public playlists of given users as a list of tuples of details defined by keys,
+    see get_public_playlists in SpotipyCollectPub.
+
+    Playlists of all users are requested together. The first page of a user gives the
+    total number of playlists, the remaining pages are then requested together too.
+
+    sp : AsyncSpotify
+    usernames : List of usernames
+    keys : information items to be fetched. Default - ('id', 'name', 'description')
+
+    returns : list of users' playlist
+    '''
+    async def user_playlists(username):
+
+        first = await sp.user_playlists(username, limit=USER_PLAYLISTS_LIMIT)
+
+        if 'total' in first:
+            offsets = range(USER_PLAYLISTS_LIMIT, first['total'], USER_PLAYLISTS_LIMIT)
+            pages = [first] + list(await asyncio.gather(*[
+                sp.user_playlists(username, limit=USER_PLAYLISTS_LIMIT, offset=o) for o in offsets]))
+        else:
+            pages = [first]
+            while pages[-1]['next']:
+                pages.append(await sp.next(pages[-1]))
+
+        return [tuple([playlist[k] for k in keys]) for page in pages for playlist in page['items']]
+
+    return list(await asyncio.gather(*[user_playlists(u) for u in usernames]))
+
+
+@ins.instrument(rows=len)
+async def get_playlist_items(sp, playlist_id, fields=None):
+    '''
+    Fetch track objects of all tracks in a playlist, see get_playlist_items in SpotipyCollect.
+
+    Parameters
+    ----------
+    sp : AsyncSpotify
+    playlist_id : str
+        Spotify playlist id
+    fields : str, optional
+        Default None - complete track objects. Must include 'total' and 'items(track(...))'.
+
+    Returns
+    -------
+    tracks_json : List[Dict]
+        track objects of the playlist (local/unavailable tracks without a track object are skipped)
+    '''
+    limit = sc.PLAYLIST_TRACKS_LIMIT
+    first = await sp.playlist_tracks(playlist_id, fields=fields, limit=limit)
+
+    pages = [first] + list(await asyncio.gather(*[
+        sp.playlist_tracks(playlist_id, fields=fields, limit=limit, offset=o)
+        for o in range(limit, first['total'], limit)]))
+
+    return [item['track'] for page in pages for item in page['items'] if item['track']]
+
+
+async def get_tracks(sp, playlist_id, allCol=False):
+    '''
+    Extract track info of all tracks in a playlist, see get_tracks in SpotipyCollect.
+
+    Parameters
+    ----------
+    sp : AsyncSpotify
+    playlist_id : str
+        Spotify playlist id
+    allCol : bool, optional
+        Default False - dataframe with only track name, artists names and id.
+        True - complete dataframe of track details with all columns.
+
+    Returns
+    -------
+    df : pandas.Dataframe
+        (Relevant) Columns : artists_name, name, id
+    '''
+    fields = None if allCol else sc.TRACK_FIELDS
+    tracks_df = json_normalize(await get_playlist_items(sp, playlist_id, fields=fields), sep='_')
+
+    tracks_df.insert(loc=0, column='artists_name', value=sc.get_artist_name(tracks_df))
+
+    return tracks_df if allCol else tracks_df[['name', 'id', 'artists_name']]
+
+
+async def get_tracks_df(sp, user_playlistIDs, rem_dup=True, allCol=False):
+    '''
+    Tracks of the listed playlists in a single dataframe, see get_tracks_df in SpotipyCollectPub.
+    Tracks of all playlists are requested together.
+
+    sp : AsyncSpotify
+    user_playlistIDs : list of tuples - (user, playlist ID)
+    rem_dup : Default True. Remove duplicate entries of tracks if track name and artists' names match
+
+    returns : dataframe of tracks
+    '''
+    tracks = await asyncio.gather(*[get_tracks(sp, u[1], allCol=True) for u in user_playlistIDs])
+
+    tracks_df = [tr_df.assign(user=u[0]) for u, tr_df in zip(user_playlistIDs, tracks)]
+    pl_full_df = pd.concat(tracks_df, ignore_index=True)
+
+    if rem_dup:
+        pl_full_df = pl_full_df.drop_duplicates(subset=['name', 'artists_name'], keep='first', ignore_index=True)
+
+    if not allCol:
+        pl_full_df = pl_full_df[['name', 'id', 'artists_name', 'user']]
+
+    return pl_full_df
+
+
+@ins.instrument(rows=len)
+async def get_tracks_analysis(sp, tracksid, cache=None):
+    '''
+    Fetches track analysis of tracks, all requested together.
+
+    Parameters
+    ----------
+    sp : AsyncSpotify
+    tracksid : List[str]
+        list of track ids.
+    cache : ResponseCache, optional
+        Default None. If provided, only tracks missing from the cache are requested.
+
+    Returns
+    -------
+    tracks_analysis : List[Dict]
+        track analysis in the order of track ids
+    '''
+    async def request(ids):
+        return list(await asyncio.gather(*[sp.audio_analysis(id_) for id_ in ids]))
+
+    return await _fetch_cached(cache, 'audio_analysis', tracksid, request)
+
+
+@ins.instrument(rows=len)
+async def get_tracks_features(sp, tracksid, cache=None):
+    '''
+    Fetches track features of tracks in batches of AUDIO_FEATURES_LIMIT ids, all requested together.
+
+    Parameters
+    ----------
+    sp : AsyncSpotify
+    tracksid : List[str]
+        list of track ids.
+    cache : ResponseCache, optional
+        Default None. If provided, only tracks missing from the cache are requested.
+
+    Returns
+    -------
+    tracks_features : List[Dict]
+        track features in the order of track ids
+    '''
+    async def request(ids):
+        limit = sc.AUDIO_FEATURES_LIMIT
+        responses = await asyncio.gather(*[sp.audio_features(ids[i: i + limit]) for i in range(0, len(ids), limit)])
+        return [f for response in responses for f in response]
+
+    return await _fetch_cached(cache, 'audio_features', tracksid, request)
+
+
+async def get_albums(sp, album_ids):
+    '''
+    Album objects of albums in batches of ALBUMS_LIMIT ids, all requested together.
+
+    sp : AsyncSpotify
+    album_ids : List of album ids (None ids are skipped)
+
+    returns : list of album objects in the order of album ids
+    '''
+    album_ids = [a for a in album_ids if a is not None]
+    responses = await asyncio.gather(*[sp.albums(album_ids[i: i + ALBUMS_LIMIT])
+                                       for i in range(0, len(album_ids), ALBUMS_LIMIT)])
+
+    return [album for response in responses for album in response['albums']]
+
+
+async def get_playlist_analysis(sp, playlist_id, segments=True, min_conf=0.5, min_dur=0.25, tempo=True,
+                                sections=False, beats=False, bars=False, cache=None, key='name'):
+    '''
+    Gets audio analysis for all tracks in a playlist, see get_playlist_analysis in SpotipyCollect.
+
+    Parameters
+    ----------
+    sp : AsyncSpotify
+    playlist_id : str
+        Spotify playlist id
+    segments, min_conf, min_dur, tempo, sections, beats, bars :
+        see get_segments in SpotipyCollect
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+    key : str, optional
+        Default 'name'. 'id' - tracks are keyed by Spotify track id, see track_keys in SpotipyCollect.
+
+    Returns
+    -------
+    playlist_analysis : Dict
+        Keys: name of track from playlist (str), or track id
+        Value: List of frames returned from get_segments
+    '''
+    tracks_df = await get_tracks(sp, playlist_id)
+    tracks_analysis = await get_tracks_analysis(sp, list(tracks_df['id']), cache=cache)
+
+    def convert():
+
+        playlist_analysis = {}
+
+        for name_, track_analysis in zip(sc.track_keys(tracks_df, key), tracks_analysis):
+
+            playlist_analysis[name_] = sc.get_segments(
+                track_analysis, segments=segments, min_conf=min_conf, min_dur=min_dur, tempo=tempo,
+                sections=sections, beats=beats, bars=bars)
+
+        return playlist_analysis
+
+    # conversion runs in the default executor, requests of other playlists proceed meanwhile
+    return await asyncio.get_running_loop().run_in_executor(None, convert)
+
+
+@ins.instrument()
+async def get_folder_analysis(sp, filsort_pl=None, pl_name_id=None, segments=True, min_conf=0.5, min_dur=0.25,
+                              sections=True, tempo=False, beats=False, bars=False, cache=None, key='name'):
+    '''
+    Audio analysis of all tracks of playlists, all playlists requested together.
+    See get_folder_analysis in SpotipyCollect, the result can be passed to create_dataset.
+
+    sp : AsyncSpotify
+    filsort_pl : Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : Default None. In the case filsort_pl is not available,
+                 provide list of playlist name and id tuples
+    cache : Default None. ResponseCache of track analysis responses.
+    key : Default 'name'. 'id' - tracks are keyed by Spotify track id, see track_keys in SpotipyCollect.
+
+    Returns : Dict - Key : Name of the playlist : Value - dict returned from get_playlist_analysis
+    '''
+    playlists = sc.resolve_playlists(filsort_pl, pl_name_id)
+
+    analyses = await asyncio.gather(*[
+        get_playlist_analysis(sp, playlist_id, segments=segments, min_conf=min_conf, min_dur=min_dur, tempo=tempo,
+                              sections=sections, beats=beats, bars=bars, cache=cache, key=key)
+        for _, playlist_id in playlists])
+
+    return {name: analysis for (name, _), analysis in zip(playlists, analyses)}
+
+
+@ins.instrument(rows=len)
+async def get_folder_features(sp, filsort_pl=None, pl_name_id=None, cache=None):
+    '''
+    Track features of all tracks of playlists, see get_folder_features in SpotipyCollect.
+    Track features of all playlists are requested together in full batches of unique track ids.
+
+    sp : AsyncSpotify
+    filsort_pl : Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : Default None. In the case filsort_pl is not available,
+                 provide list of playlist name and id tuples
+    cache : Default None. ResponseCache of track features responses.
+
+    Returns : Dict - Key : Name of the playlist : Value - pandas.DataFrame of track features
+    '''
+    playlists = sc.resolve_playlists(filsort_pl, pl_name_id)
+
+    folder_tracks = await asyncio.gather(*[get_tracks(sp, playlist_id) for _, playlist_id in playlists])
+
+    unique_ids = list(dict.fromkeys(id_ for tracks_df in folder_tracks for id_ in tracks_df['id']))
+    features = dict(zip(unique_ids, await get_tracks_features(sp, unique_ids, cache=cache)))
+
+    folder_features = {}
+
+    for (name, _), tracks_df in zip(playlists, folder_tracks):
+
+        folder_features[name] = sc.get_playlist_features(
+            None, playlist_id=None, tracks_df=tracks_df, tracks_features=[features[id_] for id_ in tracks_df['id']])
+
+    return folder_features
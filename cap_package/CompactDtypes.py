@@ -0,0 +1,146 @@
+'''
+ Compact dtypes for segments, statistics and labels.
+
+ Function definitions : quantize_unit, dequantize_unit, to_float32, compact_segments,
+                        expand_segments, compact_frame, label_codes
+
+Segment values are stored by default as float64 (and pitches/timbre as lists of Python floats).
+The compact representation keeps:
+- pitches and confidence (range 0-1) quantized to uint8 (steps of 1/255), or float32
+- timbre and other float values as float32
+- labels as integer codes instead of one hot arrays
+Every conversion checks that no value is lost beyond the precision of the target dtype and raises
+ValueError otherwise. See the compact options of get_segments (SpotipyCollect), split_columns,
+get_segsec_stats and encode_label (ReadTransform).
+'''
+import numpy as np
+import pandas as pd
+
+# uint8 steps of values in range 0-1
+UNIT_SCALE = 255
+
+PITCH_COLS = ['pitch_{:0>2d}'.format(i + 1) for i in range(12)]
+TIMBRE_COLS = ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+
+
+def quantize_unit(values):
+    '''
+    Quantize values in range 0-1 to uint8.
+
+    Rounding to the nearest of UNIT_SCALE steps, dequantize_unit returns every value to within
+    half a step (1/510), so only finite values in range 0-1 are checked.
+
+    values : array of values in range 0-1
+    return : uint8 array
+    '''
+    values = np.asarray(values, dtype=np.float64)
+
+    if values.size and (not np.isfinite(values).all() or values.min() < 0 or values.max() > 1):
+        raise ValueError('Values to quantize must be finite and in range 0-1')
+
+    return np.rint(values * UNIT_SCALE).astype(np.uint8)
+
+
+def dequantize_unit(q, dtype=np.float32):
+    '''
+    Values in range 0-1 of uint8 quantized values.
+    '''
+    return (np.asarray(q) / UNIT_SCALE).astype(dtype)
+
+
+def to_float32(values, rtol=1e-6):
+    '''
+    Cast values to float32, checking that they fit.
+
+    values : float array
+    rtol : Default 1e-6. Maximum relative error allowed
+    return : float32 array
+    '''
+    values = np.asarray(values)
+    f32 = values.astype(np.float32)
+
+    with np.errstate(invalid='ignore'):
+        bad = ~np.isclose(f32, values, rtol=rtol, atol=0, equal_nan=True)
+
+    if bad.any():
+        raise ValueError('{} values do not fit in float32'.format(int(bad.sum())))
+
+    return f32
+
+
+def compact_segments(df, quantize=True):
+    '''
+    Compact representation of a segments dataframe.
+
+    df : segments dataframe with list columns 'pitches' and 'timbre' (or split columns pitch_01.. and timbre_01..)
+    quantize : Default True - pitches and confidence as uint8 (see quantize_unit).
+               False - as float32
+    return : dataframe with columns pitch_01 - pitch_12 and timbre_01 - timbre_12 instead of lists,
+             other columns kept (start and duration stay float64, they need the precision)
+    '''
+    if 'pitches' in df.columns:
+        pitches = np.array(df['pitches'].tolist(), dtype=np.float64).reshape(-1, 12)
+        timbre = np.array(df['timbre'].tolist(), dtype=np.float64).reshape(-1, 12)
+        df = df.drop(columns=['pitches', 'timbre'])
+    else:
+        pitches = df[PITCH_COLS].to_numpy(dtype=np.float64)
+        timbre = df[TIMBRE_COLS].to_numpy(dtype=np.float64)
+        df = df.drop(columns=PITCH_COLS + TIMBRE_COLS)
+
+    unit = quantize_unit if quantize else to_float32
+
+    out = df.copy()
+    if 'confidence' in out.columns:
+        out['confidence'] = unit(out['confidence'].to_numpy())
+
+    vectors = pd.concat([pd.DataFrame(unit(pitches), index=df.index, columns=PITCH_COLS),
+                         pd.DataFrame(to_float32(timbre), index=df.index, columns=TIMBRE_COLS)], axis=1)
+
+    return pd.concat([out, vectors], axis=1)
+
+
+def expand_segments(df, dtype=np.float64):
+    '''
+    Undo compact_segments - quantized columns are converted back to values in range 0-1.
+
+    df : compact segments dataframe
+    dtype : Default numpy.float64. dtype of the expanded columns
+    return : dataframe with the same columns
+    '''
+    df = df.copy()
+
+    for c in PITCH_COLS + TIMBRE_COLS + ['confidence']:
+        if c not in df.columns:
+            continue
+
+        if df[c].dtype == np.uint8:
+            df[c] = dequantize_unit(df[c].to_numpy(), dtype=dtype)
+        else:
+            df[c] = df[c].astype(dtype)
+
+    return df
+
+
+def compact_frame(df):
+    '''
+    Cast the float64 columns of a dataframe (e.g. statistics) to float32, checking that they fit.
+    '''
+    df = df.copy()
+
+    for c in df.columns[df.dtypes == np.float64]:
+        df[c] = to_float32(df[c].to_numpy())
+
+    return df
+
+
+def label_codes(labels):
+    '''
+    Integer codes of labels.
+
+    labels : list of labels
+    return : codes - array of the smallest integer dtype fitting the number of categories,
+             categories - sorted array of unique labels (code i is categories[i])
+    '''
+    categories, codes = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+
+    return codes.astype(np.min_scalar_type(max(len(categories) - 1, 0))), categories
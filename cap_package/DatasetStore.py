@@ -0,0 +1,221 @@
+'''
+ Consolidated parquet storage of the dataset.
+
+ Function definitions : stack_tracks, write_frame, read_frame, frame_playlists,
+                        is_deduplicated, write_membership, read_membership,
+                        write_tracks, read_tracks, playlist_folders
+
+Instead of one parquet file per track per dataframe, every dataframe type (tempo, segments,
+sections, beats, bars) is stored as one parquet dataset partitioned by playlist:
+
+    path/segments/playlist=<playlist name>/part-0.parquet
+    path/sections/playlist=<playlist name>/part-0.parquet
+    ...
+
+Rows carry 'track' (name the track is stored under) and 'track_id' columns, so a playlist
+or the whole corpus is read in a single scan. See create_dataset in SpotipyCollect and
+read_consolidated in ReadTransform.
+
+A track found in several playlists can instead be stored once (create_index_dataset in SpotipyCollect):
+
+    path/tracks/<track id>_<dataframe type>.parquet
+    path/membership.parquet
+
+membership.parquet has a row per track of every playlist (playlist, position, track, track_id).
+Track files are always named by track id, so different tracks with the same name are kept apart,
+'track' is a display name only. read_dataset and iter_dataset in ReadTransform read both layouts.
+
+Datasets stored by track id - built by update_dataset, stream_dataset and create_index_dataset - keep
+a track metadata table next to the playlist folders:
+
+    path/tracks.parquet/playlist=<playlist name>/part-0.parquet
+
+with a row per track of every playlist (id, name, artists_name, playlist, track), read indexed and sorted
+by Spotify track id. Like the consolidated dataframes it is partitioned by playlist, so the rows of a
+playlist are written without rewriting the rest of the table. Files of a track are named by its id,
+'track' is a display name only (see track_key in SpotipyCollect). Tables keyed by track id (e.g. feature
+statistics with a track_id column) are joined to it without matching names.
+'''
+from cap_package import Instrument as ins
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from urllib.parse import unquote
+
+# Rows per parquet row group. Large groups keep scans fast, a playlist of segments fits in a few groups.
+ROW_GROUP_SIZE = 64 * 1024
+# Folder of the track files and membership table of a deduplicated dataset
+TRACKS_DIR = 'tracks'
+MEMBERSHIP_NAME = 'membership.parquet'
+MEMBERSHIP_COLUMNS = ['playlist', 'position', 'track', 'track_id']
+# Track metadata table of a dataset
+TRACKS_TABLE = 'tracks.parquet'
+TRACKS_COLUMNS = ['id', 'name', 'artists_name', 'playlist', 'track']
+
+
+def stack_tracks(tracks, track_ids=None):
+    '''
+    Stack dataframes of tracks into one dataframe with track columns.
+
+    tracks : list of (track name, dataframe) tuples
+    track_ids : Default None. Dict of track name : Spotify track id.
+                track_id column is left empty for tracks missing in it.
+    returns : dataframe with 'track' and 'track_id' as first columns.
+              Index of the track dataframes is dropped.
+    '''
+    track_ids = track_ids or {}
+    dfs = []
+
+    for track, df in tracks:
+
+        df = df.reset_index(drop=True)
+        df.insert(loc=0, column='track_id', value=track_ids.get(track))
+        df.insert(loc=0, column='track', value=track)
+        dfs.append(df)
+
+    if not dfs:
+        return pd.DataFrame(columns=['track', 'track_id'])
+
+    stacked = pd.concat(dfs, ignore_index=True)
+    stacked['track_id'] = stacked['track_id'].astype('string')
+
+    return stacked
+
+
+@ins.instrument()
+def write_frame(df, path, frame, playlist, row_group_size=ROW_GROUP_SIZE):
+    '''
+    Write the dataframes of one type for all tracks of a playlist, replacing earlier data of the playlist.
+
+    df : dataframe returned by stack_tracks
+    path : pathlib.Path - path to the consolidated dataset directory
+    frame : name of the dataframe type, e.g. 'segments'
+    playlist : name of the playlist
+    row_group_size : Default ROW_GROUP_SIZE. Maximum rows per parquet row group.
+    '''
+    ins.count('DatasetStore.write_frame', rows=len(df))
+
+    df = df.copy()
+    df.insert(loc=0, column='playlist', value=playlist)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    pq.write_to_dataset(table, str(path.joinpath(frame)), partition_cols=['playlist'],
+                        basename_template='part-{i}.parquet', existing_data_behavior='delete_matching',
+                        min_rows_per_group=min(row_group_size, max(len(df), 1)),
+                        max_rows_per_group=row_group_size)
+
+
+@ins.instrument(rows=len)
+def read_frame(path, frame, playlists=None, columns=None, filters=None):
+    '''
+    Read a dataframe type for the whole corpus or selected playlists in one scan.
+
+    path : pathlib.Path - path to the consolidated dataset directory
+    frame : name of the dataframe type, e.g. 'segments'
+    playlists : Default None - all playlists. List of playlist names to read.
+    columns : Default None - all columns. List of columns to read.
+    filters : Default None. Row filters pushed into the parquet reader,
+              in pyarrow format, e.g. [('confidence', '>', 0.5)]
+    returns : dataframe with 'playlist' column
+    '''
+    filters = list(filters or [])
+
+    if playlists is not None:
+        filters.append(('playlist', 'in', list(playlists)))
+
+    df = pd.read_parquet(path.joinpath(frame), engine='pyarrow', columns=columns,
+                         filters=filters or None)
+
+    if 'playlist' in df.columns:
+        df['playlist'] = df['playlist'].astype(str)
+
+    return df
+
+
+def frame_playlists(path, frame):
+    '''
+    Names of the playlists stored for a dataframe type, without reading any data.
+
+    path : pathlib.Path - path to the consolidated dataset directory
+    frame : name of the dataframe type, e.g. 'segments'
+    returns : sorted list of playlist names
+    '''
+    return sorted(unquote(p.name.split('=', 1)[1]) for p in path.joinpath(frame).iterdir()
+                  if p.is_dir() and p.name.startswith('playlist='))
+
+
+def is_deduplicated(path):
+    '''
+    True if path is a deduplicated dataset (tracks stored once with a membership table).
+    '''
+    return path.joinpath(MEMBERSHIP_NAME).is_file()
+
+
+def write_membership(df, path):
+    '''
+    Write the membership table of a deduplicated dataset.
+
+    df : dataframe with columns MEMBERSHIP_COLUMNS - playlist, position (of the track in the playlist),
+         track (display name) and track_id (name the track files are stored under)
+    path : pathlib.Path - path to the dataset directory
+    '''
+    df = df[MEMBERSHIP_COLUMNS].astype({'playlist': 'string', 'position': 'int32', 'track': 'string',
+                                        'track_id': 'string'})
+    tmp = path.joinpath(MEMBERSHIP_NAME + '.tmp')
+
+    df.to_parquet(tmp, engine='pyarrow', index=False)
+    tmp.replace(path.joinpath(MEMBERSHIP_NAME))
+
+
+def read_membership(path, playlists=None):
+    '''
+    Read the membership table of a deduplicated dataset.
+
+    path : pathlib.Path - path to the dataset directory
+    playlists : Default None - all playlists. List of playlist names to read.
+    returns : dataframe with columns MEMBERSHIP_COLUMNS, in stored order
+    '''
+    filters = None if playlists is None else [('playlist', 'in', list(playlists))]
+
+    return pd.read_parquet(path.joinpath(MEMBERSHIP_NAME), engine='pyarrow', filters=filters)
+
+
+def write_tracks(df, path):
+    '''
+    Write rows of the track metadata table of a dataset.
+    Earlier rows of the playlists in df are replaced, rows of other playlists are kept.
+
+    df : dataframe with columns TRACKS_COLUMNS - id (name the files of the track are stored under),
+         name, artists_name, playlist and track (display name)
+    path : pathlib.Path - path to the dataset directory
+    '''
+    table = pa.Table.from_pandas(df[TRACKS_COLUMNS].astype('string'), preserve_index=False)
+
+    pq.write_to_dataset(table, str(path.joinpath(TRACKS_TABLE)), partition_cols=['playlist'],
+                        basename_template='part-{i}.parquet', existing_data_behavior='delete_matching')
+
+
+def read_tracks(path, playlists=None):
+    '''
+    Read the track metadata table of a dataset.
+
+    path : pathlib.Path - path to the dataset directory
+    playlists : Default None - all playlists. List of playlist names to read.
+    returns : dataframe indexed and sorted by track id, with columns name, artists_name, playlist and track
+    '''
+    filters = None if playlists is None else [('playlist', 'in', list(playlists))]
+
+    df = pd.read_parquet(path.joinpath(TRACKS_TABLE), engine='pyarrow', filters=filters)
+    df = df.astype({'playlist': 'string'})[TRACKS_COLUMNS]
+
+    return df.sort_values(['id', 'playlist'], kind='stable').set_index('id')
+
+
+def playlist_folders(path):
+    '''
+    Playlist folders of a dataset of one parquet file per track, without the track metadata table.
+
+    path : pathlib.Path - path to the dataset directory
+    returns : list of pathlib.Path
+    '''
+    return [p for p in path.iterdir() if p.is_dir() and p.name != TRACKS_TABLE]
@@ -0,0 +1,280 @@
+'''
+ Instrumentation of cap_package hot paths.
+
+ Function/Class definitions : enable, disable, enabled, reset, instrument, span, count,
+                              summary, save_summary, save_chrome_trace, frame_rows, json_bytes
+
+API calls, conversions, storage and transforms are decorated with 'instrument'. Recording is off
+by default and a disabled decorator only checks a flag before calling the function. Once enabled,
+every call records its wall time and, where known, the rows it produced and bytes it transferred:
+
+    from cap_package import Instrument as ins
+    ins.enable()
+    ...                                   # crawl, build or read the dataset
+    ins.save_summary('summary.json')      # calls, seconds, rows and bytes per function
+    ins.save_chrome_trace('trace.json')   # open in chrome://tracing or https://ui.perfetto.dev
+
+Times are inclusive, a function calling other instrumented functions also counts their time.
+'''
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+# Maximum number of trace events kept, later calls are still counted in the summary
+MAX_EVENTS = 1000000
+
+_enabled = False
+_trace = True
+_sizes = True
+_lock = threading.Lock()
+_stats = {}
+_events = []
+_origin = time.perf_counter()
+
+
+def enable(trace=True, sizes=True):
+    '''
+    Start recording.
+
+    trace : Default True. Keep an event per call for save_chrome_trace. False - only the summary is kept
+    sizes : Default True. Record bytes of API responses, measured by serializing them again.
+            False - skip it, it adds to the time of calling functions on large responses (e.g. track analysis)
+    '''
+    global _enabled, _trace, _sizes
+
+    _trace = trace
+    _sizes = sizes
+    _enabled = True
+
+
+def disable():
+    '''
+    Stop recording, recorded data is kept until reset.
+    '''
+    global _enabled
+
+    _enabled = False
+
+
+def enabled():
+
+    return _enabled
+
+
+def reset():
+    '''
+    Clear recorded data.
+    '''
+    global _origin
+
+    with _lock:
+        _stats.clear()
+        del _events[:]
+        _origin = time.perf_counter()
+
+
+def _record(name, start, end, rows=0, bytes_=0, error=False):
+
+    with _lock:
+        st = _stats.get(name)
+        if st is None:
+            st = _stats[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'bytes': 0, 'errors': 0}
+
+        st['calls'] += 1
+        st['seconds'] += end - start
+        st['max_seconds'] = max(st['max_seconds'], end - start)
+        st['rows'] += rows
+        st['bytes'] += bytes_
+        st['errors'] += error
+
+        if _trace and len(_events) < MAX_EVENTS:
+            args = {k: v for k, v in (('rows', rows), ('bytes', bytes_), ('error', error)) if v}
+            _events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                            'ts': (start - _origin) * 1e6, 'dur': (end - start) * 1e6, 'args': args})
+
+
+def count(name, rows=0, bytes_=0):
+    '''
+    Add rows or bytes to a function's totals without timing a call, e.g. bytes of files written inside it.
+    '''
+    if not _enabled:
+        return
+
+    with _lock:
+        st = _stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'bytes': 0,
+                                      'errors': 0})
+        st['rows'] += rows
+        st['bytes'] += bytes_
+
+
+def frame_rows(result):
+    '''
+    Total rows of the dataframes in a result (a dataframe or nested lists, tuples and dicts of them).
+    '''
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result)
+
+    if isinstance(result, dict):
+        result = result.values()
+
+    if isinstance(result, (list, tuple, type({}.values()))):
+        return sum(frame_rows(r) for r in result)
+
+    return 0
+
+
+def json_bytes(result):
+    '''
+    Size of a json response, as transferred without whitespace.
+    '''
+    return len(json.dumps(result, separators=(',', ':')).encode('utf-8'))
+
+
+def instrument(name=None, rows=None, bytes_=None):
+    '''
+    Decorator recording calls of a function (or coroutine function) while recording is enabled.
+
+    name : Default None - '<module>.<function>'. Name the calls are recorded under
+    rows : Default None. Function of the result returning the number of rows produced, e.g. len
+    bytes_ : Default None. Function of the result returning the number of bytes transferred
+    '''
+    def decorator(func):
+
+        label = name or '{}.{}'.format(func.__module__.split('.')[-1], func.__qualname__)
+
+        if inspect.iscoroutinefunction(func):
+
+            # coroutines are timed from the first step to their result, including time spent awaiting
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+
+                if not _enabled:
+                    return await func(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException:
+                    _record(label, start, time.perf_counter(), error=True)
+                    raise
+
+                end = time.perf_counter()
+                _record(label, start, end, rows=rows(result) if rows else 0,
+                        bytes_=bytes_(result) if bytes_ and _sizes else 0)
+
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                _record(label, start, time.perf_counter(), error=True)
+                raise
+
+            end = time.perf_counter()
+            _record(label, start, end, rows=rows(result) if rows else 0,
+                    bytes_=bytes_(result) if bytes_ and _sizes else 0)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class _Span:
+
+    def __init__(self, name):
+
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+
+        _record(self.name, self.start, time.perf_counter(), rows=self.rows, bytes_=self.bytes,
+                error=exc_type is not None)
+        return False
+
+
+class _NullSpan:
+
+    rows = 0
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, key, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    '''
+    Context manager recording a block of code while recording is enabled.
+    Set 'rows' and 'bytes' on the returned object to record them:
+
+        with ins.span('stage') as s:
+            df = ...
+            s.rows = len(df)
+    '''
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def summary():
+    '''
+    Returns
+    -------
+    summary : Dict
+        key - name : value - calls, seconds (total), mean_ms, max_seconds, rows, bytes and errors,
+        sorted by total time
+    '''
+    with _lock:
+        stats = {k: dict(v) for k, v in _stats.items()}
+
+    for st in stats.values():
+        st['mean_ms'] = 1000 * st['seconds'] / st['calls'] if st['calls'] else 0.0
+
+    return dict(sorted(stats.items(), key=lambda kv: -kv[1]['seconds']))
+
+
+def save_summary(path):
+    '''
+    Write the summary as json.
+    '''
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=1)
+
+
+def save_chrome_trace(path):
+    '''
+    Write recorded calls in the Chrome trace event format (chrome://tracing, Perfetto).
+    '''
+    with _lock:
+        events = list(_events)
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -1,6 +1,14 @@
+from cap_package import CompactDtypes as cd
+from cap_package import DatasetStore as ds
+from cap_package import Instrument as ins
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
+import os
 import numpy as np
 import pandas as pd
-import random
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 from sklearn.preprocessing import OneHotEncoder
 
@@ -9,7 +17,21 @@ from sklearn.preprocessing import OneHotEncoder
 # --------------------------------------------------------------------------------
 
 
-def read_dataset(path_, segments=True, sections=False, tempo=False):
+def read_parquet_file(args):
+    '''
+    Read a parquet file. Takes a single tuple so it can be mapped over a process pool.
+
+    args : (path to file, list of columns or None, row filters or None)
+    return : dataframe
+    '''
+    t, columns, filters = args
+
+    return pd.read_parquet(t, columns=columns, filters=filters)
+
+
+@ins.instrument()
+def read_dataset(path_, segments=True, sections=False, tempo=False, columns=None, filters=None, playlists=None,
+                 workers=None, processes=False):
     '''
     Read analysis(dataframes) dataset stored as parquet files.
     Use this when only track info needs to be retained and not playlist labels
@@ -17,47 +39,351 @@ def read_dataset(path_, segments=True, sections=False, tempo=False):
     path_ : path to dataset directory
     segments : Boolean - True to read segments files
     tempo : Boolean - True to read tempo files. Default False
+    columns : Default None - all columns. Dict of dataframe type : list of columns to read,
+              e.g. {'segments': ['start', 'timbre']}
+    filters : Default None. Dict of dataframe type : row filters in pyarrow format pushed into
+              the parquet reader, e.g. {'segments': [('confidence', '>', 0.5)]}
+    playlists : Default None - all playlists. List of playlist names to read
+    workers : Default None - files are read one after another. Number of threads (or processes)
+              to read files with. The result is the same, in the same order, as a serial read.
+    processes : Default False. True - read files in a pool of processes instead of threads
+    See iter_dataset to iterate over tracks without reading the whole dataset into memory.
+    A deduplicated dataset (create_index_dataset in SpotipyCollect) is read the same way, every stored track
+    is read once and the same dataframes are listed under every playlist the track is in, by display name.
+    Track names are the names files are stored under, track ids in a dataset with a track metadata
+    table (see track_keys in SpotipyCollect). DatasetStore.read_tracks maps them to names and artists.
     return : a tuple for all playlists in the folder -
              (name : Name of the playlist (string),
               segments : if true, a list of track analysis dataframes of all tracks from the playlist
               tempo : if true, a list of tempo values (as pandas dataframes/series) of all tracks from the playlist)
     '''
+    columns = columns or {}
+    filters = filters or {}
+    frames = [f for f, a in zip(['tempo', 'segments', 'sections'], [tempo, segments, sections]) if a]
+
+    # list files first, so they can be read in any order and put back in place
+    layout = []
+    tasks = []
+    dedup = ds.is_deduplicated(path_)
+
+    if dedup:
+        # every stored track is read once, however many playlists it is in
+        membership = ds.read_membership(path_, playlists)
+        tracks_path = path_.joinpath(ds.TRACKS_DIR)
+
+        for frame in frames:
+
+            suffix = '_{}.parquet'.format(frame)
+            stored = {t.name[:-len(suffix)] for t in tracks_path.glob('*' + suffix)}
+            names = [t for t in dict.fromkeys(membership['track_id']) if t in stored]
+            layout.append(names)
+            tasks += [(tracks_path.joinpath(t + suffix), columns.get(frame), filters.get(frame)) for t in names]
+    else:
+        for pl in ds.playlist_folders(path_):
+
+            if playlists is not None and pl.name not in playlists:
+                continue
+
+            pl_files = []
+            for frame in frames:
+
+                files = list(pl.glob('*_{}.parquet'.format(frame)))
+                pl_files.append([re.sub('_{}.parquet'.format(frame), '', t.name) for t in files])
+                tasks += [(t, columns.get(frame), filters.get(frame)) for t in files]
+
+            layout.append((pl.name, pl_files))
+
+    if ins.enabled():
+        ins.count('ReadTransform.read_dataset', bytes_=sum(t.stat().st_size for t, _, _ in tasks))
+
+    if workers is None or workers <= 1:
+        dfs = [read_parquet_file(task) for task in tasks]
+    else:
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool(max_workers=workers) as executor:
+            dfs = list(executor.map(read_parquet_file, tasks, chunksize=32 if processes else 1))
+
+    if ins.enabled():
+        ins.count('ReadTransform.read_dataset', rows=sum(len(df) for df in dfs))
+
     dataset = []
-    for pl in path_.iterdir():
+    dfs = iter(dfs)
 
-        pl_info = [pl.name]
+    if dedup:
+        # playlists sharing a track share its dataframes
+        frame_dfs = [{name: next(dfs) for name in names} for names in layout]
 
-        if tempo:
-            tempo_list = [(re.sub('_tempo.parquet', '', t.name), pd.read_parquet(t)) for t in pl.glob('*_tempo.parquet')]
-            pl_info.append(tempo_list)
+        for pl_name, tracks in membership.groupby('playlist', sort=False):
+            dataset.append([pl_name] + [[(t, d[i]) for t, i in zip(tracks['track'], tracks['track_id']) if i in d]
+                                        for d in frame_dfs])
 
-        if segments:
-            segments_list = [(re.sub('_segments.parquet', '', s.name), pd.read_parquet(s)) for s in pl.glob('*_segments.parquet')]
-            pl_info.append(segments_list)
+        return dataset
 
-        if sections:
-            sections_list = [(re.sub('_sections.parquet', '', s.name), pd.read_parquet(s)) for s in pl.glob('*_sections.parquet')]
-            pl_info.append(sections_list)
+    for pl_name, pl_files in layout:
+
+        pl_info = [pl_name]
+        for names in pl_files:
+            pl_info.append([(name, next(dfs)) for name in names])
 
         dataset.append(pl_info)
 
     return dataset
 
 
-def split_columns(df, pitch_cols, timbre_cols):
+def iter_dataset(path_, frame='segments', columns=None, filters=None, playlists=None):
+    '''
+    Lazily iterate over the tracks of a dataset, one track dataframe at a time.
+
+    Works on the dataset of one parquet file per track (create_dataset), the consolidated dataset
+    (create_dataset with consolidated=True) and the deduplicated dataset (create_index_dataset). Only the selected columns and the rows passing
+    the filters are read from the parquet files, and at most one playlist is held in memory.
+
+    path_ : path to dataset directory
+    frame : Default 'segments'. Dataframe type - 'tempo', 'segments', 'sections', 'beats' or 'bars'
+    columns : Default None - all columns. List of columns to read, e.g. ['start', 'timbre']
+    filters : Default None. Row filters in pyarrow format, e.g. [('confidence', '>', 0.5)]
+    playlists : Default None - all playlists. List of playlist names to read
+    yields : (name of the playlist, track name, track dataframe) tuples
+    '''
+    if ds.is_deduplicated(path_):
+        suffix = '_{}.parquet'.format(frame)
+        membership = ds.read_membership(path_, playlists)
+
+        for pl, track, track_id in zip(membership['playlist'], membership['track'], membership['track_id']):
+
+            file = path_.joinpath(ds.TRACKS_DIR, track_id + suffix)
+            if file.exists():
+                yield pl, track, pd.read_parquet(file, columns=columns, filters=filters)
+        return
+
+    if path_.joinpath(frame).is_dir():
+        # consolidated dataset
+        read_cols = None if columns is None else ['track'] + [c for c in columns if c != 'track']
+
+        for pl in ds.frame_playlists(path_, frame):
+
+            if playlists is not None and pl not in playlists:
+                continue
+
+            pl_df = ds.read_frame(path_, frame, playlists=[pl], columns=read_cols, filters=filters)
+            data_cols = [c for c in pl_df.columns if c not in ('playlist', 'track', 'track_id')] \
+                if columns is None else list(columns)
+
+            for track, tr_df in pl_df.groupby('track', sort=False):
+                yield pl, track, tr_df[data_cols].reset_index(drop=True)
+        return
+
+    suffix = '_{}.parquet'.format(frame)
+
+    for pl in ds.playlist_folders(path_):
+
+        if playlists is not None and pl.name not in playlists:
+            continue
+
+        for t in pl.glob('*' + suffix):
+            yield pl.name, t.name[:-len(suffix)], pd.read_parquet(t, columns=columns, filters=filters)
+
+
+@ins.instrument(rows=len)
+def read_consolidated(path_, frame='segments', playlists=None, columns=None, filters=None):
+    '''
+    Read one dataframe type of a consolidated dataset (see DatasetStore module) in a single scan.
+
+    path_ : path to consolidated dataset directory
+    frame : Default 'segments'. Dataframe type - 'tempo', 'segments', 'sections', 'beats' or 'bars'
+    playlists : Default None - whole corpus. List of playlist names to read
+    columns : Default None - all columns. List of columns to read
+    filters : Default None. Row filters in pyarrow format, e.g. [('confidence', '>', 0.5)]
+    return : dataframe of all tracks with 'playlist', 'track' and 'track_id' columns
+    '''
+    return ds.read_frame(path_, frame, playlists=playlists, columns=columns, filters=filters)
+
+
+def group_tracks(df):
+    '''
+    Split a dataframe returned by read_consolidated into the structure returned by read_dataset.
+
+    df : dataframe with 'playlist' and 'track' columns
+    return : a list for all playlists - [name of the playlist, list of (track name, dataframe) tuples]
+    '''
+    dataset = []
+    data_cols = [c for c in df.columns if c not in ('playlist', 'track', 'track_id')]
+
+    for pl, pl_df in df.groupby('playlist', sort=False):
+
+        tracks = [(track, tr_df[data_cols].reset_index(drop=True))
+                  for track, tr_df in pl_df.groupby('track', sort=False)]
+        dataset.append([pl, tracks])
+
+    return dataset
+
+
+@ins.instrument()
+def consolidate_dataset(path_, out_path, frames=('tempo', 'segments', 'sections')):
+    '''
+    Convert a dataset of one parquet file per track per dataframe (as created by create_dataset)
+    into a consolidated dataset (see DatasetStore module).
+
+    Track ids are taken from the manifest of a playlist folder, if it has one. A deduplicated dataset
+    (create_index_dataset in SpotipyCollect) is converted too, track ids are taken from its membership
+    table and every playlist gets a copy of its tracks.
+
+    path_ : path to dataset directory
+    out_path : path to consolidated dataset directory
+    frames : Default ('tempo', 'segments', 'sections'). Dataframe types to convert
+    '''
+    if ds.is_deduplicated(path_):
+        membership = ds.read_membership(path_)
+        tracks_path = path_.joinpath(ds.TRACKS_DIR)
+
+        for frame in frames:
+
+            suffix = '_{}.parquet'.format(frame)
+            stored = {t.name[:-len(suffix)] for t in tracks_path.glob('*' + suffix)}
+            dfs = {}
+
+            for pl, rows in membership.groupby('playlist', sort=False):
+
+                rows = rows[rows['track_id'].isin(stored)]
+                tracks = []
+                # stacked a track at a time, tracks of a playlist may share a display name
+                for t, i in zip(rows['track'], rows['track_id']):
+
+                    if i not in dfs:
+                        dfs[i] = pd.read_parquet(tracks_path.joinpath(i + suffix))
+                    tracks.append(ds.stack_tracks([(t, dfs[i])], track_ids={t: i}))
+
+                if tracks:
+                    ds.write_frame(pd.concat(tracks, ignore_index=True), out_path, frame, pl)
+        return
+
+    for pl in ds.playlist_folders(path_):
+
+        track_ids = {}
+        if pl.joinpath('manifest.json').exists():
+            with open(pl.joinpath('manifest.json'), encoding='utf-8') as f:
+                track_ids = {track: entry.get('id') for track, entry in json.load(f).items()}
+
+        for frame in frames:
+
+            suffix = '_{}.parquet'.format(frame)
+            tracks = [(t.name[:-len(suffix)], pd.read_parquet(t)) for t in sorted(pl.glob('*' + suffix))]
+
+            if tracks:
+                ds.write_frame(ds.stack_tracks(tracks, track_ids=track_ids), out_path, frame, pl.name)
+
+
+def vector_values(values, width=12):
+    '''
+    Values of a column of fixed length vectors as one 2D array.
+
+    values : pyarrow list array (or chunked array) - flattened without copying when it has no nulls,
+             or pandas series/array of lists or numpy arrays (as read from parquet by pandas)
+    width : Default 12. Length of the vectors
+    return : array (number of rows, width)
+    '''
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+
+        flat = values.flatten()
+        if len(flat) != len(values) * width:
+            raise ValueError('Vectors must have {} values'.format(width))
+
+        return flat.to_numpy(zero_copy_only=flat.null_count == 0).reshape(-1, width)
+
+    values = list(values)
+    if not values:
+        return np.empty((0, width))
+
+    return np.concatenate(values).reshape(-1, width)
+
+
+@ins.instrument(rows=len)
+def split_columns(df, pitch_cols, timbre_cols, compact=False):
     '''
     df : dataframe of track segments with columns of pitch vector and timbre vector
     pitch_cols : List of pitch column names to split in
     timbre_cols : List of timbre column names to split in
+    compact : Default False. True - pitch columns quantized to uint8 and timbre columns float32,
+              see CompactDtypes
 
     return : Updated dataframe with only pitches and timbre elements columns
     '''
+    pitches = vector_values(df['pitches'])
+    timbre = vector_values(df['timbre'])
+
+    if compact:
+        return pd.concat([pd.DataFrame(cd.quantize_unit(pitches), index=df.index, columns=pitch_cols),
+                          pd.DataFrame(cd.to_float32(timbre), index=df.index, columns=timbre_cols)], axis=1)
+
+    return pd.DataFrame(np.hstack([pitches, timbre]), index=df.index, columns=list(pitch_cols) + list(timbre_cols))
+
+
+def split_table(table, pitch_cols, timbre_cols):
+    '''
+    Dataframe of a pyarrow table of segments, with list columns 'pitches' and 'timbre' split into
+    columns (the lists are flattened in Arrow, without creating Python objects).
+
+    table : pyarrow table read from segments parquet file(s)
+    pitch_cols : List of pitch column names to split in
+    timbre_cols : List of timbre column names to split in
+    return : dataframe of the other columns followed by pitch and timbre columns
+    '''
+    vectors = [c for c in ('pitches', 'timbre') if c in table.column_names]
+    df = table.drop_columns(vectors).to_pandas()
+
+    blocks = []
+    if 'pitches' in vectors:
+        blocks.append(pd.DataFrame(vector_values(table.column('pitches')), index=df.index, columns=pitch_cols,
+                                   copy=False))
+    if 'timbre' in vectors:
+        blocks.append(pd.DataFrame(vector_values(table.column('timbre')), index=df.index, columns=timbre_cols,
+                                   copy=False))
+
+    return pd.concat([df] + blocks, axis=1)
+
+
+def read_segments_split(path_, pitch_cols, timbre_cols, columns=None, filters=None):
+    '''
+    Read a segments parquet file with pitches and timbre split into columns, see split_table.
+
+    path_ : path to the segments parquet file
+    pitch_cols : List of pitch column names to split in
+    timbre_cols : List of timbre column names to split in
+    columns : Default None - all columns. List of columns to read, e.g. ['start', 'timbre']
+    filters : Default None. Row filters in pyarrow format, e.g. [('confidence', '>', 0.5)]
+    return : dataframe
+    '''
+    table = pq.read_table(path_, columns=columns, filters=filters, use_pandas_metadata=True)
+
+    return split_table(table, pitch_cols, timbre_cols)
+
+
+@ins.instrument(rows=ins.frame_rows)
+def read_playlist_split(pl_path, pitch_cols, timbre_cols, columns=None, filters=None):
+    '''
+    Read segments files of all tracks of a playlist folder and split pitches and timbre of all of them
+    in one pass, see split_table.
+
+    pl_path : pathlib.Path - path to the playlist folder
+    pitch_cols : List of pitch column names to split in
+    timbre_cols : List of timbre column names to split in
+    columns : Default None - all columns. List of columns to read, e.g. ['start', 'timbre']
+    filters : Default None. Row filters in pyarrow format, e.g. [('confidence', '>', 0.5)]
+    return : list of (track name, segments dataframe) tuples, tracks in sorted order
+    '''
+    suffix = '_segments.parquet'
+    files = sorted(pl_path.glob('*' + suffix))
+    if not files:
+        return []
 
-    new_seg = pd.DataFrame()
-    new_seg[pitch_cols] = pd.DataFrame(df.pitches.tolist(), index=df.index)
-    new_seg[timbre_cols] = pd.DataFrame(df.timbre.tolist(), index=df.index)
+    tables = [pq.read_table(t, columns=columns, filters=filters, use_pandas_metadata=True) for t in files]
+    df = split_table(pa.concat_tables(tables, promote_options='default'), pitch_cols, timbre_cols)
 
-    return new_seg
+    offsets = np.concatenate([[0], np.cumsum([t.num_rows for t in tables])])
+
+    return [(t.name[:-len(suffix)], df.iloc[offsets[i]: offsets[i + 1]]) for i, t in enumerate(files)]
 
 
 def timbre_minmax_tr(track_seg):
@@ -94,6 +420,221 @@ def pop_timbre_minmax(timbre_mins, timbre_maxs):
     return pop_timbre_min, pop_timbre_max
 
 
+def segment_batch(batch):
+    '''
+    Pitch and timbre values of a batch of segments as one array.
+
+    batch : dataframe of segments with list columns 'pitches' and 'timbre', or with split columns
+            (pitch_1.. / pitch_01.., timbre_1.. / timbre_01.., see split_columns),
+            or an array (number of segments, 24) of 12 pitch then 12 timbre values
+    return : float64 array (number of segments, 24)
+    '''
+    if not isinstance(batch, pd.DataFrame):
+        return np.asarray(batch, dtype=np.float64).reshape(-1, 24)
+
+    if 'pitches' in batch.columns and 'timbre' in batch.columns:
+        pitches = np.array(batch['pitches'].tolist(), dtype=np.float64).reshape(-1, 12)
+        timbre = np.array(batch['timbre'].tolist(), dtype=np.float64).reshape(-1, 12)
+        return np.hstack([pitches, timbre])
+
+    pitch_cols = [c for c in batch.columns if re.match(r'^pitch_\d+$', c)]
+    timbre_cols = [c for c in batch.columns if re.match(r'^timbre_\d+$', c)]
+    # order numerically so that timbre_1 .. timbre_12 and timbre_01 .. timbre_12 both work
+    pitch_cols.sort(key=lambda c: int(c.split('_')[1]))
+    timbre_cols.sort(key=lambda c: int(c.split('_')[1]))
+
+    return batch[pitch_cols + timbre_cols].to_numpy(dtype=np.float64)
+
+
+class SegmentStats:
+    '''
+    Streaming statistics of the 12 pitch and 12 timbre values of segments, computed in one pass.
+
+    Keeps count, min, max, mean and variance (merged with Chan's parallel update) and a uniform
+    reservoir sample of segments for quantiles. Reducers of separate workers can be merged, and
+    saved to reuse scaling bounds at inference time.
+    Statistics are arrays of 24 values - pitch 1 to 12 then timbre 1 to 12.
+
+    reservoir : Default 100000. Number of segments kept for quantiles, 0 to skip quantiles.
+    seed : Default None. Seed of the reservoir sampling.
+    '''
+    dims = ['pitch_{:0>2d}'.format(i + 1) for i in range(12)] + ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+
+    def __init__(self, reservoir=100000, seed=None):
+
+        self.count = 0
+        self.min = np.full(24, np.inf)
+        self.max = np.full(24, -np.inf)
+        self.mean = np.zeros(24)
+        self.m2 = np.zeros(24)
+        self.reservoir_size = reservoir
+        self.sample = np.empty((0, 24))
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, batch):
+        '''
+        Add a batch of segments (see segment_batch for accepted formats).
+        return : self
+        '''
+        x = segment_batch(batch)
+        n = len(x)
+
+        if n == 0:
+            return self
+
+        self.min = np.minimum(self.min, x.min(axis=0))
+        self.max = np.maximum(self.max, x.max(axis=0))
+
+        mean = x.mean(axis=0)
+        m2 = ((x - mean) ** 2).sum(axis=0)
+        self._combine(n, mean, m2)
+
+        self._reservoir_update(x)
+        self.count += n
+
+        return self
+
+    def _combine(self, n, mean, m2):
+
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * n / total
+
+    def _reservoir_update(self, x):
+
+        size = self.reservoir_size
+        fill = min(max(size - len(self.sample), 0), len(x))
+
+        if fill:
+            self.sample = np.vstack([self.sample, x[:fill]])
+
+        rest = x[fill:]
+        if len(rest):
+            # algorithm R - row j (0 based, over all rows seen) replaces a random slot with probability size / (j + 1)
+            seen = self.count + fill + np.arange(len(rest))
+            slots = (self.rng.random(len(rest)) * (seen + 1)).astype(np.int64)
+            keep = slots < size
+            self.sample[slots[keep]] = rest[keep]
+
+    def merge(self, other):
+        '''
+        Merge the statistics of another SegmentStats (e.g. of another worker) into this one.
+        return : self
+        '''
+        if other.count == 0:
+            return self
+
+        if self.count == 0:
+            self.min, self.max = other.min.copy(), other.max.copy()
+            self.mean, self.m2 = other.mean.copy(), other.m2.copy()
+            self.sample = other.sample[:self.reservoir_size].copy()
+            self.count = other.count
+            return self
+
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self._combine(other.count, other.mean, other.m2)
+
+        # draw from each reservoir in proportion to the segments it represents
+        size = min(self.reservoir_size, len(self.sample) + len(other.sample))
+        total = self.count + other.count
+        k = min(int(round(size * self.count / total)), len(self.sample))
+        k = max(k, size - len(other.sample))
+        own = self.rng.choice(len(self.sample), k, replace=False)
+        others = self.rng.choice(len(other.sample), size - k, replace=False)
+        self.sample = np.vstack([self.sample[own], other.sample[others]])
+
+        self.count = total
+
+        return self
+
+    @property
+    def var(self):
+        '''
+        Population variance
+        '''
+        return self.m2 / self.count if self.count else np.full(24, np.nan)
+
+    @property
+    def std(self):
+
+        return np.sqrt(self.var)
+
+    def quantiles(self, q):
+        '''
+        Approximate quantiles from the reservoir sample.
+
+        q : quantile or list of quantiles in range 0-1
+        return : array (24,) or (len(q), 24)
+        '''
+        if not len(self.sample):
+            raise ValueError('No segments in the reservoir sample')
+
+        return np.quantile(self.sample, q, axis=0)
+
+    def timbre_minmax(self):
+        '''
+        return : minimum and maximum values of timbre elements over the whole dataset as lists
+                 (same as pop_timbre_minmax)
+        '''
+        return list(self.min[12:]), list(self.max[12:])
+
+    def to_frame(self, q=(0.01, 0.25, 0.5, 0.75, 0.99)):
+        '''
+        return : dataframe of statistics (rows) of every pitch and timbre dimension (columns)
+        '''
+        rows = {'count': np.full(24, self.count), 'min': self.min, 'max': self.max, 'mean': self.mean,
+                'std': self.std}
+
+        if len(self.sample):
+            for q_, v in zip(q, self.quantiles(list(q))):
+                rows['q{:g}'.format(q_)] = v
+
+        return pd.DataFrame(rows, index=self.dims).T
+
+    def save(self, path):
+        '''
+        Save the statistics (and reservoir sample) to a .npz file.
+        '''
+        np.savez(path, count=self.count, min=self.min, max=self.max, mean=self.mean, m2=self.m2,
+                 reservoir=self.reservoir_size, sample=self.sample)
+
+    @classmethod
+    def load(cls, path, seed=None):
+        '''
+        Load statistics saved by save.
+        '''
+        with np.load(path) as f:
+            stats = cls(reservoir=int(f['reservoir']), seed=seed)
+            stats.count = int(f['count'])
+            stats.min, stats.max = f['min'], f['max']
+            stats.mean, stats.m2 = f['mean'], f['m2']
+            stats.sample = f['sample']
+
+        return stats
+
+
+@ins.instrument()
+def dataset_stats(path_, playlists=None, filters=None, reservoir=100000, seed=None):
+    '''
+    Statistics of segments of a stored dataset, read track by track (see iter_dataset) in a single pass.
+
+    path_ : pathlib.Path - path to the dataset folder (per playlist folders or a consolidated dataset)
+    playlists : Default None - all playlists. List of playlist names to include.
+    filters : Default None. Row filters of segments, e.g. [('confidence', '>', 0.5)]
+    reservoir, seed : see SegmentStats
+    return : SegmentStats
+    '''
+    stats = SegmentStats(reservoir=reservoir, seed=seed)
+
+    for pl, track, df in iter_dataset(path_, frame='segments', columns=['pitches', 'timbre'],
+                                      filters=filters, playlists=playlists):
+        stats.update(df)
+
+    return stats
+
+
 def minmax_scale(x, mins, maxs, a=-1, b=1):
     '''
     Scale vector x between -1 and 1.
@@ -110,7 +651,84 @@ def minmax_scale(x, mins, maxs, a=-1, b=1):
     return rescaled_x
 
 
-def transform_dataset(dataset, timbre_min, timbre_max, num_seg=50, bin_num=5):
+def pack_segments(dataset, columns=None):
+    '''
+    Pack segments dataframes of all tracks into one ragged array.
+
+    dataset : list of track segments dataframes (with the same numeric columns)
+    columns : Default None - all columns of the first dataframe. List of columns to pack
+    return : values - float32 array (total number of segments, number of columns),
+             offsets - int64 array (number of tracks + 1), rows of track i are values[offsets[i]: offsets[i + 1]],
+             columns - list of packed column names
+    '''
+    if columns is None:
+        columns = list(dataset[0].columns)
+
+    values = np.concatenate([df[columns].to_numpy(dtype=np.float32) for df in dataset]) \
+        if dataset else np.empty((0, len(columns)), dtype=np.float32)
+    offsets = np.concatenate([[0], np.cumsum([len(df) for df in dataset])]).astype(np.int64)
+
+    return values, offsets, list(columns)
+
+
+def sample_segments(offsets, num_seg=50, bin_num=5, rng=None, draws=1):
+    '''
+    Draw stratified random segments for all tracks at once.
+
+    Rows of every track are divided into bin_num equal bins (trailing rows left over are never drawn),
+    and num_seg / bin_num rows are drawn without replacement from each bin, in row order.
+
+    offsets : offsets of tracks returned by pack_segments
+    num_seg : Default : 50 - Number of segments to be drawn per track.
+    bin_num : Default : 5 - Number of bins
+    rng : Default None - unseeded. numpy.random.Generator to draw with
+    draws : Default 1. Number of independent draws per track
+    return : int64 array (draws, number of tracks, num_seg) of row indices into the packed values
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    bin_seg = int(num_seg / bin_num)
+    starts = offsets[:-1]
+    bin_size = np.diff(offsets) // bin_num
+
+    if len(bin_size) == 0:
+        return np.empty((draws, 0, bin_seg * bin_num), dtype=np.int64)
+
+    if (bin_size < bin_seg).any():
+        raise ValueError('Tracks need at least num_seg segments, found {}'.format(bin_size.min() * bin_num))
+
+    # random keys per row of every bin, rows past the bin size get keys that are never among the smallest
+    max_bin = bin_size.max()
+    keys = rng.random((draws, len(bin_size), bin_num, max_bin), dtype=np.float32)
+    outside = np.arange(max_bin)[None, :] >= bin_size[:, None]
+    keys[np.broadcast_to(outside[None, :, None, :], keys.shape)] = 2
+
+    pos = np.argpartition(keys, bin_seg - 1, axis=-1)[..., :bin_seg]
+    pos.sort(axis=-1)
+
+    idx = starts[:, None, None] + np.arange(bin_num)[None, :, None] * bin_size[:, None, None] + pos
+
+    return idx.reshape(draws, len(bin_size), bin_seg * bin_num)
+
+
+def scale_timbre(values, timbre_idx, timbre_min, timbre_max, a=-1, b=1):
+    '''
+    Scale timbre columns of an array in place between a and b (see minmax_scale), in one broadcast operation.
+
+    values : float array with columns in the last axis
+    timbre_idx : positions of the 12 timbre columns
+    timbre_min, timbre_max : List or numpy array of minimums/maximums of timbre values over the whole dataset
+    return : values
+    '''
+    timbre_min = np.asarray(timbre_min, dtype=values.dtype)
+    timbre_max = np.asarray(timbre_max, dtype=values.dtype)
+
+    values[..., timbre_idx] = a + (values[..., timbre_idx] - timbre_min) * (b - a) / (timbre_max - timbre_min)
+
+    return values
+
+
+@ins.instrument(rows=len)
+def transform_dataset(dataset, timbre_min, timbre_max, num_seg=50, bin_num=5, seed=None):
     '''
     Create input arrays to be fed into a model.
     A fixed number(num_seg) of segments are randomly chosen from each track(dataframe) and
@@ -121,145 +739,591 @@ def transform_dataset(dataset, timbre_min, timbre_max, num_seg=50, bin_num=5):
     a filter constricting them to minimum duration and confidence.
     See get_segments in SpotifyCollect module for details.
 
+    All tracks are packed into one array and sampled and scaled together,
+    see pack_segments, sample_segments and scale_timbre.
+
     dataset : list of track segments dataframes
     timbre_min : List or numpy array of minimums of timbre values over the whole dataset
     timbre_max : List or numpy array of maximums of timbre values over the whole dataset
     num_seg : Default : 50 - Number of segments to be taken for input.
     bin_num : Number of bins for rows of segments dataframes are to be divided in
+    seed : Default None. Seed of the random generator, for reproducible inputs
 
-    returns : data - list of track input arrays.
+    returns : data - float32 array (number of tracks, num_seg * number of columns),
+              one row of chosen segments (row after row) per track.
     '''
     if num_seg % bin_num != 0:
         print('Make sure num_seg is divisible by bin_num to ensure equal number of segments are chosen from each bin')
 
-    bin_seg = int(num_seg / bin_num)
-    timbre_ = ['timbre_{}'.format(i + 1) for i in range(12)]
+    values, offsets, columns = pack_segments(dataset)
+    timbre_idx = [i for i, c in enumerate(columns) if c.startswith('timbre')]
 
-    timbre_min = np.array(timbre_min)
-    timbre_max = np.array(timbre_max)
+    idx = sample_segments(offsets, num_seg=num_seg, bin_num=bin_num, rng=np.random.default_rng(seed))[0]
 
-    data_arrays = []
+    # Gather chosen segments and scale their timbre values
+    segments = scale_timbre(values[idx], timbre_idx, timbre_min, timbre_max)
 
-    for df in dataset:
+    return segments.reshape(len(idx), -1)
 
-        bin_size = int(len(df) / bin_num)
-        idx = list(df.index)
 
-        # make a list of randomly chosen 'bin_seg' number of segments from each bin
-        idx_list = []
-        for b in range(bin_num):
+class SegmentSampler:
+    '''
+    Reproducible random draws of segments for model inputs, for data augmentation over epochs.
 
-            idx_list += random.sample(idx[b * bin_size: (b + 1) * bin_size], bin_seg)
+    Segments of all tracks are packed and their timbre values scaled once, every draw only gathers
+    the chosen rows. Draws of an epoch depend only on seed and epoch number, so any epoch can be regenerated.
 
-        idx_list.sort()
+    dataset : list of track segments dataframes
+    timbre_min : List or numpy array of minimums of timbre values over the whole dataset
+    timbre_max : List or numpy array of maximums of timbre values over the whole dataset
+    num_seg : Default : 50 - Number of segments to be drawn per track.
+    bin_num : Number of bins for rows of segments dataframes are to be divided in
+    seed : Default None - random seed (stored in self.seed). Seed of the draws.
+    '''
+
+    def __init__(self, dataset, timbre_min, timbre_max, num_seg=50, bin_num=5, seed=None):
+
+        values, offsets, columns = pack_segments(dataset)
+        timbre_idx = [i for i, c in enumerate(columns) if c.startswith('timbre')]
+
+        self.values = scale_timbre(values, timbre_idx, timbre_min, timbre_max)
+        self.offsets = offsets
+        self.columns = columns
+        self.num_seg = num_seg
+        self.bin_num = bin_num
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+        # fail early on tracks too short to draw from
+        bin_size = np.diff(offsets) // bin_num
+        if len(bin_size) and bin_size.min() < int(num_seg / bin_num):
+            raise ValueError('Tracks need at least num_seg segments, found {}'.format(bin_size.min() * bin_num))
+
+    def __len__(self):
+
+        return len(self.offsets) - 1
+
+    def indices(self, epoch=0, k=1):
+        '''
+        Rows drawn for an epoch.
+
+        epoch : Default 0. Epoch number
+        k : Default 1. Number of independent draws per track
+        return : int64 array (k, number of tracks, num_seg) of row indices into self.values
+        '''
+        rng = np.random.default_rng([self.seed, epoch])
+
+        return sample_segments(self.offsets, num_seg=self.num_seg, bin_num=self.bin_num, rng=rng, draws=k)
+
+    def draw(self, epoch=0, k=1):
+        '''
+        Inputs of an epoch.
+
+        epoch : Default 0. Epoch number
+        k : Default 1. Number of independent draws per track
+        return : float32 array (k, number of tracks, num_seg * number of columns)
+        '''
+        idx = self.indices(epoch, k)
+
+        return self.values[idx].reshape(k, len(self), -1)
+
+    def batches(self, epoch=0, k=1, batch_size=32):
+        '''
+        Inputs of an epoch in batches of tracks, only one batch is gathered at a time.
+
+        epoch : Default 0. Epoch number
+        k : Default 1. Number of independent draws per track
+        batch_size : Default 32. Number of tracks per batch
+        yields : (positions of the tracks in dataset, float32 array (k, len(positions), num_seg * number of columns))
+        '''
+        idx = self.indices(epoch, k)
+
+        for i in range(0, len(self), batch_size):
+
+            batch = idx[:, i: i + batch_size]
+            yield np.arange(i, i + batch.shape[1]), self.values[batch].reshape(k, batch.shape[1], -1)
+
+    def epochs(self, n_epochs=None, k=1, start=0):
+        '''
+        Fresh inputs every epoch.
+
+        n_epochs : Default None - endless. Number of epochs
+        k : Default 1. Number of independent draws per track per epoch
+        start : Default 0. First epoch number, to resume training
+        yields : (epoch number, inputs of the epoch, see draw)
+        '''
+        epoch = start
 
-        # filter index of n -> num_seg randomly chosen segments
-        df_ = df.loc[idx_list]
+        while n_epochs is None or epoch < start + n_epochs:
 
-        # Scale timbre values
-        df_[timbre_] = df_[timbre_].apply(minmax_scale, args=(timbre_min, timbre_max), axis=1)
+            yield epoch, self.draw(epoch, k)
+            epoch += 1
 
-        # Convert dataframe to numpy array
-        segments = df_.to_numpy()
-        segments = np.hstack(segments)
-        data_arrays.append(segments)
 
-    return data_arrays
+# Segment statistics in the order of the flattened segstat table columns
+SEG_STATS = ['kurtosis', 'max', 'mean', 'min', 'skewness', 'std']
+# Number of longest sections kept per track
+TOP_SECTIONS = 5
 
+_KEYS_ONEHOT = np.eye(12)
 
-def get_segsec_stats(tracks_seg, tracks_sec):
+
+def timbre_values(df):
     '''
-    Create input arrays to be fed into a model.
-    A fixed number(num_seg) of segments are randomly chosen from each track(dataframe) and
-    timbre columns of these segments are scaled. The resulting dataframe is then converted
-    to a numpy array
+    Timbre values of segments as an array.
 
-    Note - Segments dataframe will have missing indices since they have been passed through
-    a filter constricting them to minimum duration and confidence.
-    See get_segments in SpotifyCollect module for details.
+    df : segments dataframe with list column 'timbre' or split timbre columns (timbre_1.. or timbre_01..)
+    return : float64 array (number of segments, 12)
+    '''
+    if 'timbre' in df.columns:
+        return np.array(df['timbre'].tolist(), dtype=np.float64).reshape(-1, 12)
 
-    dataset : list of track segments dataframes
-    timbre_min : List or numpy array of minimums of timbre values over the whole dataset
-    timbre_max : List or numpy array of maximums of timbre values over the whole dataset
-    num_seg : Default : 50 - Number of segments to be taken for input.
-    bin_num : Number of bins for rows of segments dataframes are to be divided in
+    cols = sorted((c for c in df.columns if re.match(r'^timbre_\d+$', c)), key=lambda c: int(c.split('_')[1]))
+
+    return df[cols].to_numpy(dtype=np.float64)
 
-    returns : data - list of track input arrays.
+
+def _zero_fperr(x, tol):
+    # floating point error of sums of constant values, as in pandas skew/kurt
+    return np.where(np.abs(x) < tol, 0, x)
+
+
+def group_moments(values, offsets):
     '''
+    Min, max, mean, std, skewness and kurtosis of columns of groups of rows, in one pass over the rows.
+    std, skewness and kurtosis are sample statistics as computed by pandas (std, skew, kurt).
 
-    sec_stat = []
-    seg_stat = []
+    values : float array (number of rows, number of columns)
+    offsets : int array (number of groups + 1), rows of group i are values[offsets[i]: offsets[i + 1]].
+              Groups must not be empty.
+    return : Dict - key : statistic name (see SEG_STATS) : value - array (number of groups, number of columns)
+    '''
+    counts = np.diff(offsets)
+    starts = offsets[:-1]
+    n = counts[:, None].astype(np.float64)
 
-    keys = [x for x in range(12)]
-    keys_column = ['key_{:0>2d}'.format(i + 1) for i in range(12)]
-    enc = OneHotEncoder(categories=[keys])
-
-    for t in zip(tracks_seg, tracks_sec):
-
-        kl = {}
-        tsec_stat = {}
-        tseg_stat = {}
-        seg = t[0]
-        sec = t[1]
-
-        top5 = sec.duration.sort_values(ascending=False)[:5].index.sort_values().array
-
-        for i in top5:
-
-            tsec_stat['sec_{}'.format(i)] = \
-                seg[(seg['start'] >= sec.start[i]) & (seg['start'] < sec.start[i] + sec.duration[i])] \
-                .loc[:, 'timbre_01': 'timbre_12'] \
-                .mean()
-            kl['sec_{}'.format(i)] = sec.iloc[i][['key', 'loudness']]
-
-        tsec_stat = pd.DataFrame.from_dict(tsec_stat, orient='index')
-        kl = pd.DataFrame.from_dict(kl, orient='index')
-        kl = kl.astype({'key': 'int32'})
-        X = np.array(kl.key).reshape(-1, 1)
-        enc_keys = enc.fit_transform(X).toarray()
-        kl[keys_column] = pd.DataFrame(enc_keys, index=kl.index)
-        kl = kl.drop(columns=['key'])
-
-        nulls = [i for i, x in tsec_stat.iterrows() if x.isnull().sum() > 0]
-        if nulls:
-            indices = list(set(tsec_stat.index[:len(top5)]) - set(nulls))
-            val = tsec_stat.loc[indices].mean()
-            for idx in nulls:
-                tsec_stat.loc[idx] = val
-                tsec_stat.rename(index={idx: '{}_upd'.format(idx)}, inplace=True)
-                kl.rename(index={idx: '{}_upd'.format(idx)}, inplace=True)
-
-        if len(top5) < 5:
-            index = ['sec_avg{}'.format(j) for j in range(5 - len(top5))]
-
-            top_avg = tsec_stat.iloc[:len(top5)].mean()
-            values = [top_avg for j in range(5 - len(top5))]
-            lines = pd.DataFrame(values, index=index)
-            tsec_stat = pd.concat(
-                [tsec_stat.iloc[:int(len(top5) / 2)], lines, tsec_stat.iloc[int(len(top5) / 2):]])
-
-            filler = kl.iloc[int(len(top5) / 2)]
-            values_ = [filler for j in range(5 - len(top5))]
-            lines_ = pd.DataFrame(values_, index=index)
-            kl = pd.concat(
-                [kl.iloc[:int(len(top5) / 2)], lines_, kl.iloc[int(len(top5) / 2):]])
-
-        tsec = pd.concat([kl, tsec_stat], axis=1)
-        sec_stat.append(tsec)
-
-        tseg_stat['min'] = seg.loc[:, 'timbre_01': 'timbre_12'].min()
-        tseg_stat['max'] = seg.loc[:, 'timbre_01': 'timbre_12'].max()
-        tseg_stat['mean'] = seg.loc[:, 'timbre_01': 'timbre_12'].mean()
-        tseg_stat['std'] = seg.loc[:, 'timbre_01': 'timbre_12'].std()
-        tseg_stat['skewness'] = seg.loc[:, 'timbre_01': 'timbre_12'].skew()
-        tseg_stat['kurtosis'] = seg.loc[:, 'timbre_01': 'timbre_12'].kurt()
-
-        tseg_stat = pd.DataFrame.from_dict(tseg_stat, orient='index')
-        seg_stat.append(tseg_stat)
+    mean = np.add.reduceat(values, starts, axis=0) / n
+    dev = values - np.repeat(mean, counts, axis=0)
+    dev2 = dev * dev
+    m2 = np.add.reduceat(dev2, starts, axis=0)
+    m3 = np.add.reduceat(dev2 * dev, starts, axis=0)
+    m4 = np.add.reduceat(dev2 * dev2, starts, axis=0)
+
+    min_ = np.minimum.reduceat(values, starts, axis=0)
+    max_ = np.maximum.reduceat(values, starts, axis=0)
+    eps_abs = np.finfo(np.float64).eps * np.maximum(np.abs(min_), np.abs(max_))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m2 / (n - 1))
+
+        m2_ = _zero_fperr(m2, eps_abs ** 2 * n)
+        m3_ = _zero_fperr(m3, eps_abs ** 3 * n)
+        skew = np.where(m2_ == 0, 0, n * (n - 1) ** 0.5 / (n - 2) * m3_ / m2_ ** 1.5)
+
+        m4_ = _zero_fperr(m4, eps_abs ** 4 * n)
+        numerator = n * (n + 1) * (n - 1) * m4_
+        denominator = (n - 2) * (n - 3) * m2_ ** 2
+        kurt = np.where(denominator == 0, 0, numerator / denominator - 3 * (n - 1) ** 2 / ((n - 2) * (n - 3)))
+
+    std = np.where(n < 2, np.nan, std)
+    skew = np.where(n < 3, np.nan, skew)
+    kurt = np.where(n < 4, np.nan, kurt)
+
+    return {'kurtosis': kurt, 'max': max_, 'mean': mean, 'min': min_, 'skewness': skew, 'std': std}
+
+
+def _sorted_position(track, time, q_track, q_time):
+    # number of (track, time) pairs lower than every (q_track, q_time) query, pairs sorted by track then time
+    keys = np.concatenate([track, q_track]), np.concatenate([time, q_time])
+    # queries sort before equal segments, so that segments starting at the query time are not counted
+    kind = np.concatenate([np.ones(len(track), dtype=np.int8), np.zeros(len(q_track), dtype=np.int8)])
+    order = np.lexsort((kind, keys[1], keys[0]))
+    is_seg = np.zeros(len(order), dtype=np.int64)
+    is_seg[1:] = np.cumsum(kind[order] == 1)[:-1]
+    pos = np.empty(len(q_track), dtype=np.int64)
+    q_at = order >= len(track)
+    pos[order[q_at] - len(track)] = is_seg[q_at]
+
+    return pos
+
+
+def top_sections(tracks_sec, top=TOP_SECTIONS):
+    '''
+    Longest sections of every track, in time order.
+
+    tracks_sec : list of track sections dataframes with columns 'start', 'duration', 'loudness' and 'key'
+    top : Default TOP_SECTIONS. Number of sections to keep per track
+    return : Dict of arrays of the kept sections - 'track' (position of the track), 'start', 'duration',
+             'loudness', 'key' and 'count' (number of sections kept per track)
+    '''
+    counts = np.array([len(sec) for sec in tracks_sec], dtype=np.int64)
+    track = np.repeat(np.arange(len(tracks_sec)), counts)
+    cols = {c: np.concatenate([sec[c].to_numpy(dtype=np.float64) for sec in tracks_sec]) if len(tracks_sec)
+            else np.empty(0) for c in ('start', 'duration', 'loudness', 'key')}
+    position = np.arange(len(track)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # longest first, ties in time order
+    order = np.lexsort((position, -cols['duration'], track))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - (np.cumsum(counts) - counts)[track[order]]
+    keep = rank < top
+
+    kept = {c: v[keep] for c, v in cols.items()}
+    kept['track'] = track[keep]
+    kept['count'] = np.minimum(counts, top)
+
+    return kept
+
+
+@ins.instrument()
+def segsec_stat_arrays(tracks_seg, tracks_sec, top=TOP_SECTIONS):
+    '''
+    Segment and section statistics of all tracks computed together.
+
+    Segments are assigned to the top sections with a sorted search on start times, section means of timbre
+    come from cumulative sums and segment statistics from group_moments.
+    Top sections without segments get the mean of the track's other top sections. Tracks with fewer than
+    'top' sections get rows of the average section inserted in the middle (key and loudness of the
+    section following them), as in get_segsec_stats.
+
+    tracks_seg : list of track segments dataframes with 'start' and timbre columns (see timbre_values)
+    tracks_sec : list of track sections dataframes with columns 'start', 'duration', 'loudness' and 'key'
+    top : Default TOP_SECTIONS. Number of sections kept per track
+    return : seg_stat - Dict of segment statistics, see group_moments,
+             sec_stat - Dict of arrays (number of tracks, top, ...) - 'key' (one hot, 12), 'loudness' (1),
+                        'timbre' (12)
+    '''
+    if len(tracks_seg) != len(tracks_sec):
+        raise ValueError('Number of segments and sections dataframes differ')
+
+    n_tracks = len(tracks_seg)
+    seg_counts = np.array([len(seg) for seg in tracks_seg], dtype=np.int64)
+    if (seg_counts == 0).any():
+        raise ValueError('Tracks without segments')
+
+    seg_track = np.repeat(np.arange(n_tracks), seg_counts)
+    seg_start = np.concatenate([seg['start'].to_numpy(dtype=np.float64) for seg in tracks_seg])
+    timbre = np.concatenate([timbre_values(seg) for seg in tracks_seg])
+
+    # segments in time order within tracks
+    order = np.lexsort((seg_start, seg_track))
+    seg_start, timbre = seg_start[order], timbre[order]
+    offsets = np.concatenate([[0], np.cumsum(seg_counts)])
+
+    seg_stat = group_moments(timbre, offsets)
+
+    sec = top_sections(tracks_sec, top)
+    lo = _sorted_position(seg_track, seg_start, sec['track'], sec['start'])
+    hi = _sorted_position(seg_track, seg_start, sec['track'], sec['start'] + sec['duration'])
+
+    cum = np.zeros((len(timbre) + 1, 12))
+    np.cumsum(timbre, axis=0, out=cum[1:])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sec_timbre = (cum[hi] - cum[lo]) / (hi - lo)[:, None]
+
+    # sections without segments get the mean of the other top sections of the track
+    empty = hi == lo
+    valid = np.bincount(sec['track'][~empty], minlength=n_tracks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fill = np.stack([np.bincount(sec['track'][~empty], weights=sec_timbre[~empty, j], minlength=n_tracks)
+                         for j in range(12)], axis=1) / valid[:, None]
+    sec_timbre[empty] = fill[sec['track'][empty]]
+
+    # per track slots - kept sections at the start and end, average sections in the middle
+    count = sec['count']
+    if (count == 0).any():
+        raise ValueError('Tracks without sections')
+    first = np.cumsum(count) - count
+    half = count // 2
+    slot = np.arange(top)[None, :]
+    in_fill = (slot >= half[:, None]) & (slot < (half + top - count)[:, None])
+    src = np.where(slot < half[:, None], slot, np.where(in_fill, half[:, None], slot - (top - count)[:, None]))
+    src = first[:, None] + src
+
+    avg = np.stack([np.bincount(sec['track'], weights=sec_timbre[:, j], minlength=n_tracks)
+                    for j in range(12)], axis=1) / count[:, None]
+
+    sec_stat = {'key': _KEYS_ONEHOT[sec['key'].astype(np.int64)][src],
+                'loudness': sec['loudness'][src][..., None],
+                'timbre': np.where(in_fill[..., None], avg[:, None, :], sec_timbre[src])}
 
     return seg_stat, sec_stat
 
-def encode_label(data_labels):
+
+def segsec_stat_tables(tracks_seg, tracks_sec, track_names=None, playlist=None, top=TOP_SECTIONS, compact=False,
+                       track_ids=None):
+    '''
+    Flattened segment and section statistics tables (one row per track), as stored in
+    user_pl_featstats/user_pl_segstat and user_pl_secstat.
+
+    tracks_seg : list of track segments dataframes with 'start' and timbre columns (see timbre_values)
+    tracks_sec : list of track sections dataframes with columns 'start', 'duration', 'loudness' and 'key'
+    track_names : Default None. List of track names, inserted as 'track_name' column
+    playlist : Default None. Playlist name or list of playlist names per track, inserted as 'playlist' column
+    top : Default TOP_SECTIONS. Number of sections kept per track
+    compact : Default False. True - statistics as float32, see CompactDtypes
+    track_ids : Default None. List of Spotify track ids, inserted as 'track_id' column after 'track_name'
+    return : segstat and secstat dataframes
+    '''
+    seg_stat, sec_stat = segsec_stat_arrays(tracks_seg, tracks_sec, top)
+    timbre_cols = ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+
+    seg_cols = ['{}_{}'.format(c, stat) for stat in SEG_STATS for c in timbre_cols]
+    seg_df = pd.DataFrame(np.hstack([seg_stat[stat] for stat in SEG_STATS]), columns=seg_cols)
+
+    sec_values = np.concatenate([sec_stat['key'], sec_stat['loudness'], sec_stat['timbre']], axis=2)
+    sec_names = ['key_{:0>2d}'.format(i + 1) for i in range(12)] + ['loudness'] + timbre_cols
+    sec_cols = ['{}_topsec{}'.format(c, j) for j in range(top) for c in sec_names]
+    sec_df = pd.DataFrame(sec_values.reshape(len(sec_values), -1), columns=sec_cols)
+
+    if compact:
+        seg_df, sec_df = cd.compact_frame(seg_df), cd.compact_frame(sec_df)
+
+    for df in (seg_df, sec_df):
+        if track_ids is not None:
+            df.insert(loc=0, column='track_id', value=pd.array(list(track_ids), dtype='string'))
+        if track_names is not None:
+            df.insert(loc=0, column='track_name', value=list(track_names))
+        if playlist is not None:
+            df.insert(loc=0, column='playlist', value=playlist if isinstance(playlist, str) else list(playlist))
+
+    return seg_df, sec_df
+
+
+@ins.instrument(rows=len)
+def get_segsec_stats(tracks_seg, tracks_sec, compact=False):
+    '''
+    Statistics of segments and top sections of tracks, see segsec_stat_arrays.
+
+    tracks_seg : list of track segments dataframes with 'start' and timbre columns - timbre_01 to timbre_12
+    tracks_sec : list of track sections dataframes with columns 'start', 'duration', 'loudness' and 'key'
+    compact : Default False. True - statistics as float32, see CompactDtypes
+
+    returns : seg_stat - list of dataframes (rows - min, max, mean, std, skewness, kurtosis; columns - timbre)
+              sec_stat - list of dataframes (rows - top 5 sections in time order;
+                         columns - loudness, key_01 to key_12, timbre_01 to timbre_12)
+    '''
+    seg_stat, sec_stat = segsec_stat_arrays(tracks_seg, tracks_sec)
+
+    timbre_cols = ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+    keys_column = ['key_{:0>2d}'.format(i + 1) for i in range(12)]
+    stats = ['min', 'max', 'mean', 'std', 'skewness', 'kurtosis']
+    index = ['topsec{}'.format(j) for j in range(TOP_SECTIONS)]
+
+    seg_dfs = [pd.DataFrame(np.stack([seg_stat[stat][t] for stat in stats]), index=stats, columns=timbre_cols)
+               for t in range(len(tracks_seg))]
+    sec_dfs = [pd.DataFrame(np.hstack([sec_stat['loudness'][t], sec_stat['key'][t], sec_stat['timbre'][t]]),
+                            index=index, columns=['loudness'] + keys_column + timbre_cols)
+               for t in range(len(tracks_sec))]
+
+    if compact:
+        seg_dfs = [cd.compact_frame(df) for df in seg_dfs]
+        sec_dfs = [cd.compact_frame(df) for df in sec_dfs]
+
+    return seg_dfs, sec_dfs
+
+
+# Version of the statistics computation, bump it to regenerate all feature statistics
+STATS_VERSION = 1
+FEATSTATS_MANIFEST = 'featstats_manifest.json'
+
+
+def featstats_track_names(playlist_tracks):
+    '''
+    Track names of the feature statistics tables. Names repeated in the corpus get '_dup' appended
+    after their first occurrence (playlists and tracks in sorted order).
+
+    playlist_tracks : Dict - key : playlist name : value - list of track names
+    return : Dict - key : playlist name : value - list of table track names
+    '''
+    seen = set()
+    names = {}
+
+    for pl in sorted(playlist_tracks):
+
+        names[pl] = []
+        for track in playlist_tracks[pl]:
+            names[pl].append(track + '_dup' if track in seen else track)
+            seen.add(track)
+
+    return names
+
+
+def write_parquet_atomic(df, path):
+    '''
+    Write a dataframe to parquet through a temporary file, so that readers never see a partial file.
+    '''
+    tmp = path.with_name(path.name + '.tmp')
+    df.to_parquet(tmp, engine='pyarrow')
+    os.replace(tmp, path)
+
+
+def track_file(stem, frame):
+    '''
+    Path of a dataframe file of a track, stem being the track folder joined with the name the track is stored under.
+    '''
+    return stem.with_name('{}_{}.parquet'.format(stem.name, frame))
+
+
+def segsec_tracks(folder):
+    '''
+    Names of the tracks in a folder with both segments and sections files.
+    '''
+    segs = {t.name[:-len('_segments.parquet')] for t in folder.glob('*_segments.parquet')}
+    secs = {t.name[:-len('_sections.parquet')] for t in folder.glob('*_sections.parquet')}
+
+    return segs & secs
+
+
+def playlist_featstats(args):
+    '''
+    Compute and write segstat and secstat tables of one playlist.
+    Takes a single tuple so it can be mapped over a process pool.
+
+    args : (name of the playlist, list of track file stems (see track_file), list of table track names,
+            path to segstat file, path to secstat file, list of track ids or None)
+    return : name of the playlist
+    '''
+    pl_name, stems, names, seg_file, sec_file, track_ids = args
+
+    tracks_seg = [pd.read_parquet(track_file(t, 'segments'), columns=['start', 'timbre']) for t in stems]
+    tracks_sec = [pd.read_parquet(track_file(t, 'sections'), columns=['start', 'duration', 'loudness', 'key'])
+                  for t in stems]
+
+    seg_df, sec_df = segsec_stat_tables(tracks_seg, tracks_sec, track_names=names, playlist=pl_name,
+                                        track_ids=track_ids)
+    write_parquet_atomic(seg_df, seg_file)
+    write_parquet_atomic(sec_df, sec_file)
+
+    return pl_name
+
+
+@ins.instrument(rows=len)
+def create_featstats(path_, out_path, workers=None, force=False):
+    '''
+    Create the feature statistics dataset (user_pl_featstats) from a dataset of playlist folders:
+        out_path/user_pl_segstat/<playlist>_segstat.parquet
+        out_path/user_pl_secstat/<playlist>_secstat.parquet
+        out_path/enc_categories.csv
+
+    Playlists are processed in a pool of processes. A playlist is skipped if its segments and sections
+    files (names, sizes, modification times), its table track names and ids and STATS_VERSION are unchanged
+    since the last run, as recorded in out_path/featstats_manifest.json. Tables of recorded playlists
+    that are no longer in the dataset (or have no tracks left) are deleted.
+
+    If the dataset has a track metadata table (DatasetStore, tracks table), its files are named by track id.
+    The tables then get a 'track_id' column, so they are joined to other tables by id, and take their
+    track names from the display names of the metadata table. A deduplicated dataset (create_index_dataset in
+    SpotipyCollect) is read through its membership table, which also gives the track ids.
+
+    path_ : path to dataset directory (e.g. Dataset1.2/user_playlists)
+    out_path : path to feature statistics directory (e.g. Dataset1.2/user_pl_featstats)
+    workers : Default None - number of CPUs. Number of processes, 1 to process playlists in this process
+    force : Default False. True - recompute all playlists
+    return : list of names of the playlists (re)computed
+    '''
+    seg_path = out_path.joinpath('user_pl_segstat')
+    sec_path = out_path.joinpath('user_pl_secstat')
+    seg_path.mkdir(parents=True, exist_ok=True)
+    sec_path.mkdir(parents=True, exist_ok=True)
+
+    # tracks with both segments and sections files - key : playlist : value - list of
+    # (track name, file stem, track id) tuples, a playlist of a deduplicated dataset may repeat a name
+    stems = {}
+    # True if track ids are known, tables get a track_id column
+    with_ids = False
+
+    if ds.is_deduplicated(path_):
+        membership = ds.read_membership(path_)
+        tracks_path = path_.joinpath(ds.TRACKS_DIR)
+        stored = segsec_tracks(tracks_path)
+
+        for pl, rows in membership.groupby('playlist', sort=False):
+            stems[pl] = [(t, tracks_path.joinpath(i), i) for t, i in zip(rows['track'], rows['track_id'])
+                         if i in stored]
+        with_ids = True
+    elif path_.joinpath(ds.TRACKS_TABLE).exists():
+        # files are named by track id, key : (playlist, track id) : value - display name
+        tracks_table = ds.read_tracks(path_)
+        display = dict(zip(zip(tracks_table['playlist'], tracks_table.index), tracks_table['track']))
+        with_ids = True
+
+        for pl in ds.playlist_folders(path_):
+            stems[pl.name] = [(display.get((pl.name, i), i), pl.joinpath(i), i) for i in segsec_tracks(pl)]
+    else:
+        for pl in ds.playlist_folders(path_):
+            stems[pl.name] = [(t, pl.joinpath(t), None) for t in segsec_tracks(pl)]
+
+    # case insensitive order, as the committed tables were listed (e.g. on NTFS)
+    playlist_tracks = {pl: sorted(tracks, key=lambda t: (t[0].upper(), t[0])) for pl, tracks in stems.items()}
+    names = featstats_track_names({pl: [t[0] for t in tracks] for pl, tracks in playlist_tracks.items()})
+
+    manifest_file = out_path.joinpath(FEATSTATS_MANIFEST)
+    recorded = {}
+    if manifest_file.exists():
+        with open(manifest_file, encoding='utf-8') as f:
+            recorded = json.load(f)
+    manifest = {} if force else recorded
+
+    tasks = []
+    signatures = {}
+    for pl, tracks in sorted(playlist_tracks.items()):
+
+        if not tracks:
+            continue
+
+        track_ids = [t[2] for t in tracks] if with_ids else None
+        # track ids only enter signatures of datasets with a tracks table, earlier manifests stay valid
+        sig_tables = [STATS_VERSION, names[pl]] if track_ids is None else [STATS_VERSION, names[pl], track_ids]
+
+        sig = hashlib.sha1()
+        sig.update(json.dumps(sig_tables).encode('utf-8'))
+        for t, stem, _ in tracks:
+            for frame in ('segments', 'sections'):
+                st = track_file(stem, frame).stat()
+                sig.update('{}|{}|{}|{};'.format(t, frame, st.st_size, st.st_mtime_ns).encode('utf-8'))
+        signatures[pl] = sig.hexdigest()
+
+        seg_file = seg_path.joinpath('{}_segstat.parquet'.format(pl))
+        sec_file = sec_path.joinpath('{}_secstat.parquet'.format(pl))
+
+        if manifest.get(pl) == signatures[pl] and seg_file.exists() and sec_file.exists():
+            continue
+
+        tasks.append((pl, [t[1] for t in tracks], names[pl], seg_file, sec_file, track_ids))
+
+    if workers == 1:
+        done = [playlist_featstats(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            done = list(executor.map(playlist_featstats, tasks))
+
+    # tables of playlists recorded by an earlier run that are no longer in the dataset
+    for pl in set(recorded) - set(signatures):
+        seg_path.joinpath('{}_segstat.parquet'.format(pl)).unlink(missing_ok=True)
+        sec_path.joinpath('{}_secstat.parquet'.format(pl)).unlink(missing_ok=True)
+
+    categories = sorted(signatures)
+    np.savetxt(out_path.joinpath('enc_categories.csv'), categories, fmt='%s', delimiter=',')
+
+    tmp = manifest_file.with_name(manifest_file.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(signatures, f, indent=1)
+    os.replace(tmp, manifest_file)
+
+    return done
+
+
+def encode_label(data_labels, compact=False):
+    '''
+    One hot encode labels.
+
+    data_labels : list of labels
+    compact : Default False. True - integer codes instead of one hot arrays, see label_codes in CompactDtypes
+    return : encoded labels (one hot float64 array or integer codes), list of the array of categories
+    '''
+    if compact:
+        codes, categories = cd.label_codes(data_labels)
+        return codes, [categories]
 
     X = np.array(data_labels).reshape(-1, 1)
     data_encode = OneHotEncoder().fit(X)
@@ -267,3 +1331,111 @@ def encode_label(data_labels):
     data_encoded = data_encode.transform(X).toarray()
 
     return data_encoded, categories
+
+
+# --------------------------------------------------------------------------------
+#  Functions for storing model inputs as memory-mapped arrays
+# --------------------------------------------------------------------------------
+
+TRACK_ARRAYS_INDEX = 'index.json'
+
+
+def save_track_arrays(path_, inputs, labels, track_names=None, categories=None):
+    '''
+    Save model inputs and labels of all tracks as .npy files that can be memory-mapped:
+        path_/inputs.npy, path_/labels.npy, path_/index.json (track names, label categories, shapes)
+
+    path_ : pathlib.Path - directory of the store, created if it does not exist
+    inputs : array (number of tracks, input length) or list of track input arrays,
+             e.g. output of transform_dataset
+    labels : array or list of track labels, e.g. output of encode_label
+    track_names : Default None. List of track names in the order of inputs
+    categories : Default None. List of label categories, e.g. categories returned by encode_label
+    '''
+    inputs = np.asarray(inputs)
+    labels = np.asarray(labels)
+
+    if len(inputs) != len(labels):
+        raise ValueError('Number of inputs ({}) and labels ({}) differ'.format(len(inputs), len(labels)))
+
+    path_.mkdir(parents=True, exist_ok=True)
+
+    for name, arr in (('inputs', inputs), ('labels', labels)):
+
+        tmp = path_.joinpath(name + '.tmp.npy')
+        np.save(tmp, arr)
+        os.replace(tmp, path_.joinpath(name + '.npy'))
+
+    index = {'tracks': len(inputs),
+             'inputs': {'shape': list(inputs.shape), 'dtype': str(inputs.dtype)},
+             'labels': {'shape': list(labels.shape), 'dtype': str(labels.dtype)},
+             'track_names': None if track_names is None else list(track_names),
+             'categories': None if categories is None else [str(c) for c in np.ravel(categories)]}
+
+    tmp = path_.joinpath(TRACK_ARRAYS_INDEX + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, path_.joinpath(TRACK_ARRAYS_INDEX))
+
+
+def load_track_arrays(path_, mmap=True):
+    '''
+    Open a store saved by save_track_arrays.
+
+    path_ : pathlib.Path - directory of the store
+    mmap : Default True - arrays are read-only memory-mapped views, nothing is read until used.
+           False - arrays are read into memory.
+    return : inputs, labels, track names (or None), label categories (or None)
+    '''
+    with open(path_.joinpath(TRACK_ARRAYS_INDEX), encoding='utf-8') as f:
+        index = json.load(f)
+
+    mode = 'r' if mmap else None
+    inputs = np.load(path_.joinpath('inputs.npy'), mmap_mode=mode)
+    labels = np.load(path_.joinpath('labels.npy'), mmap_mode=mode)
+
+    return inputs, labels, index['track_names'], index['categories']
+
+
+def read_text(path_):
+    '''
+    Read a text file written with utf-8, or with the Windows default encoding (cp1252) by np.savetxt.
+    '''
+    data = path_.read_bytes()
+
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('cp1252')
+
+
+def read_track_csv(path_):
+    '''
+    Read a track input or label csv file (one value per line) as a float array.
+    '''
+    with open(path_) as f:
+        return np.array(f.read().split(), dtype=np.float64)
+
+
+def convert_track_csv(csv_path, out_path, dtype=np.float32):
+    '''
+    Convert the per-track csv files of model inputs and labels into a store of memory-mapped arrays
+    (see save_track_arrays).
+
+    csv_path : pathlib.Path - directory with track_arrays/track_inp_N.csv, track_labels/track_lab_N.csv,
+               track_names.csv and label_categories.csv (e.g. Dataset1.2/usertracks_csv)
+    out_path : pathlib.Path - directory of the store
+    dtype : Default numpy.float32. dtype of the stored inputs
+    '''
+    track_names = read_text(csv_path.joinpath('track_names.csv')).splitlines()
+
+    categories = None
+    if csv_path.joinpath('label_categories.csv').exists():
+        categories = read_text(csv_path.joinpath('label_categories.csv')).strip().split(',')
+
+    inputs = np.stack([read_track_csv(csv_path.joinpath('track_arrays', 'track_inp_{}.csv'.format(i)))
+                       for i in range(len(track_names))]).astype(dtype)
+    labels = np.stack([read_track_csv(csv_path.joinpath('track_labels', 'track_lab_{}.csv'.format(i)))
+                       for i in range(len(track_names))])
+
+    save_track_arrays(out_path, inputs, labels, track_names=track_names, categories=categories)
@@ -0,0 +1,248 @@
+'''
+ Rate-limit aware scheduling of Spotify Web API requests.
+
+ Function/Class definitions : RequestScheduler, ScheduledSpotify, retry_after, disable_retries
+
+Hierachy:
+- ScheduledSpotify > arg(spotipy object, RequestScheduler) > disable_retries
+  - every endpoint call > RequestScheduler.call > token bucket, retry_after
+
+Spotipy retries 429 and 5xx responses itself by default (urllib3 Retry mounted on its requests
+session) and sleeps inside the request. Setting status_retries=0 is not enough: urllib3 then turns
+the first retryable response into a RetryError, which spotipy reports as a 429 without headers.
+ScheduledSpotify therefore mounts an adapter that never retries (disable_retries), so every error
+reaches the scheduler with its real status and Retry-After header, and throttling pauses all threads
+sharing the scheduler instead of just the one that was throttled.
+'''
+import functools
+import random
+import requests
+import spotipy
+import threading
+import time
+from urllib3.util.retry import Retry
+
+# HTTP status codes worth retrying - too many requests and transient server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def retry_after(error):
+    '''
+    Read the Retry-After header (in seconds) of a throttled response.
+
+    Parameters
+    ----------
+    error : spotipy.SpotifyException
+
+    Returns
+    -------
+    secs : float or None
+        seconds to wait before retrying, None if the header is missing or malformed
+    '''
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('Retry-After', headers.get('retry-after'))
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def disable_retries(spotipyUserAuth):
+    '''
+    Mount an adapter that never retries on the requests session of a spotipy object.
+
+    HTTP errors are then raised by spotipy as SpotifyException with the status and headers
+    of the response, and connection errors as requests ConnectionError.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+
+    Returns
+    -------
+    spotipyUserAuth : the same spotipy object
+    '''
+    session = getattr(spotipyUserAuth, '_session', None)
+
+    if isinstance(session, requests.Session):
+        adapter = requests.adapters.HTTPAdapter(max_retries=Retry(total=0, read=False, status_forcelist=[]))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    return spotipyUserAuth
+
+
+class RequestScheduler:
+    '''
+    Central scheduler for API requests.
+
+    Requests are admitted by a token bucket refilled at 'rate' requests per second,
+    holding up to 'burst' tokens. Throttled (HTTP 429) requests honour Retry-After and
+    pause every thread using the scheduler, other retryable failures back off exponentially
+    with full jitter.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Default 10. Sustained number of requests per second.
+    burst : int, optional
+        Default None - same as rate. Maximum number of requests admitted at once.
+    max_retries : int, optional
+        Default 5. Number of retries before a request is counted as failed and the error raised.
+    backoff : float, optional
+        Default 1. Base of exponential backoff in seconds.
+    max_backoff : float, optional
+        Default 60. Upper bound of a single backoff in seconds.
+    '''
+
+    def __init__(self, rate=10.0, burst=None, max_retries=5, backoff=1.0, max_backoff=60.0):
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self.counters = {'requests': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+
+    def _count(self, name):
+
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        '''
+        Returns
+        -------
+        counters : Dict
+            number of requests, throttled (429) responses, retries and failed requests
+        '''
+        with self._lock:
+            return dict(self.counters)
+
+    def pause(self, secs):
+        '''
+        Stop admitting requests for secs seconds.
+        '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + secs)
+
+    def acquire(self):
+        '''
+        Block until the token bucket admits one request.
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.counters['requests'] += 1
+                        return
+
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def backoff_delay(self, attempt):
+        '''
+        Jittered exponential backoff delay for a retry attempt (starting at 0).
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call an API function through the scheduler.
+
+        Parameters
+        ----------
+        func : Callable
+            spotipy endpoint method, e.g. sp.audio_analysis
+        args, kwargs :
+            arguments to func
+
+        Returns
+        -------
+        response of func
+        '''
+        attempt = 0
+
+        while True:
+            self.acquire()
+
+            try:
+                return func(*args, **kwargs)
+
+            except spotipy.SpotifyException as e:
+                if e.http_status not in RETRY_STATUS or attempt >= self.max_retries:
+                    self._count('failed')
+                    raise
+
+                if e.http_status == 429:
+                    self._count('throttled')
+                    wait = retry_after(e)
+                    if wait is None:
+                        wait = self.backoff_delay(attempt)
+                    else:
+                        # small jitter so that paused threads do not all retry at the same instant
+                        wait += random.uniform(0, self.backoff)
+                    self.pause(wait)
+                else:
+                    time.sleep(self.backoff_delay(attempt))
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.max_retries:
+                    self._count('failed')
+                    raise
+
+                time.sleep(self.backoff_delay(attempt))
+
+            attempt += 1
+            self._count('retried')
+
+
+class ScheduledSpotify:
+    '''
+    Wraps a spotipy object so that every endpoint call goes through a RequestScheduler.
+
+    It can be passed to any function in SpotipyCollect and SpotipyCollectPub in place of
+    the spotipy object. Retries of the spotipy object itself are disabled (see disable_retries).
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' or 'spotipy_client_cred' function.
+    scheduler : RequestScheduler, optional
+        Default None - a new RequestScheduler with default settings.
+        Share one scheduler between objects using the same API quota.
+    '''
+
+    def __init__(self, spotipyUserAuth, scheduler=None):
+
+        self.spotipy = disable_retries(spotipyUserAuth)
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+
+    def __getattr__(self, name):
+
+        attr = getattr(self.spotipy, name)
+
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def scheduled(*args, **kwargs):
+            return self.scheduler.call(attr, *args, **kwargs)
+
+        return scheduled
@@ -0,0 +1,231 @@
+'''
+ Persistent on-disk cache of Spotify Web API responses.
+
+ Function/Class definitions : ResponseCache
+
+Responses are stored zlib-compressed in a SQLite database, keyed by endpoint and
+track id (e.g. ('audio_analysis', '4uLU6hMCjMI75M1A2tKUQC')). Least recently used entries are
+evicted once the cache grows over its size limit. See get_tracks_analysis and
+get_tracks_features in SpotipyCollect for usage.
+'''
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# Ids per SQL query, below the default limit of 999 bound variables of older SQLite versions
+QUERY_CHUNK = 500
+
+
+class ResponseCache:
+    '''
+    Size-bounded LRU cache of API responses stored in a SQLite file.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        path of the SQLite file. Created if it does not exist.
+    max_bytes : int, optional
+        Default 2 GB. Maximum total size of the compressed responses.
+        Least recently used responses are evicted beyond this.
+    ttl : float, optional
+        Default None - responses never expire. Age in seconds after which a response is refetched.
+    offline : bool, optional
+        Default False. True - never request the API, raise KeyError for responses missing in the cache.
+    '''
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, ttl=None, offline=False):
+
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'endpoint TEXT, id TEXT, data BLOB, size INTEGER, created REAL, accessed REAL, '
+            'PRIMARY KEY (endpoint, id))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def stats(self):
+        '''
+        Returns
+        -------
+        stats : Dict
+            hits, misses, hit rate, number of stored responses and their total size in bytes
+        '''
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            lookups = self.hits + self.misses
+
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': entries, 'bytes': self._size}
+
+    def get_many(self, endpoint, ids):
+        '''
+        Look up cached responses.
+
+        Parameters
+        ----------
+        endpoint : str
+            name of the endpoint, e.g. 'audio_analysis'
+        ids : List[str]
+            track ids
+
+        Returns
+        -------
+        responses : Dict
+            key - track id : value - response, for ids found in the cache (and not expired)
+        '''
+        found = {}
+        now = time.time()
+        unique = list(dict.fromkeys(ids))
+
+        with self._lock:
+            for i in range(0, len(unique), QUERY_CHUNK):
+
+                chunk = unique[i: i + QUERY_CHUNK]
+                rows = self._conn.execute(
+                    'SELECT id, data, created FROM responses WHERE endpoint = ? AND id IN ({})'.format(
+                        ', '.join('?' * len(chunk))), [endpoint] + chunk).fetchall()
+
+                for id_, data, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[id_] = json.loads(zlib.decompress(data))
+
+            self._conn.executemany('UPDATE responses SET accessed = ? WHERE endpoint = ? AND id = ?',
+                                   [(now, endpoint, id_) for id_ in found])
+            self._conn.commit()
+
+            self.hits += sum(1 for id_ in ids if id_ in found)
+            self.misses += sum(1 for id_ in ids if id_ not in found)
+
+        return found
+
+    def put_many(self, endpoint, responses):
+        '''
+        Store responses and evict least recently used responses if over max_bytes.
+
+        Parameters
+        ----------
+        endpoint : str
+            name of the endpoint, e.g. 'audio_analysis'
+        responses : Dict
+            key - track id : value - response (json serializable). None responses are not stored.
+        '''
+        now = time.time()
+
+        with self._lock:
+            for id_, response in responses.items():
+                if response is None:
+                    continue
+
+                data = zlib.compress(json.dumps(response, separators=(',', ':')).encode('utf-8'))
+                old = self._conn.execute('SELECT size FROM responses WHERE endpoint = ? AND id = ?',
+                                         (endpoint, id_)).fetchone()
+                if old is not None:
+                    self._size -= old[0]
+
+                self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                   (endpoint, id_, data, len(data), now, now))
+                self._size += len(data)
+
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+
+        while self._size > self.max_bytes:
+            rows = self._conn.execute(
+                'SELECT endpoint, id, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+
+            for endpoint, id_, size in rows:
+                self._conn.execute('DELETE FROM responses WHERE endpoint = ? AND id = ?', (endpoint, id_))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+    def lookup(self, endpoint, ids):
+        '''
+        Split ids into cached responses and ids to request.
+
+        Parameters
+        ----------
+        endpoint : str
+            name of the endpoint, e.g. 'audio_analysis'
+        ids : List[str]
+            track ids
+
+        Returns
+        -------
+        found : Dict
+            key - track id : value - response, for ids found in the cache (and not expired)
+        missing : List[str]
+            unique ids to request, in order
+
+        Raises
+        ------
+        KeyError
+            if responses are missing in offline mode
+        '''
+        found = self.get_many(endpoint, ids)
+        missing = list(dict.fromkeys(id_ for id_ in ids if id_ not in found))
+
+        if missing and self.offline:
+            raise KeyError('{} {} responses missing from cache in offline mode'.format(len(missing), endpoint))
+
+        return found, missing
+
+    def fetch(self, endpoint, ids, request):
+        '''
+        Get responses from the cache, requesting only the missing ones.
+
+        Parameters
+        ----------
+        endpoint : str
+            name of the endpoint, e.g. 'audio_analysis'
+        ids : List[str]
+            track ids
+        request : Callable
+            function taking a list of missing track ids and returning a list of responses
+            in the same order
+
+        Returns
+        -------
+        responses : List
+            responses in the order of ids
+        '''
+        ids = list(ids)
+        found, missing = self.lookup(endpoint, ids)
+
+        if missing:
+            fetched = dict(zip(missing, request(missing)))
+            self.put_many(endpoint, fetched)
+            found.update(fetched)
+
+        return [found[id_] for id_ in ids]
+
+    def clear(self):
+        '''
+        Remove all stored responses.
+        '''
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+            self._size = 0
+
+    def close(self):
+
+        with self._lock:
+            self._conn.close()
@@ -7,7 +7,14 @@
                         get_tracks_analysis, track_anlaysis_to_df,
                         convert_time, tracks_analysis, get_segments,
                         get_playlist_analysis, get_folder_analysis,
-                        create_dataset, uri_to_id
+                        create_dataset, uri_to_id, fetch_concurrent,
+                        clean_name, track_key, frame_names, load_manifest,
+                        save_manifest, track_stored, record_track, resolve_playlists, update_dataset, get_features_batched,
+                        convert_times, select_segments, segment_vectors,
+                        analysis_columns, track_analysis_to_arrays, stream_dataset,
+                        track_index, build_track_index, track_keys, tracks_table,
+                        index_tracks_table, get_index_analysis, create_index_dataset,
+                        get_index_features
 
 Hierachy:
 - spotipy_userauth
@@ -24,18 +31,45 @@ Hierachy:
 
 Using USER's playlist: get_pl_details >  playlist_id_url > arg(get_playlists,)
 
+Incremental build: update_dataset > get_tracks, load_manifest/save_manifest
+                                  > get_tracks_analysis, get_segments (only for missing tracks)
+                                  > record_track
+
+Deduplicated build: create_index_dataset > arg(get_index_analysis - analysis by track id)
+                                        > arg(build_track_index > get_tracks, track_index)
+
+Streaming build: stream_dataset > get_tracks > fetch threads (get_tracks_analysis)
+                                > get_segments > parquet writer, connected by bounded queues
+
 Reduntant - tracks_analysis, track_genre
 
 '''
+from cap_package import CompactDtypes as cd
+from cap_package import DatasetStore as ds
+from cap_package import Instrument as ins
+from cap_package import RequestScheduler as rs
+from concurrent.futures import ThreadPoolExecutor
 import demoji
+import json
+import numpy as np
+import os
 import pandas as pd
 from pandas import json_normalize
+import queue
 import re
 import spotipy
 import spotipy.util as util
+import threading
+from urllib.parse import urlparse
 
 demoji.download_codes()
 
+# Maximum number of requests in flight to a single API host, shared by all worker pools
+HOST_CONCURRENCY = 8
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
 
 def spotipy_userauth2(username, scope, client_id, client_secret, redirect_uri):
     '''
@@ -69,7 +103,7 @@ def spotipy_userauth2(username, scope, client_id, client_secret, redirect_uri):
     return sp
 
 
-def spotipy_userauth(username, scope, client_id, client_secret, redirect_uri):
+def spotipy_userauth(username, scope, client_id, client_secret, redirect_uri, scheduler=None):
     '''
     Implements Authorization Code Flow for Spotify’s OAuth implementation.
 
@@ -87,18 +121,28 @@ def spotipy_userauth(username, scope, client_id, client_secret, redirect_uri):
         client secret of the app
     redirect_uri : str
         redirect URI of the app
+    scheduler : RequestScheduler, optional
+        Default None. If provided, all requests are rate limited and retried by the scheduler.
+        See RequestScheduler module.
 
     Returns
     -------
     sp : spotipy object
         spotipy object with access to all Spotify Web API endpoints
+        (wrapped in ScheduledSpotify if scheduler is provided)
     '''
     username = username
-    spotify = spotipy.Spotify(
-        auth_manager=spotipy.SpotifyOAuth(
-            username=username, scope=scope, client_id=client_id,
-            client_secret=client_secret, redirect_uri=redirect_uri))
-    return spotify
+    auth_manager = spotipy.SpotifyOAuth(
+        username=username, scope=scope, client_id=client_id,
+        client_secret=client_secret, redirect_uri=redirect_uri)
+
+    spotify = spotipy.Spotify(auth_manager=auth_manager)
+
+    if scheduler is None:
+        return spotify
+
+    # retries move from spotipy to the scheduler, which sees 429 responses with their Retry-After
+    return rs.ScheduledSpotify(spotify, scheduler)
 
 
 def get_playlists(spotipyUserAuth, username):
@@ -269,7 +313,53 @@ def get_artist_name(tracks_df):
     return artists_list
 
 
-def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
+# Maximum number of tracks the playlist tracks endpoint returns in one request
+PLAYLIST_TRACKS_LIMIT = 100
+# Fields requested from the playlist tracks endpoint when only track name, id and artists are needed
+TRACK_FIELDS = 'total,items(track(name,id,artists(name)))'
+
+
+@ins.instrument(rows=len, bytes_=ins.json_bytes)
+def get_playlist_items(spotipyUserAuth, playlist_id, fields=None, workers=None):
+    '''
+    Fetch track objects of all tracks in a playlist.
+
+    The first page gives the total number of tracks, the remaining pages are then
+    requested together (concurrently if workers is provided).
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    playlist_id : str
+        Spotify playlist id
+    fields : str, optional
+        Default None - complete track objects. Fields to return, see Spotify Web API reference.
+        Must include 'total' and 'items(track(...))'.
+    workers : int, optional
+        Default None. Number of threads to request pages concurrently with.
+
+    Returns
+    -------
+    tracks_json : List[Dict]
+        track objects of the playlist (local/unavailable tracks without a track object are skipped)
+    '''
+    tracks = spotipyUserAuth.playlist_tracks(playlist_id, fields=fields, limit=PLAYLIST_TRACKS_LIMIT)
+
+    def request(offset):
+        return spotipyUserAuth.playlist_tracks(playlist_id, fields=fields, limit=PLAYLIST_TRACKS_LIMIT,
+                                               offset=offset)
+
+    offsets = range(PLAYLIST_TRACKS_LIMIT, tracks['total'], PLAYLIST_TRACKS_LIMIT)
+    pages = [tracks] + fetch_concurrent(spotipyUserAuth, request, offsets, workers=workers)
+
+    tracks_json = [item['track'] for page in pages for item in page['items'] if item['track']]
+
+    return tracks_json
+
+
+@ins.instrument(rows=len)
+def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False, workers=None):
     '''
     Extract track info of all tracks in a playlist.
 
@@ -285,7 +375,10 @@ def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
                         with all columns.
     showkeys : bool, optional
         True - Prints all column names/keys of the complete dataframe
+        (only name, id and artists are requested if allCol is False)
         Default False
+    workers : int, optional
+        Default None. Number of threads to request pages of tracks concurrently with.
 
     Returns
     -------
@@ -298,34 +391,9 @@ def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
     See https://developer.spotify.com/documentation/web-api/reference/playlists/get-playlists-tracks/ 
     for more information on returned track object columns/keys
     '''
-    track_lim = 100
-
-    tracks = spotipyUserAuth.playlist_tracks(playlist_id)
-
-    tracks_json = [
-        tracks['items'][j]['track']
-        for j in range(len(tracks['items']))
-        if tracks['items'][j]['track']]
-
-    tracks_df = json_normalize(tracks_json, sep='_')
-
-    if tracks['total'] > track_lim:
-        offset = track_lim
-        tracks_dflist = [tracks_df]
-
-        for i in range(int(tracks['total'] / track_lim)):
-
-            tracks = spotipyUserAuth.playlist_tracks(playlist_id, offset=(i + 1) * offset)
-
-            tracks_json = [
-                tracks['items'][j]['track']
-                for j in range(len(tracks['items']))
-                if tracks['items'][j]['track']]
-
-            tracks_df_ = json_normalize(tracks_json, sep='_')
-            tracks_dflist.append(tracks_df_)
-
-        tracks_df = pd.concat(tracks_dflist, ignore_index=True)
+    fields = None if allCol else TRACK_FIELDS
+    tracks_df = json_normalize(get_playlist_items(spotipyUserAuth, playlist_id, fields=fields, workers=workers),
+                               sep='_')
 
     artists_list = get_artist_name(tracks_df)
     tracks_df.insert(loc=0, column='artists_name', value=artists_list)
@@ -341,6 +409,82 @@ def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
     return df
 
 
+def track_index(folder_tracks):
+    '''
+    Index of the unique tracks of several playlists.
+
+    Tracks are identified by id, the track column is a display name only (track_key of the
+    track name and artists' names) and different tracks may share it.
+
+    Parameters
+    ----------
+    folder_tracks : List[tuple]
+        (playlist name, tracks dataframe returned by get_tracks) tuples
+
+    Returns
+    -------
+    tracks_df : pandas.DataFrame
+        one row per unique track id, in order of first appearance
+        Columns : id, name, artists_name, track (display name, see track_key)
+    membership : pandas.DataFrame
+        one row per track of every playlist, in playlist order
+        Columns : playlist, position (of the track in the playlist), track_id, track
+    '''
+    frames = [df[['id', 'name', 'artists_name']].assign(playlist=name, position=np.arange(len(df)))
+              for name, df in folder_tracks]
+
+    if not frames:
+        return (pd.DataFrame(columns=['id', 'name', 'artists_name', 'track']),
+                pd.DataFrame(columns=['playlist', 'position', 'track_id', 'track']))
+
+    all_tracks = pd.concat(frames, ignore_index=True)
+    all_tracks['track'] = track_keys(all_tracks)
+
+    tracks_df = all_tracks.drop_duplicates(subset='id')[['id', 'name', 'artists_name', 'track']].reset_index(drop=True)
+    membership = all_tracks[['playlist', 'position', 'id', 'track']].rename(columns={'id': 'track_id'})
+
+    return tracks_df, membership
+
+
+def index_tracks_table(tracks_df, membership):
+    '''
+    Track metadata table (DatasetStore.write_tracks) of an index returned by track_index,
+    stored by create_index_dataset.
+    '''
+    table = membership[['track_id', 'playlist', 'track']].merge(
+        tracks_df[['id', 'name', 'artists_name']], left_on='track_id', right_on='id', how='left')
+
+    return table[ds.TRACKS_COLUMNS]
+
+
+def build_track_index(spotipyUserAuth, filsort_pl=None, pl_name_id=None, workers=None):
+    '''
+    Lists the tracks of all playlists and indexes them by track id before anything else is fetched,
+    so that a track found in several playlists is fetched and stored once.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    filsort_pl : List[tuple], optional
+        Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : List[tuple], optional
+        Dafault None. In the case filsort_pl is not available,
+        provide a list of playlist name and id tuples
+    workers : int, optional
+        Default None. Number of threads to request pages of tracks concurrently with.
+
+    Returns
+    -------
+    tracks_df, membership : pandas.DataFrame
+        see track_index. Playlist names are cleaned as in get_folder_analysis.
+    '''
+    playlists = resolve_playlists(filsort_pl, pl_name_id)
+
+    return track_index([(name, get_tracks(spotipyUserAuth, playlist_id, workers=workers))
+                        for name, playlist_id in playlists])
+
+
 def track_genre(spotipyUserAuth, album_ids):
     '''
     Get track genre info from parent album genre
@@ -393,12 +537,81 @@ def track_genre(spotipyUserAuth, album_ids):
 
     return album_genre
 
+# --------------------------------------------------------------------------------
+#  Functions for issuing requests concurrently
+# --------------------------------------------------------------------------------
+
+
+def host_semaphore(spotipyUserAuth):
+    '''
+    Get the semaphore limiting concurrent requests to the API host of a spotipy object.
+
+    The semaphore is shared between all worker pools talking to the same host,
+    so that several concurrent collections do not exceed HOST_CONCURRENCY together.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function, or any object with the same endpoints.
+
+    Returns
+    -------
+    semaphore : threading.BoundedSemaphore
+    '''
+    host = urlparse(getattr(spotipyUserAuth, 'prefix', '') or '').netloc or 'default'
+
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+
+        return _host_semaphores[host]
+
+
+def fetch_concurrent(spotipyUserAuth, request, items, workers=None):
+    '''
+    Applies a request function to every item, optionally with a bounded pool of threads.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function. Used to look up the per-host request limit.
+    request : Callable
+        function taking a single item and returning the API response for it.
+    items : List
+        items (e.g. track ids) to be requested.
+    workers : int, optional
+        Default None - requests are made one after another.
+        Number of threads to issue requests with.
+
+    Returns
+    -------
+    responses : List
+        responses in the same order as items.
+    '''
+    items = list(items)
+
+    if not workers or workers <= 1 or len(items) <= 1:
+        return [request(item) for item in items]
+
+    semaphore = host_semaphore(spotipyUserAuth)
+
+    def limited_request(item):
+        with semaphore:
+            return request(item)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        # map yields results in the order of items, whichever request finishes first
+        responses = list(executor.map(limited_request, items))
+
+    return responses
+
 # --------------------------------------------------------------------------------
 #  Functions for retrieving track analysis of the dataset
 # --------------------------------------------------------------------------------
 
 
-def get_tracks_analysis(spotipyUserAuth, tracksid, showkeys=False):
+@ins.instrument(rows=len, bytes_=ins.json_bytes)
+def get_tracks_analysis(spotipyUserAuth, tracksid, showkeys=False, workers=None, cache=None):
     '''
     Fetches track analysis of tracks
 
@@ -410,14 +623,24 @@ def get_tracks_analysis(spotipyUserAuth, tracksid, showkeys=False):
         list of track ids.
     showkeys : bool, optional
         Default False. True - prints dictionary keys
+    workers : int, optional
+        Default None. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. If provided, track analysis is read from the cache and only
+        missing tracks are requested.
 
     Returns
     -------
     tracks_analysis : List[Dict]
-        list of dictionaries containing track analysis
+        list of dictionaries containing track analysis, in the order of track ids
     '''
-    tracks_analysis = [spotipyUserAuth.audio_analysis(tracksid[j])
-                       for j in range(len(tracksid))]
+    def request(ids):
+        return fetch_concurrent(spotipyUserAuth, spotipyUserAuth.audio_analysis, ids, workers=workers)
+
+    if cache is None:
+        tracks_analysis = request(tracksid)
+    else:
+        tracks_analysis = cache.fetch('audio_analysis', tracksid, request)
 
     if showkeys is True:
         print(tracks_analysis[0].keys())
@@ -457,7 +680,73 @@ def tracks_analysis(spotipyUserAuth, playlist_id):
     return analysis_dict
 
 
-def track_anlaysis_to_df(trackid=None, spotipyUserAuth=None, track_analysis=None):
+# Keys of track analysis items holding vectors of 12 values
+VECTOR_KEYS = ('pitches', 'timbre')
+
+
+def analysis_columns(records, vector_dtype=np.float32):
+    '''
+    Decode a list of track analysis items (beats, bars, segments or sections) into columns.
+
+    Parameters
+    ----------
+    records : List[Dict]
+        items of one kind from a track analysis, e.g. track_analysis['segments']
+    vector_dtype : numpy.dtype or None, optional
+        Default numpy.float32. dtype of the (n, 12) arrays pitches and timbre are decoded into.
+        None - pitches and timbre are kept as lists of the original lists.
+
+    Returns
+    -------
+    columns : Dict
+        key - item key (str) : value - numpy.ndarray of values, NaN where an item lacks the key.
+        Keys are in the order they first appear, like json_normalize.
+    '''
+    keys = list(dict.fromkeys(k for r in records for k in r))
+    columns = {}
+
+    for k in keys:
+
+        if k in VECTOR_KEYS:
+            if vector_dtype is None:
+                columns[k] = [r[k] for r in records]
+            else:
+                columns[k] = np.array([r[k] for r in records], dtype=vector_dtype).reshape(-1, 12)
+        else:
+            columns[k] = np.array([r.get(k, np.nan) for r in records])
+
+    return columns
+
+
+def track_analysis_to_arrays(track_analysis, frames=('beats', 'bars', 'segments', 'sections'),
+                             vector_dtype=np.float32):
+    '''
+    Convert a track analysis dictionary into columns of typed numpy arrays.
+
+    Parameters
+    ----------
+    track_analysis : Dict
+        track analysis dictionary of a single track
+    frames : tuple(str), optional
+        Default all of beats, bars, segments and sections. Items of the analysis to convert.
+    vector_dtype : numpy.dtype or None, optional
+        Default numpy.float32. See analysis_columns.
+
+    Returns
+    -------
+    trackoverview : Dict
+        track info.
+    arrays : Dict
+        key - frame name (str) : value - columns returned by analysis_columns
+    '''
+    trackoverview = track_analysis['track']
+    arrays = {f: analysis_columns(track_analysis[f], vector_dtype=vector_dtype) for f in frames}
+
+    return trackoverview, arrays
+
+
+@ins.instrument(rows=ins.frame_rows)
+def track_anlaysis_to_df(trackid=None, spotipyUserAuth=None, track_analysis=None, columnar=False):
     '''
     Convert track analysis dictionaries into dateframes -
     beats, bars, segments and sections.
@@ -470,6 +759,9 @@ def track_anlaysis_to_df(trackid=None, spotipyUserAuth=None, track_analysis=None
         Spotify track id
     track_analysis : Dict, optional
         Default - None. Or track analysis dictionary of a single track if trackid is not provided
+    columnar : bool, optional
+        Default False. True - return columns of numpy arrays (see analysis_columns) instead of
+        dataframes, with pitches and timbre as float32 arrays of shape (n, 12)
 
     Either need to provide track ids or track analysis for a single track
 
@@ -493,13 +785,16 @@ def track_anlaysis_to_df(trackid=None, spotipyUserAuth=None, track_analysis=None
 
         track_analysis = get_tracks_analysis(spotipyUserAuth, [trackid])[0]
 
-    trackoverview = track_analysis['track']
-
     # We don't need tatums currently
-    beats_df = json_normalize(track_analysis['beats'], sep='_')
-    bars_df = json_normalize(track_analysis['bars'], sep='_')
-    segments_df = json_normalize(track_analysis['segments'], sep='_')
-    sections_df = json_normalize(track_analysis['sections'], sep='_')
+    trackoverview, arrays = track_analysis_to_arrays(track_analysis, vector_dtype=np.float32 if columnar else None)
+
+    if columnar:
+        return trackoverview, arrays['beats'], arrays['bars'], arrays['segments'], arrays['sections']
+
+    beats_df = pd.DataFrame(arrays['beats'])
+    bars_df = pd.DataFrame(arrays['bars'])
+    segments_df = pd.DataFrame(arrays['segments'])
+    sections_df = pd.DataFrame(arrays['sections'])
 
     return trackoverview, beats_df, bars_df, segments_df, sections_df
 
@@ -532,12 +827,122 @@ def convert_time(secs):
         return '{:0>2d}:{:0>2d}:{:0>2d}'.format(minutes, seconds, milisecs)
 
 
+def convert_times(secs):
+    '''
+    Converts an array of seconds to mins. Format mm:ss:ms
+
+    Vectorized form of convert_time, giving the same strings.
+
+    Parameters
+    ----------
+    secs : numpy.ndarray or pandas.Series
+        times in seconds (non-negative)
+
+    Returns
+    -------
+    times : numpy.ndarray
+        times as strings in the above format (NaN where secs is NaN)
+    '''
+    secs = np.asarray(secs, dtype=np.float64)
+    nulls = np.isnan(secs)
+    secs_ = np.where(nulls, 0, secs)
+
+    int_secs = np.trunc(secs_)
+    milisecs = (np.round(secs_ - int_secs, 2) * 100).astype(np.int64)
+    minutes = (int_secs // 60).astype(np.int64)
+    seconds = (int_secs % 60).astype(np.int64)
+
+    times = np.char.add(np.char.add(np.char.zfill(minutes.astype(str), 2), ':'),
+                        np.char.add(np.char.add(np.char.zfill(seconds.astype(str), 2), ':'),
+                                    np.char.zfill(milisecs.astype(str), 2)))
+
+    if nulls.any():
+        times = times.astype(object)
+        times[nulls] = float('NaN')
+
+    return times
+
+
+def select_segments(confidence, duration, min_conf=0.5, min_dur=0.25, min_count=100, step=0.05):
+    '''
+    Select segments over a minimum confidence and duration, relaxing both until enough are selected.
+
+    Thresholds are lowered by 'step' together until at least min_count segments pass. The
+    number of relaxation steps each segment needs to pass is computed directly, so the final
+    thresholds are found without re-filtering the segments at every step.
+
+    Parameters
+    ----------
+    confidence : numpy.ndarray
+        confidence of segments
+    duration : numpy.ndarray
+        duration of segments in secs
+    min_conf : Float
+        minimum confidence to include a segment (range 0-1)
+    min_dur : Float
+        minimum duration/length in secs to include a segment.
+    min_count : int, optional
+        Default 100. Minimum number of segments to select.
+        All segments are selected if a track has fewer segments.
+    step : Float, optional
+        Default 0.05. Decrease of both thresholds in every relaxation step.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        boolean mask of selected segments
+    '''
+    confidence = np.asarray(confidence, dtype=np.float64)
+    duration = np.asarray(duration, dtype=np.float64)
+
+    # thresholds of every relaxation step, until no segment can be excluded anymore
+    conf_steps = [min_conf]
+    dur_steps = [min_dur]
+    while conf_steps[-1] >= 0 or dur_steps[-1] >= 0:
+        conf_steps.append(conf_steps[-1] - step)
+        dur_steps.append(dur_steps[-1] - step)
+
+    # first step at which a segment passes each threshold (thresholds are decreasing)
+    conf_k = np.searchsorted(-np.array(conf_steps), -confidence, side='right')
+    dur_k = np.searchsorted(-np.array(dur_steps), -duration, side='right')
+    seg_k = np.maximum(conf_k, dur_k)
+
+    if len(seg_k) < min_count:
+        return seg_k < len(conf_steps)
+
+    final_k = np.partition(seg_k, min_count - 1)[min_count - 1]
+
+    return seg_k <= final_k
+
+
+def segment_vectors(segments_df):
+    '''
+    Pitch and timbre vectors of segments as contiguous float32 arrays.
+
+    Parameters
+    ----------
+    segments_df : pandas.DataFrame
+        segments with columns 'pitches' and 'timbre' containing lists of 12 values
+
+    Returns
+    -------
+    pitches, timbre : numpy.ndarray
+        arrays of shape (number of segments, 12)
+    '''
+    pitches = np.array(segments_df['pitches'].tolist(), dtype=np.float32).reshape(-1, 12)
+    timbre = np.array(segments_df['timbre'].tolist(), dtype=np.float32).reshape(-1, 12)
+
+    return pitches, timbre
+
+
+@ins.instrument(rows=ins.frame_rows)
 def get_segments(track_analysis, segments=True, min_conf=0.5, min_dur=0.25, tempo=True,
-                 sections=False, beats=False, bars=False):
+                 sections=False, beats=False, bars=False, start_minute=True, vectors=False, compact=False):
     '''
     Get segments of tracks on a playlist with conditions.
 
     Restrictions on  minimum confidence and minimum duration of a segment can be set.
+    Both are relaxed in steps of 0.05 until at least 100 segments are selected, see select_segments.
 
     Parameters
     ----------
@@ -558,6 +963,14 @@ def get_segments(track_analysis, segments=True, min_conf=0.5, min_dur=0.25, temp
         Default False. True if beats dataframe needs to be returned
     bars: bool, optional
         Default False. True if bars dataframe needs to be returned
+    start_minute: bool, optional
+        Default True. False if the start_minute column (start time as mm:ss:ms) is not needed
+    vectors: bool, optional
+        Default False. True - segments dataframe has float32 columns pitch_01 - pitch_12 and
+        timbre_01 - timbre_12 (one contiguous block) instead of columns of lists 'pitches' and 'timbre'
+    compact: bool, optional
+        Default False. True - as vectors, with pitches and confidence quantized to uint8,
+        see compact_segments in CompactDtypes
 
     Returns
     -------
@@ -566,21 +979,39 @@ def get_segments(track_analysis, segments=True, min_conf=0.5, min_dur=0.25, temp
     sections_df, beats_df, bars_df  as required
     '''
 
-    trackoverview, beats_df, bars_df, segments_df, sections_df = track_anlaysis_to_df(track_analysis=track_analysis)
+    # decode only the parts of the analysis that are returned, segments are always needed for filtering
+    frames = ['segments'] + [f for f, a in zip(['sections', 'beats', 'bars'], [sections, beats, bars]) if a]
+    vectors = vectors or compact
+    trackoverview, arrays = track_analysis_to_arrays(track_analysis, frames=frames,
+                                                     vector_dtype=np.float32 if vectors else None)
 
     tempo_df = pd.DataFrame({'tempo': [trackoverview['tempo']]})
 
-    # Introducing start_minute column for more readability of start time in min:sec format
-    start_minute = segments_df['start'].map(convert_time)
-    segments_df.insert(1, 'start_minute', start_minute)
-    segments_df_ = segments_df[(segments_df['confidence'] > min_conf) & (segments_df['duration'] > min_dur)]
+    seg = arrays['segments']
+    idx = np.flatnonzero(select_segments(seg['confidence'], seg['duration'], min_conf=min_conf, min_dur=min_dur))
+
+    # index keeps positions of segments in the track analysis
+    segments_df_ = pd.DataFrame({c: seg[c][idx] for c in ['start', 'duration', 'confidence']}, index=idx)
 
-    while len(segments_df_) < 100:
-        min_conf = min_conf - 0.05
-        min_dur = min_dur - 0.05
-        segments_df_ = segments_df[(segments_df['confidence'] > min_conf) & (segments_df['duration'] > min_dur)]
+    if vectors:
+        pitch_cols = ['pitch_{:0>2d}'.format(i + 1) for i in range(12)]
+        timbre_cols = ['timbre_{:0>2d}'.format(i + 1) for i in range(12)]
+        block = np.hstack([seg['pitches'][idx], seg['timbre'][idx]])
+        segments_df_ = pd.concat([segments_df_, pd.DataFrame(block, index=idx, columns=pitch_cols + timbre_cols)],
+                                 axis=1)
+    else:
+        segments_df_['pitches'] = [seg['pitches'][i] for i in idx]
+        segments_df_['timbre'] = [seg['timbre'][i] for i in idx]
+
+    if compact:
+        segments_df_ = cd.compact_segments(segments_df_)
 
-    segments_df_ = segments_df_[['start', 'start_minute', 'duration', 'confidence', 'pitches', 'timbre']]
+    if start_minute:
+        # Introducing start_minute column for more readability of start time in min:sec format
+        segments_df_.insert(1, 'start_minute', convert_times(segments_df_['start']))
+
+    sections_df, beats_df, bars_df = [pd.DataFrame(arrays[f]) if f in arrays else None
+                                      for f in ['sections', 'beats', 'bars']]
 
     # iterating over a boolean mask to collect what to output/return
     output = [b for a, b in zip(
@@ -590,8 +1021,10 @@ def get_segments(track_analysis, segments=True, min_conf=0.5, min_dur=0.25, temp
     return output
 
 
+@ins.instrument(rows=len)
 def get_playlist_analysis(spotipyUserAuth, playlist_id, segments=True, min_conf=0.5,
-                          min_dur=0.25, tempo=True, sections=False, beats=False, bars=False):
+                          min_dur=0.25, tempo=True, sections=False, beats=False, bars=False, workers=None,
+                          cache=None, key='name'):
     '''
     Gets audio analysis for all tracks in a playlist.
 
@@ -616,46 +1049,46 @@ def get_playlist_analysis(spotipyUserAuth, playlist_id, segments=True, min_conf=
         Default False. True if beats dataframe needs to be returned
     bars: bool, optional
         Default False. True if bars dataframe needs to be returned
+    workers : int, optional
+        Default None. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+    key : str, optional
+        Default 'name'. 'id' - tracks are keyed by Spotify track id, see track_keys.
 
     Returns
     -------
     playlist_analysis : Dict
-        Keys: name of track from playlist (str)
+        Keys: name of track from playlist (str), or track id
         Value: List containing tempo and segment dataframe
                (and sections/beats/bars if asked)of the track
                Values here are returned from get_segments
     '''
     playlist_analysis = {}
-    tracks_df = get_tracks(spotipyUserAuth, playlist_id)
-    tracks_name = list(tracks_df['name'])
+    tracks_df = get_tracks(spotipyUserAuth, playlist_id, workers=workers)
     tracks_id = list(tracks_df['id'])
-    tracks_artist = list(tracks_df['artists_name'])
     # track_analysis returns a list of dictionary
-    tracks_analysis = get_tracks_analysis(spotipyUserAuth, tracks_id)
-
-    for name_, track_artist, track_analysis in zip(tracks_name, tracks_artist, tracks_analysis):
-
-        # remove any special characters from name (they may cause issues in filenaming)
-        track_artist = re.sub(r'[*|><:"?/]|\\', "", track_artist)
-        track_artist = demoji.replace(track_artist)
-        name_ = re.sub(r'[*|><:"?/]|\\', "", name_)
-        name_ = demoji.replace(name_)
-        # rename track name to make it unique by adding first 3 characters from
-        # the artist's name
-        name_ = name_ + '_' + track_artist[:3]
+    tracks_analysis = get_tracks_analysis(spotipyUserAuth, tracks_id, workers=workers, cache=cache)
+
+    for name_, track_analysis in zip(track_keys(tracks_df, key), tracks_analysis):
+
         playlist_analysis[name_] = get_segments(track_analysis, segments=segments,
                                                 min_conf=min_conf, min_dur=min_dur, tempo=tempo,
                                                 sections=sections, beats=beats, bars=bars)
     return playlist_analysis
 
 
+@ins.instrument()
 def get_folder_analysis(spotipyUserAuth, filsort_pl=None, pl_name_id=None, segments=True, min_conf=0.5,
-                        min_dur=0.25, sections=True, tempo=False, beats=False, bars=False):
+                        min_dur=0.25, sections=True, tempo=False, beats=False, bars=False, workers=None,
+                        cache=None, key='name'):
     '''
     Gets audio analysis for all tracks in a playlist, for all playlists.
     Here, we will be using either a filtered and sorted list of playlists
     or a list of user playlist name and id tuples.
 
+    See get_index_analysis to fetch and convert a track found in several playlists once.
+
     Parameters
     ----------
     spotipyUserAuth : spotipy object
@@ -680,6 +1113,12 @@ def get_folder_analysis(spotipyUserAuth, filsort_pl=None, pl_name_id=None, segme
         Default False. True if beats dataframe needs to be returned
     bars: bool, optional
         Default False. True if bars dataframe needs to be returned
+    workers : int, optional
+        Default None. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+    key : str, optional
+        Default 'name'. 'id' - tracks are keyed by Spotify track id, see track_keys.
 
     Returns
     -------
@@ -688,39 +1127,28 @@ def get_folder_analysis(spotipyUserAuth, filsort_pl=None, pl_name_id=None, segme
          Value : a dict of track analysis of all tracks from the playlist
                  Values here are returned from get_playlist_analysis
     '''
-
     folder_analysis = {}
 
-    if filsort_pl is not None:
-        for p in filsort_pl:
-
-            # remove any special characters from name (they may cause issues in filenaming)
-            pl_name = re.sub(r'[*|><:"?/]|\\', "", p[1])
-            pl_name = demoji.replace(pl_name)
-            folder_analysis[pl_name] = get_playlist_analysis(spotipyUserAuth, playlist_id=p[2],
-                                                             segments=segments, tempo=tempo,
-                                                             min_conf=min_conf, min_dur=min_dur,
-                                                             sections=sections, beats=beats, bars=bars)
-    else:
-        for p in pl_name_id:
-
-            # remove any special characters from name (they may cause issues in filenaming)
+    for pl_name, playlist_id in resolve_playlists(filsort_pl, pl_name_id):
 
-            pl_name = re.sub(r'[*|><:"?/]|\\', "", p[0])
-            pl_name = demoji.replace(pl_name)
-
-            folder_analysis[pl_name] = get_playlist_analysis(spotipyUserAuth, playlist_id=p[1],
-                                                             segments=segments, tempo=tempo,
-                                                             min_conf=min_conf, min_dur=min_dur,
-                                                             sections=sections, beats=beats, bars=bars)
+        folder_analysis[pl_name] = get_playlist_analysis(spotipyUserAuth, playlist_id=playlist_id,
+                                                         segments=segments, tempo=tempo,
+                                                         min_conf=min_conf, min_dur=min_dur,
+                                                         sections=sections, beats=beats, bars=bars,
+                                                         workers=workers, cache=cache, key=key)
     return folder_analysis
 
 
-def create_dataset(folder_analysis, path):
+@ins.instrument()
+def create_dataset(folder_analysis, path, df_names=None, consolidated=False, track_ids=None, key='name'):
     '''
     Creates dataset as folders for each playlist, subfolders for all tracks in a playlist folder
     and track analysis dataframes as parquet files.
 
+    With consolidated=True, each dataframe type is instead stored as one parquet dataset
+    partitioned by playlist, see DatasetStore module.
+
+    See create_index_dataset to store a track in several playlists once.
 
     Parameters
     ----------
@@ -729,11 +1157,36 @@ def create_dataset(folder_analysis, path):
         dict returned by get_folder_analysis
     path : str
         path to store the dataset
+    df_names : List[str], optional
+        Default ['tempo', 'segments', 'sections', 'beats', 'bars']. Names of the dataframes of a track,
+        in order. Use frame_names with the arguments given to get_folder_analysis.
+    consolidated : bool, optional
+        Default False. True - store one parquet dataset per dataframe type instead of a file per track.
+    track_ids : Dict, optional
+        Default None. Key : track name (as in folder_analysis), Value : Spotify track id.
+        Fills the track_id column of the consolidated dataset.
+    key : str, optional
+        Default 'name'. 'id' - tracks of folder_analysis are keyed by track id (get_folder_analysis with
+        key='id'), they fill the track_id columns without track_ids.
     '''
     # Path to 'Dataset' dir
     p = path
     # list of dataframe names in output
-    df_names = ['tempo', 'segments', 'sections', 'beats', 'bars']
+    if df_names is None:
+        df_names = ['tempo', 'segments', 'sections', 'beats', 'bars']
+
+    if key == 'id' and track_ids is None:
+        track_ids = {track: track for i in folder_analysis.values() for track in i}
+
+    if consolidated:
+        for fn, i in folder_analysis.items():
+
+            for k, name in enumerate(df_names):
+
+                frames = [(track, j[k]) for track, j in i.items() if k < len(j)]
+                if frames:
+                    ds.write_frame(ds.stack_tracks(frames, track_ids=track_ids), p, name, fn.strip())
+        return
 
     for fn, i in folder_analysis.items():
 
@@ -744,18 +1197,680 @@ def create_dataset(folder_analysis, path):
 
             for k in range(len(j)):
 
-                j[k].to_parquet(path_.joinpath('{}_{}.parquet'.format(track, df_names[k])), engine='pyarrow')
+                file = path_.joinpath('{}_{}.parquet'.format(track, df_names[k]))
+                j[k].to_parquet(file, engine='pyarrow')
+
+                if ins.enabled():
+                    ins.count('SpotipyCollect.create_dataset', rows=len(j[k]), bytes_=file.stat().st_size)
+
+
+@ins.instrument(rows=len)
+def get_index_analysis(spotipyUserAuth, index, segments=True, min_conf=0.5, min_dur=0.25, sections=True,
+                       tempo=False, beats=False, bars=False, workers=None, cache=None):
+    '''
+    Gets audio analysis of the unique tracks of several playlists, so a track found in several
+    playlists is fetched and converted once.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    index : tuple
+        (tracks_df, membership) returned by build_track_index.
+    segments, min_conf, min_dur, sections, tempo, beats, bars :
+        see get_folder_analysis
+    workers : int, optional
+        Default None. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+
+    Returns
+    -------
+    index_analysis : Dict
+         Key : Spotify track id
+         Value : list of dataframes returned by get_segments
+    '''
+    tracks_df = index[0]
+    tracks_analysis = get_tracks_analysis(spotipyUserAuth, list(tracks_df['id']), workers=workers, cache=cache)
+
+    index_analysis = {}
+    for track_id, track_analysis in zip(tracks_df['id'], tracks_analysis):
+
+        index_analysis[track_id] = get_segments(track_analysis, segments=segments, min_conf=min_conf,
+                                                min_dur=min_dur, tempo=tempo, sections=sections, beats=beats,
+                                                bars=bars)
+    return index_analysis
+
+
+@ins.instrument()
+def create_index_dataset(index_analysis, index, path, df_names=None):
+    '''
+    Creates a deduplicated dataset: every track is stored once by its id in a 'tracks' folder,
+    with a membership table of the playlists it is in and the track metadata table,
+    see DatasetStore module.
+
+    Parameters
+    ----------
+    index_analysis : Dict
+        dict returned by get_index_analysis
+    index : tuple
+        (tracks_df, membership) given to get_index_analysis
+    path : str
+        path to store the dataset
+    df_names : List[str], optional
+        Default ['tempo', 'segments', 'sections', 'beats', 'bars']. Names of the dataframes of a track,
+        in order. Use frame_names with the arguments given to get_index_analysis.
+    '''
+    p = path
+    if df_names is None:
+        df_names = ['tempo', 'segments', 'sections', 'beats', 'bars']
+
+    tracks_df, membership = index
+    tracks_path = p.joinpath(ds.TRACKS_DIR)
+    tracks_path.mkdir(parents=True, exist_ok=True)
+
+    for track_id in tracks_df['id']:
+
+        j = index_analysis[track_id]
+
+        for k in range(len(j)):
+
+            file = tracks_path.joinpath('{}_{}.parquet'.format(track_id, df_names[k]))
+            j[k].to_parquet(file, engine='pyarrow')
+
+            if ins.enabled():
+                ins.count('SpotipyCollect.create_index_dataset', rows=len(j[k]), bytes_=file.stat().st_size)
+
+    membership = membership.assign(playlist=membership['playlist'].str.strip())
+    ds.write_membership(membership, p)
+    ds.write_tracks(index_tracks_table(tracks_df, membership), p)
 
 
+# --------------------------------------------------------------------------------
+#  Functions for building the dataset incrementally
+# --------------------------------------------------------------------------------
+
+# Name of the manifest file kept in every playlist folder of the dataset
+MANIFEST_NAME = 'manifest.json'
+
+
+def clean_name(name):
+    '''
+    Removes special characters and emojis from a name (they may cause issues in filenaming).
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    name : str
+    '''
+    name = re.sub(r'[*|><:"?/]|\\', "", name)
+
+    return demoji.replace(name)
+
+
+def resolve_playlists(filsort_pl=None, pl_name_id=None):
+    '''
+    Playlists to collect, given to the functions of this module either way.
+
+    Parameters
+    ----------
+    filsort_pl : List[tuple], optional
+        Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : List[tuple], optional
+        Dafault None. In the case filsort_pl is not available,
+        provide a list of playlist name and id tuples
+
+    Returns
+    -------
+    playlists : List[tuple]
+        (playlist name cleaned by clean_name, playlist id) tuples
+    '''
+    if filsort_pl is not None:
+        return [(clean_name(p[1]), p[2]) for p in filsort_pl]
+
+    return [(clean_name(p[0]), p[1]) for p in pl_name_id]
+
+
+def track_key(name, artists_name, sep='_'):
+    '''
+    Creates the name a track is stored under in the dataset.
+
+    Track name is made unique by adding first 3 characters from the artist's name.
+
+    Parameters
+    ----------
+    name : str
+        track name
+    artists_name : str
+        artists' names of the track, as returned by get_artist_name
+    sep : str, optional
+        Default '_'. Separator of the track and artists' names, '-' in SpotipyCollectPub datasets.
+
+    Returns
+    -------
+    key : str
+    '''
+    return clean_name(name) + sep + clean_name(artists_name)[:3]
+
+
+# Names the files of a track can be stored under, see track_keys
+TRACK_KEYS = ('name', 'id')
+
+
+def track_keys(tracks_df, key='name', sep='_'):
+    '''
+    Creates the names the tracks of a playlist are stored under in the dataset.
+
+    Parameters
+    ----------
+    tracks_df : pandas.DataFrame
+        tracks returned by get_tracks, with columns 'name', 'id' and 'artists_name'
+    key : str, optional
+        Default 'name' - track_key of the track name and artists' names, a display name that
+        different tracks may share.
+        'id' - Spotify track id. Ids are stable and unique, tracks with the same name never overwrite
+        each other and stored tracks are joined to other tables by id (see DatasetStore, tracks table).
+    sep : str, optional
+        Default '_'. Separator of track_key.
+
+    Returns
+    -------
+    keys : List[str]
+    '''
+    if key not in TRACK_KEYS:
+        raise ValueError('key must be one of {}, got {!r}'.format(TRACK_KEYS, key))
+
+    if key == 'id':
+        return list(tracks_df['id'])
+
+    return [track_key(n, a, sep=sep) for n, a in zip(tracks_df['name'], tracks_df['artists_name'])]
+
+
+def tracks_table(pl_name, tracks_df, sep='_'):
+    '''
+    Rows of the track metadata table (DatasetStore.write_tracks) of the tracks of a playlist
+    stored by track id.
+
+    Parameters
+    ----------
+    pl_name : str
+        name of the playlist (folder)
+    tracks_df : pandas.DataFrame
+        tracks returned by get_tracks
+    sep : str, optional
+        Default '_'. Separator of the display names, see track_key.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        Columns : id, name, artists_name, playlist, track (display name, see track_key)
+    '''
+    return pd.DataFrame({'id': list(tracks_df['id']), 'name': list(tracks_df['name']),
+                         'artists_name': list(tracks_df['artists_name']), 'playlist': pl_name,
+                         'track': track_keys(tracks_df, sep=sep)}, columns=ds.TRACKS_COLUMNS)
+
+
+def frame_names(segments=True, tempo=True, sections=False, beats=False, bars=False):
+    '''
+    Names of the dataframes returned by get_segments, in the order they are returned.
+
+    Parameters
+    ----------
+    segments, tempo, sections, beats, bars : bool, optional
+        same as get_segments
+
+    Returns
+    -------
+    names : List[str]
+    '''
+    return [name for name, a in zip(['tempo', 'segments', 'sections', 'beats', 'bars'],
+                                     [tempo, segments, sections, beats, bars]) if a]
+
+
+def load_manifest(path):
+    '''
+    Reads the manifest of a playlist folder.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the playlist folder
+
+    Returns
+    -------
+    manifest : Dict
+        Key : track name as stored in the dataset
+        Value : Dict with track 'id' and list of stored dataframe names 'frames'
+        Empty if the folder has no manifest yet.
+    '''
+    path_ = path.joinpath(MANIFEST_NAME)
+
+    if not path_.exists():
+        return {}
+
+    with open(path_, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    '''
+    Writes the manifest of a playlist folder.
+
+    The manifest is written to a temporary file first and then renamed,
+    so an interrupted run never leaves a partially written manifest.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the playlist folder
+    manifest : Dict
+        returned by load_manifest
+    '''
+    path_ = path.joinpath(MANIFEST_NAME)
+    tmp = path.joinpath(MANIFEST_NAME + '.tmp')
+
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+    os.replace(tmp, path_)
+
+
+def track_stored(path, manifest, key, track_id, frames):
+    '''
+    Checks if a track is already stored with all required dataframes.
+
+    A track found on disk but missing from the manifest (e.g. dataset written by create_dataset)
+    counts as stored and is added to the manifest.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the playlist folder
+    manifest : Dict
+        returned by load_manifest, updated in place
+    key : str
+        track name as stored in the dataset
+    track_id : str
+        Spotify track id
+    frames : List[str]
+        names of required dataframes, see frame_names
+
+    Returns
+    -------
+    stored : bool
+    '''
+    entry = manifest.get(key)
+
+    if entry is not None and entry.get('id') not in (None, track_id):
+        # a different track is stored under the same name
+        return False
+
+    if not all(path.joinpath('{}_{}.parquet'.format(key, f)).exists() for f in frames):
+        return False
+
+    manifest[key] = {'id': track_id, 'frames': sorted(set(frames) | set((entry or {}).get('frames', [])))}
+
+    return True
+
+
+def record_track(path, manifest, key, track_id, frames):
+    '''
+    Records a track written to the playlist folder in the manifest.
+
+    Frames recorded earlier for the same track id are kept, so files of other frames
+    (e.g. beats of a previous run) stay listed and are deleted by prune. Files of frames
+    not rewritten for a different track under the same name are stale and deleted.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        path to the playlist folder
+    manifest : Dict
+        returned by load_manifest, updated in place
+    key : str
+        track name as stored in the dataset
+    track_id : str
+        Spotify track id
+    frames : List[str]
+        names of the dataframes written, see frame_names
+    '''
+    entry = manifest.get(key) or {}
+    recorded = set(entry.get('frames', [])) - set(frames)
+
+    if recorded and entry.get('id') not in (None, track_id):
+        for f in recorded:
+            path.joinpath('{}_{}.parquet'.format(key, f)).unlink(missing_ok=True)
+        recorded = set()
+
+    manifest[key] = {'id': track_id, 'frames': sorted(set(frames) | recorded)}
+
+
+@ins.instrument()
+def update_dataset(spotipyUserAuth, path, filsort_pl=None, pl_name_id=None, segments=True, min_conf=0.5,
+                   min_dur=0.25, sections=True, tempo=False, beats=False, bars=False, workers=None,
+                   cache=None, checkpoint=20, prune=False, key='id'):
+    '''
+    Incrementally creates or refreshes the dataset created by create_dataset.
+
+    Files are named by track id and the track metadata table of the dataset (DatasetStore, tracks table)
+    is updated with the current tracks of every playlist. With key='name' a dataset of files named
+    by track_key (as created by create_dataset) is refreshed instead, without a tracks table.
+
+    Only tracks that are missing on disk, or whose stored file belongs to a different track id,
+    are fetched. Each playlist folder keeps a manifest of stored tracks, which is saved after every
+    'checkpoint' tracks, so a failed run resumes where it stopped.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    path : pathlib.Path
+        path to the dataset directory
+    filsort_pl : List[tuple], optional
+        Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : List[tuple], optional
+        Dafault None. In the case filsort_pl is not available,
+        provide a list of playlist name and id tuples
+    segments, min_conf, min_dur, sections, tempo, beats, bars :
+        same as get_folder_analysis
+    workers : int, optional
+        Default None. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+    checkpoint : int, optional
+        Default 20. Number of tracks fetched and written between manifest saves.
+    prune : bool, optional
+        Default False. True - delete stored files of tracks no longer in the playlist.
+    key : str, optional
+        Default 'id'. 'name' - files are named by track_key, see track_keys.
+
+    Returns
+    -------
+    fetched : Dict
+        Key : Name of the playlist (string)
+        Value : number of tracks fetched for the playlist
+    '''
+    playlists = resolve_playlists(filsort_pl, pl_name_id)
+
+    frames = frame_names(segments=segments, tempo=tempo, sections=sections, beats=beats, bars=bars)
+    fetched = {}
+
+    for pl_name, playlist_id in playlists:
+
+        path_ = path.joinpath('{}'.format(pl_name.strip()))
+        path_.mkdir(exist_ok=True)
+
+        manifest = load_manifest(path_)
+        tracks_df = get_tracks(spotipyUserAuth, playlist_id, workers=workers)
+        keys = track_keys(tracks_df, key)
+        if key == 'id':
+            ds.write_tracks(tracks_table(pl_name.strip(), tracks_df), path)
+
+        missing = [(k, track_id) for k, track_id in zip(keys, tracks_df['id'])
+                   if not track_stored(path_, manifest, k, track_id, frames)]
+
+        if prune:
+            for k in set(manifest) - set(keys):
+                for f in manifest.pop(k)['frames']:
+                    path_.joinpath('{}_{}.parquet'.format(k, f)).unlink(missing_ok=True)
+
+        save_manifest(path_, manifest)
+
+        for i in range(0, len(missing), checkpoint):
+
+            chunk = missing[i: i + checkpoint]
+            tracks_analysis = get_tracks_analysis(spotipyUserAuth, [t[1] for t in chunk],
+                                                  workers=workers, cache=cache)
+
+            for (k, track_id), track_analysis in zip(chunk, tracks_analysis):
+
+                output = get_segments(track_analysis, segments=segments, min_conf=min_conf, min_dur=min_dur,
+                                      tempo=tempo, sections=sections, beats=beats, bars=bars)
+
+                for df, f in zip(output, frames):
+                    df.to_parquet(path_.joinpath('{}_{}.parquet'.format(k, f)), engine='pyarrow')
+
+                record_track(path_, manifest, k, track_id, frames)
+
+            save_manifest(path_, manifest)
+
+        fetched[pl_name] = len(missing)
+
+    return fetched
+
+# --------------------------------------------------------------------------------
+#  Functions for streaming the dataset
+# --------------------------------------------------------------------------------
+
+# Sentinel closing a queue of the streaming pipeline
+_DONE = object()
+
+
+def _put(q, item, stop):
+    '''
+    Put an item on a bounded queue, giving up once the pipeline is stopped.
+    Returns False if the item was not put.
+    '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _get(q, stop):
+    '''
+    Get an item from a queue, _DONE once the pipeline is stopped.
+    '''
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+    return _DONE
+
+
+@ins.instrument()
+def stream_dataset(spotipyUserAuth, path, filsort_pl=None, pl_name_id=None, segments=True, min_conf=0.5,
+                   min_dur=0.25, sections=True, tempo=False, beats=False, bars=False, workers=None,
+                   cache=None, checkpoint=20, queue_size=None, key='id'):
+    '''
+    Creates or refreshes the dataset of update_dataset as a pipeline, writing every track as soon as it is converted.
+
+    Track analysis is fetched, converted (get_segments) and written to parquet by separate stages
+    connected by bounded queues:
+
+        playlists > get_tracks > [jobs] > fetch threads > [analyses] > get_segments > [frames] > writer
+
+    A stage waits when the queue after it is full, so at most about 3 * queue_size tracks are held in
+    memory however many playlists are crawled. Analysis responses are released once converted and
+    frames once written. Tracks already stored are skipped and manifests are saved after every
+    'checkpoint' written tracks, so an interrupted run resumes where it stopped (see update_dataset).
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    path : pathlib.Path
+        path to the dataset directory
+    filsort_pl : List[tuple], optional
+        Default None. Uses 4-tuple output from filtersort_playlist function.
+    pl_name_id : List[tuple], optional
+        Dafault None. In the case filsort_pl is not available,
+        provide a list of playlist name and id tuples
+    segments, min_conf, min_dur, sections, tempo, beats, bars :
+        same as get_folder_analysis
+    workers : int, optional
+        Default None - one thread. Number of threads to fetch track analysis concurrently with.
+    cache : ResponseCache, optional
+        Default None. Cache of track analysis responses.
+    checkpoint : int, optional
+        Default 20. Number of tracks written between manifest saves.
+    queue_size : int, optional
+        Default None - twice the number of fetch threads. Maximum number of tracks waiting between two stages.
+    key : str, optional
+        Default 'id'. 'name' - files are named by track_key without a tracks table, see update_dataset.
+
+    Returns
+    -------
+    written : Dict
+        Key : Name of the playlist (string)
+        Value : number of tracks written for the playlist
+    '''
+    playlists = resolve_playlists(filsort_pl, pl_name_id)
+
+    frames = frame_names(segments=segments, tempo=tempo, sections=sections, beats=beats, bars=bars)
+    n_fetch = max(workers or 1, 1)
+    queue_size = queue_size or 2 * n_fetch
+
+    jobs, analyses, outputs = queue.Queue(queue_size), queue.Queue(queue_size), queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    written = {}
+
+    def stage(func):
+
+        def run():
+            try:
+                func()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        return threading.Thread(target=run, daemon=True)
+
+    def produce():
+
+        for pl_name, playlist_id in playlists:
+
+            path_ = path.joinpath('{}'.format(pl_name.strip()))
+            path_.mkdir(exist_ok=True)
+
+            manifest = load_manifest(path_)
+            tracks_df = get_tracks(spotipyUserAuth, playlist_id, workers=workers)
+            keys = track_keys(tracks_df, key)
+            if key == 'id':
+                ds.write_tracks(tracks_table(pl_name.strip(), tracks_df), path)
+
+            missing = [(k, track_id) for k, track_id in zip(keys, tracks_df['id'])
+                       if not track_stored(path_, manifest, k, track_id, frames)]
+            save_manifest(path_, manifest)
+            written.setdefault(pl_name, 0)
+
+            # the manifest of a playlist is only changed by the writer from here on
+            for k, track_id in missing:
+                if not _put(jobs, (pl_name, path_, manifest, k, track_id), stop):
+                    return
+
+        for _ in range(n_fetch):
+            _put(jobs, _DONE, stop)
+
+    def fetch():
+
+        semaphore = host_semaphore(spotipyUserAuth)
+
+        while True:
+            job = _get(jobs, stop)
+            if job is _DONE:
+                break
+
+            with semaphore:
+                track_analysis = get_tracks_analysis(spotipyUserAuth, [job[-1]], cache=cache)[0]
+
+            if not _put(analyses, job + (track_analysis,), stop):
+                return
+
+        _put(analyses, _DONE, stop)
+
+    def convert():
+
+        done = 0
+
+        while done < n_fetch:
+            item = _get(analyses, stop)
+            if item is _DONE:
+                done += 1
+                continue
+
+            output = get_segments(item[-1], segments=segments, min_conf=min_conf, min_dur=min_dur,
+                                  tempo=tempo, sections=sections, beats=beats, bars=bars)
+            job, item = item[:-1], None
+
+            if not _put(outputs, job + (output,), stop):
+                return
+
+        _put(outputs, _DONE, stop)
+
+    threads = [stage(produce)] + [stage(fetch) for _ in range(n_fetch)] + [stage(convert)]
+    for t in threads:
+        t.start()
+
+    # the calling thread writes, it is the only one changing manifests once tracks are queued
+    dirty = {}
+    count = 0
+
+    try:
+        while True:
+            item = _get(outputs, stop)
+            if item is _DONE:
+                break
+
+            pl_name, path_, manifest, k, track_id, output = item
+            item = None
+
+            for df, f in zip(output, frames):
+
+                file = path_.joinpath('{}_{}.parquet'.format(k, f))
+                df.to_parquet(file, engine='pyarrow')
+
+                if ins.enabled():
+                    ins.count('SpotipyCollect.stream_dataset', rows=len(df), bytes_=file.stat().st_size)
+
+            record_track(path_, manifest, k, track_id, frames)
+            dirty[path_] = manifest
+            written[pl_name] += 1
+            count += 1
+
+            if count % checkpoint == 0:
+                for p, m in dirty.items():
+                    save_manifest(p, m)
+                dirty.clear()
+    finally:
+        for p, m in dirty.items():
+            save_manifest(p, m)
+
+        stop.set()
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+    return written
+
 # --------------------------------------------------------------------------------
 #  Functions for retrieving track features of the dataset
 # --------------------------------------------------------------------------------
 
 
-def get_tracks_features(spotipyUserAuth, tracksid, showkeys=False):
+# Maximum number of track ids the audio features endpoint accepts in one request
+AUDIO_FEATURES_LIMIT = 100
+
+
+@ins.instrument(rows=len, bytes_=ins.json_bytes)
+def get_tracks_features(spotipyUserAuth, tracksid, showkeys=False, cache=None, workers=None):
     '''
     Gets track features for multiple tracks.
 
+    Track ids are requested in batches of AUDIO_FEATURES_LIMIT ids.
+
     Parameters
     ----------
     spotipyUserAuth : spotipy object
@@ -764,6 +1879,11 @@ def get_tracks_features(spotipyUserAuth, tracksid, showkeys=False):
         list of track ids. Wrap a track id in a list if only a single track is present.
     showkeys : bool, optional
         Default False - prints dictionary keys
+    cache : ResponseCache, optional
+        Default None. If provided, track features are read from the cache and only
+        missing tracks are requested.
+    workers : int, optional
+        Default None. Number of threads to request batches concurrently with.
 
     Returns
     -------
@@ -771,7 +1891,16 @@ def get_tracks_features(spotipyUserAuth, tracksid, showkeys=False):
         list of dictionaries containing track features of all tracks
         in the track id list
     '''
-    tracks_features = spotipyUserAuth.audio_features(tracksid)
+    def request(ids):
+        batches = [ids[i: i + AUDIO_FEATURES_LIMIT] for i in range(0, len(ids), AUDIO_FEATURES_LIMIT)]
+        responses = fetch_concurrent(spotipyUserAuth, spotipyUserAuth.audio_features, batches, workers=workers)
+
+        return [f for response in responses for f in response]
+
+    if cache is None:
+        tracks_features = request(list(tracksid))
+    else:
+        tracks_features = cache.fetch('audio_features', tracksid, request)
 
     if showkeys is True:
         print(tracks_features[0].keys())
@@ -779,7 +1908,36 @@ def get_tracks_features(spotipyUserAuth, tracksid, showkeys=False):
     return tracks_features
 
 
-def tracks_features_to_df(spotipyUserAuth, tracksid):
+def get_features_batched(spotipyUserAuth, tracksid_lists, cache=None, workers=None):
+    '''
+    Gets track features for several lists of tracks (e.g. one list per playlist) at once.
+
+    Track ids of all lists are deduplicated and packed into full batches of
+    AUDIO_FEATURES_LIMIT ids before requesting, then scattered back to each list.
+
+    Parameters
+    ----------
+    spotipyUserAuth : spotipy object
+        returned by 'spotipy_userauth' function.
+    tracksid_lists : List[List[str]]
+        lists of track ids
+    cache : ResponseCache, optional
+        Default None. Cache of track features responses.
+    workers : int, optional
+        Default None. Number of threads to request batches concurrently with.
+
+    Returns
+    -------
+    features_lists : List[List[Dict]]
+        track features for each list of track ids, in the same order
+    '''
+    unique_ids = list(dict.fromkeys(id_ for ids in tracksid_lists for id_ in ids))
+    features = dict(zip(unique_ids, get_tracks_features(spotipyUserAuth, unique_ids, cache=cache, workers=workers)))
+
+    return [[features[id_] for id_ in ids] for ids in tracksid_lists]
+
+
+def tracks_features_to_df(spotipyUserAuth, tracksid, cache=None, tracks_features=None):
     '''
     Convert track feature dictionary into dateframe.
 
@@ -789,18 +1947,24 @@ def tracks_features_to_df(spotipyUserAuth, tracksid):
         returned by 'spotipy_userauth' function.
     trackids : List[str]
         list of track ids. If a single trackid is present, wrap it in a list.
+    cache : ResponseCache, optional
+        Default None. Cache of track features responses.
+    tracks_features : List[Dict], optional
+        Default None. Already fetched track features, nothing is requested if provided.
 
     Returns
     -------
     features_df : pandas.DataFrame
     '''
+    if tracks_features is None:
+        tracks_features = get_tracks_features(spotipyUserAuth, tracksid, cache=cache)
 
-    tracks_features = get_tracks_features(spotipyUserAuth, tracksid)
-    features_df = json_normalize(tracks_features)
+    # tracks without features (None) are kept as empty rows, so rows line up with track ids
+    features_df = json_normalize([f if f is not None else {} for f in tracks_features])
     return features_df
 
 
-def get_playlist_features(spotipyUserAuth, playlist_id):
+def get_playlist_features(spotipyUserAuth, playlist_id, cache=None, tracks_df=None, tracks_features=None):
     '''Gets features for all tracks in a playlist.
 
     Parameters
@@ -808,50 +1972,80 @@ def get_playlist_features(spotipyUserAuth, playlist_id):
     spotipyUserAuth : spotipy object
         returned by 'spotipy_userauth' function.
     playlist_id : str
+    cache : ResponseCache, optional
+        Default None. Cache of track features responses.
+    tracks_df : pandas.DataFrame, optional
+        Default None. Tracks of the playlist as returned by get_tracks, fetched if not provided.
+    tracks_features : List[Dict], optional
+        Default None. Already fetched track features of tracks_df, fetched if not provided.
 
     Returns : pandas.DataFrame
               Rows represent tracks and colummns represent features
     '''
+    if tracks_df is None:
+        tracks_df = get_tracks(spotipyUserAuth, playlist_id)
 
-    tracks_df = get_tracks(spotipyUserAuth, playlist_id)
-    features_df = tracks_features_to_df(spotipyUserAuth, tracks_df['id'])
+    features_df = tracks_features_to_df(spotipyUserAuth, tracks_df['id'], cache=cache,
+                                        tracks_features=tracks_features)
     pl_features_df = pd.concat([tracks_df[['name', 'artists_name']], features_df], axis=1)
 
     return pl_features_df
 
 
-def get_folder_features(spotipyUserAuth, filsort_pl=None, pl_name_id=None):
+@ins.instrument(rows=len)
+def get_folder_features(spotipyUserAuth, filsort_pl=None, pl_name_id=None, cache=None, workers=None):
     '''
     Here, we will be using filtered and sorted output. Future edit should take user
     playlist names and id.
 
+    Track features of all playlists are requested together in full batches of
+    unique track ids, see get_features_batched.
+
     spotipyUserAuth : Spotipy auth object.
 
     filsort_pl : Default None. Uses 4-tuple output from filtersort_playlist function.
     pl_name_id : Dafault None. In the case filsort_pl is not available,
                  provide list of playlist name and id tuples
+    cache : Default None. ResponseCache of track features responses.
+    workers : Default None. Number of threads to request batches concurrently with.
 
     Returns: a dict with key/value pairs for all playlists in the folder.
              Key : Name of the playlist (string)
              Value : pandas.DataFrame returned from get_playlist_features
     '''
+    playlists = resolve_playlists(filsort_pl, pl_name_id)
 
-    folder_features = {}
+    folder_tracks = [(name, get_tracks(spotipyUserAuth, playlist_id, workers=workers))
+                     for name, playlist_id in playlists]
 
-    if filsort_pl is not None:
-        for p in filsort_pl:
+    features_lists = get_features_batched(spotipyUserAuth, [list(t[1]['id']) for t in folder_tracks],
+                                          cache=cache, workers=workers)
 
-            # remove any special characters from name (they may cause issues in filenaming)
-            pl_name = re.sub(r'[*|><:"?/]|\\', "", p[1])
-            pl_name = demoji.replace(pl_name)
-            folder_features[pl_name] = get_playlist_features(spotipyUserAuth, playlist_id=p[2])
-    else:
-        for p in pl_name_id:
+    folder_features = {}
 
-            # remove any special characters from name (they may cause issues in filenaming)
+    for (pl_name, tracks_df), tracks_features in zip(folder_tracks, features_lists):
 
-            pl_name = re.sub(r'[*|><:"?/]|\\', "", p[0])
-            pl_name = demoji.replace(pl_name)
-            folder_features[pl_name] = get_playlist_features(spotipyUserAuth, playlist_id=p[1])
+        folder_features[pl_name] = get_playlist_features(spotipyUserAuth, playlist_id=None, tracks_df=tracks_df,
+                                                         tracks_features=tracks_features)
 
     return folder_features
+
+
+@ins.instrument(rows=len)
+def get_index_features(spotipyUserAuth, index, cache=None, workers=None):
+    '''
+    Track features of the unique tracks of an index, requested once per track.
+
+    spotipyUserAuth : Spotipy auth object.
+
+    index : (tracks_df, membership) returned by build_track_index.
+    cache : Default None. ResponseCache of track features responses.
+    workers : Default None. Number of threads to request batches concurrently with.
+
+    Returns: pandas.DataFrame returned from get_playlist_features, one row per unique track id.
+             Join it to the membership of the index on id for the playlists of a track.
+    '''
+    tracks_df = index[0]
+    tracks_features = get_tracks_features(spotipyUserAuth, list(tracks_df['id']), cache=cache, workers=workers)
+
+    return get_playlist_features(spotipyUserAuth, None, tracks_df=tracks_df, tracks_features=tracks_features)
@@ -1,3 +1,6 @@
+from cap_package import DatasetStore as ds
+from cap_package import Instrument as ins
+from cap_package import RequestScheduler as rs
 from cap_package import SpotipyCollect as sc
 import demoji
 import pandas as pd
@@ -10,15 +13,23 @@ from spotipy.oauth2 import SpotifyClientCredentials
 demoji.download_codes()
 
 
-def spotipy_client_cred(client_id, client_secret):
+def spotipy_client_cred(client_id, client_secret, scheduler=None):
     '''
     Creates server-to-server authentication token and returns spotipy object.
     Token automatically refreshes.
+
+    scheduler : Default None. RequestScheduler to rate limit and retry all requests with.
+                The returned object is then wrapped in ScheduledSpotify.
     '''
     client_credentials_manager = SpotifyClientCredentials(
         client_id=client_id, client_secret=client_secret)
+
     sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
 
+    if scheduler is not None:
+        # retries move from spotipy to the scheduler, which sees 429 responses with their Retry-After
+        sp = rs.ScheduledSpotify(sp, scheduler)
+
     return sp
 
 
@@ -80,8 +91,10 @@ def get_artist_name(pl_full_df):
     return artists_list
 
 
+@ins.instrument(rows=len)
 def get_df_analysis(spotipyUserAuth, tracks_df, segments=True, min_conf=0.5,
-                    min_dur=0.25, tempo=True, sections=False, beats=False, bars=False):
+                    min_dur=0.25, tempo=True, sections=False, beats=False, bars=False, workers=None,
+                    cache=None, key='name'):
     '''
     spotipyUserAuth : Spotipy auth object.
     playlist_id : playlist id
@@ -89,27 +102,24 @@ def get_df_analysis(spotipyUserAuth, tracks_df, segments=True, min_conf=0.5,
     min_conf: minimum confidence to include a segment (range 0-1)
     min_dur : minimum duration/length in secs to include a segment
     sections/beats/bars: Default False. True if needs to be returned
+    workers : Default None. Number of threads to fetch track analysis concurrently with.
+    cache : Default None. ResponseCache of track analysis responses.
+    key : Default 'name' - track_key of name and artists' names joined by '-'. 'id' - tracks are keyed
+          by Spotify track id, see track_keys in SpotipyCollect.
 
     Returns : a dict with key/value pairs for all tracks in the playlist
-                Keys: name of track
+                Keys: name of track (or track id)
                 Value: list containing tempo and segment dataframe of the track
                        (and sections/beats/bars if asked)
     '''
 
-    tracks_name = list(tracks_df['name'])
     tracks_id = list(tracks_df['id'])
-    artists_name = list(tracks_df['artists_name'])
     # track_analysis returns a list of dictionary
-    tracks_analysis = sc.get_tracks_analysis(spotipyUserAuth, tracks_id)
+    tracks_analysis = sc.get_tracks_analysis(spotipyUserAuth, tracks_id, workers=workers, cache=cache)
     df_analysis = {}
 
-    for name_, artists_name_, track_analysis in zip(tracks_name, artists_name, tracks_analysis):
+    for name_, track_analysis in zip(sc.track_keys(tracks_df, key, sep='-'), tracks_analysis):
 
-        # remove any special characters from name (they may cause issues in filenaming)
-        name_ = re.sub(r'[*|><:"?/]|\\', "", name_)
-        name_ = demoji.replace(name_)
-        artists_name_ = re.sub(r'[*|><:"?/]|\\', "", artists_name_)
-        name_ = name_ + '-' + artists_name_[:3]
         df_analysis[name_] = sc.get_segments(track_analysis, segments=segments,
                                              min_conf=min_conf, min_dur=min_dur, tempo=tempo,
                                              sections=sections, beats=beats, bars=bars)
@@ -146,7 +156,8 @@ def get_public_playlists(sp, usernames, keys=('id', 'name', 'description')):
     return userpl_list
 
 
-def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
+@ins.instrument(rows=len)
+def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False, workers=None):
     '''
     Extract track info of all tracks in a playlist.
 
@@ -154,40 +165,17 @@ def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
     playlist_id : playlist id can be obtained from  'get_playlists'
                   or 'filtersort_playlists' function.
     allCol : Default False - Returns a dataframe with only track name and id.
+                             Only these fields are requested from the API.
              True - Returns a complete dataframe of track details
                     with all columns.
     showkeys : Prints all column names/keys of the complete dataframe
+    workers : Default None. Number of threads to request pages of tracks concurrently with.
 
     Returns: Dataframe with track info (Default - name and id)
     '''
-    track_lim = 100
-
-    tracks = spotipyUserAuth.playlist_tracks(playlist_id)
-
-    tracks_json = [
-        tracks['items'][j]['track']
-        for j in range(len(tracks['items']))
-        if tracks['items'][j]['track']]
-
-    tracks_df = json_normalize(tracks_json, sep='_')
-
-    if tracks['total'] > track_lim:
-        offset = track_lim
-        tracks_dflist = [tracks_df]
-
-        for i in range(int(tracks['total'] / track_lim)):
-
-            tracks = spotipyUserAuth.playlist_tracks(playlist_id, offset=(i + 1) * offset)
-
-            tracks_json = [
-                tracks['items'][j]['track']
-                for j in range(len(tracks['items']))
-                if tracks['items'][j]['track']]
-
-            tracks_df_ = json_normalize(tracks_json, sep='_')
-            tracks_dflist.append(tracks_df_)
-
-        tracks_df = pd.concat(tracks_dflist, ignore_index=True)
+    fields = None if allCol else 'total,items(track(name,id))'
+    tracks_df = json_normalize(sc.get_playlist_items(spotipyUserAuth, playlist_id, fields=fields, workers=workers),
+                               sep='_')
 
     if allCol is False:
         df = tracks_df[['name', 'id']]
@@ -200,7 +188,8 @@ def get_tracks(spotipyUserAuth, playlist_id, allCol=False, showkeys=False):
     return df
 
 
-def get_tracks_df(sp, user_playlistIDs, rem_dup=True, allCol=False):
+@ins.instrument(rows=len)
+def get_tracks_df(sp, user_playlistIDs, rem_dup=True, allCol=False, workers=None):
     '''
     Gets tracks from spotipfy API of the listed playlists and returns
     a single dataframe of tracks from all playlists
@@ -208,6 +197,7 @@ def get_tracks_df(sp, user_playlistIDs, rem_dup=True, allCol=False):
     playlistIDs : list of tuples - (user, playlist IDs)
     rem_dup : Default True. Remove duplicate entries of tracks
               if track name and artists' names match
+    workers : Default None. Number of threads to request pages of tracks concurrently with.
 
     returns : dataframe fo tracks df
     '''
@@ -215,7 +205,7 @@ def get_tracks_df(sp, user_playlistIDs, rem_dup=True, allCol=False):
 
     for u in user_playlistIDs:
 
-        tr_df = get_tracks(sp, u[1], allCol=True)
+        tr_df = get_tracks(sp, u[1], allCol=True, workers=workers)
 
         user_col = [u[0]] * len(tr_df)
         tr_df.insert(loc=len(tr_df.columns), column='user', value=user_col)
@@ -249,12 +239,24 @@ def uri_to_id(uri_list):
     return id_list
 
 
-def user_analysis(spotipyUserAuth, user, df, save=True, path=None, fn=0):
+@ins.instrument()
+def user_analysis(spotipyUserAuth, user, df, save=True, path=None, fn=0, incremental=False,
+                  checkpoint=20, workers=None, cache=None, key='id'):
     '''
     Gets tracksanalysis for tracks under one user and saves them as parquet files.
 
     spotipyUserAuth : Spotipy auth object.
+    incremental : Default False. True - skip tracks already stored in the chunk folder and
+                  save a manifest after every 'checkpoint' tracks, so a failed run resumes
+                  where it stopped. See update_dataset in SpotipyCollect.
+    checkpoint : Default 20. Number of tracks fetched and saved between manifest saves.
+    workers : Default None. Number of threads to fetch track analysis concurrently with.
+    cache : Default None. ResponseCache of track analysis responses.
+    key : Default 'id' - files are named by Spotify track id and the user folder keeps a track metadata
+          table of its chunks (see DatasetStore, tracks table). 'name' - files are named as in get_df_analysis.
     '''
+    keys = sc.track_keys(df, key, sep='-')
+
     if save:
         # Create user folder
         path_ = path.joinpath('{}'.format(user))
@@ -262,17 +264,45 @@ def user_analysis(spotipyUserAuth, user, df, save=True, path=None, fn=0):
         # create sub folders for every chunk or n number of tracks in the user folder
         p = path_.joinpath('{}_{}'.format(user, fn))
         p.mkdir(exist_ok=True)
+        if key == 'id':
+            ds.write_tracks(sc.tracks_table(p.name, df, sep='-'), path_)
 
     # list of dataframe names in output
     df_names = ['tempo', 'segments', 'sections', 'beats', 'bars']
 
-    df_analysis = get_df_analysis(spotipyUserAuth, df)
+    if not incremental:
+        df_analysis = get_df_analysis(spotipyUserAuth, df, workers=workers, cache=cache, key=key)
+
+        for track, a in df_analysis.items():
+
+            for k in range(len(a)):
+
+                a[k].to_parquet(p.joinpath('{}_{}.parquet'.format(track, df_names[k])), engine='pyarrow')
+        return
+
+    frames = sc.frame_names()
+    manifest = sc.load_manifest(p)
+
+    # positions of tracks not stored yet
+    missing = [i for i, (track, track_id) in enumerate(zip(keys, df['id']))
+               if not sc.track_stored(p, manifest, track, track_id, frames)]
+    sc.save_manifest(p, manifest)
+
+    for i in range(0, len(missing), checkpoint):
+
+        chunk = missing[i: i + checkpoint]
+        chunk_ids = {keys[j]: df['id'].iloc[j] for j in chunk}
+        df_analysis = get_df_analysis(spotipyUserAuth, df.iloc[chunk], workers=workers, cache=cache, key=key)
+
+        for track, a in df_analysis.items():
+
+            for k in range(len(a)):
 
-    for track, a in df_analysis.items():
+                a[k].to_parquet(p.joinpath('{}_{}.parquet'.format(track, frames[k])), engine='pyarrow')
 
-        for k in range(len(a)):
+            sc.record_track(p, manifest, track, chunk_ids[track], frames)
 
-            a[k].to_parquet(p.joinpath('{}_{}.parquet'.format(track, df_names[k])), engine='pyarrow')
+        sc.save_manifest(p, manifest)
 
 
 def user_plid_pair(user_ids, playlists):
@@ -0,0 +1,40 @@
+'''
+ Test configuration. Tests run from the repository root without network access:
+
+    python -m pytest -q
+'''
+import os
+import sys
+
+import demoji
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# SpotipyCollect downloads the emoji codes of demoji on import, skip it when they are not cached yet
+if demoji.last_downloaded_timestamp() is None:
+    demoji.download_codes = lambda: None
+    demoji.replace = lambda string, repl='': string
+
+
+@pytest.fixture
+def stub():
+    '''
+    StubSpotify of 15 short tracks per playlist, recording the ids of requested track analyses.
+    '''
+    from benchmarks.synthetic import StubSpotify
+
+    class RecordingSpotify(StubSpotify):
+
+        def __init__(self, n_tracks=15, n_segments=150):
+
+            super().__init__(n_tracks=n_tracks, n_segments=n_segments)
+            self.analysed = []
+
+        def audio_analysis(self, track_id):
+
+            self.analysed.append(track_id)
+
+            return super().audio_analysis(track_id)
+
+    return RecordingSpotify()
@@ -0,0 +1,105 @@
+'''
+ ResponseCache lookups, LRU eviction, TTL and offline mode.
+'''
+import pytest
+
+from cap_package import ResponseCache as rc
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    Clock of the cache, advanced by hand.
+    '''
+    now = [1000.0]
+    monkeypatch.setattr(rc.time, 'time', lambda: now[0])
+
+    return now
+
+
+def response(id_):
+
+    return {'id': id_, 'values': list(range(200))}
+
+
+def test_fetch_requests_missing_only(tmp_path):
+
+    cache = rc.ResponseCache(tmp_path.joinpath('c.db'))
+    requested = []
+
+    def request(ids):
+        requested.append(list(ids))
+        return [response(i) for i in ids]
+
+    assert cache.fetch('audio_analysis', ['a', 'b', 'a'], request) == [response('a'), response('b'), response('a')]
+    assert cache.fetch('audio_analysis', ['b', 'c'], request) == [response('b'), response('c')]
+    assert requested == [['a', 'b'], ['c']]
+
+    # endpoints are cached apart
+    assert cache.get_many('audio_features', ['a']) == {}
+    cache.close()
+
+
+def test_lookup_in_chunks(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(rc, 'QUERY_CHUNK', 3)
+    cache = rc.ResponseCache(tmp_path.joinpath('c.db'))
+    ids = [str(i) for i in range(10)]
+    cache.put_many('audio_analysis', {i: response(i) for i in ids[::2]})
+
+    found, missing = cache.lookup('audio_analysis', ids)
+
+    assert sorted(found) == ids[::2]
+    assert missing == ids[1::2]
+    cache.close()
+
+
+def test_least_recently_used_are_evicted(tmp_path, clock):
+
+    cache = rc.ResponseCache(tmp_path.joinpath('c.db'))
+    cache.put_many('audio_analysis', {'a': response('a')})
+    size = cache.stats()['bytes']
+    # room for three responses
+    cache.max_bytes = 3 * size + size // 2
+
+    clock[0] += 1
+    cache.put_many('audio_analysis', {'b': response('b'), 'c': response('c')})
+    clock[0] += 1
+    cache.get_many('audio_analysis', ['a'])
+    clock[0] += 1
+    cache.put_many('audio_analysis', {'d': response('d')})
+
+    assert sorted(cache.get_many('audio_analysis', ['a', 'b', 'c', 'd'])) == ['a', 'c', 'd']
+    assert cache.stats()['bytes'] <= cache.max_bytes
+    cache.close()
+
+
+def test_expired_responses_are_refetched(tmp_path, clock):
+
+    cache = rc.ResponseCache(tmp_path.joinpath('c.db'), ttl=60)
+    cache.put_many('audio_analysis', {'a': response('a')})
+
+    clock[0] += 30
+    assert 'a' in cache.get_many('audio_analysis', ['a'])
+
+    clock[0] += 31
+    assert cache.lookup('audio_analysis', ['a']) == ({}, ['a'])
+    cache.close()
+
+
+def test_offline(tmp_path):
+
+    path = tmp_path.joinpath('c.db')
+    cache = rc.ResponseCache(path)
+    cache.put_many('audio_analysis', {'a': response('a')})
+    cache.close()
+
+    cache = rc.ResponseCache(path, offline=True)
+
+    def request(ids):
+        raise AssertionError('requested in offline mode')
+
+    assert cache.fetch('audio_analysis', ['a'], request) == [response('a')]
+    with pytest.raises(KeyError):
+        cache.fetch('audio_analysis', ['a', 'b'], request)
+    cache.close()
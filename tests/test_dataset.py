@@ -0,0 +1,141 @@
+'''
+ Incremental builds, deduplicated datasets and the track metadata table on StubSpotify data.
+'''
+import pandas as pd
+
+from cap_package import DatasetStore as ds
+from cap_package import ReadTransform as rt
+from cap_package import SpotipyCollect as sc
+
+PLAYLISTS = [('PL A', 'a'), ('PL B', 'b')]
+
+
+def track_id(i):
+
+    return 'track{:0>18d}'.format(i)
+
+
+def test_update_dataset_fetches_missing_tracks(stub, tmp_path):
+
+    assert sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS) == {'PL A': 15, 'PL B': 15}
+
+    manifest = sc.load_manifest(tmp_path.joinpath('PL A'))
+    assert sorted(manifest) == [track_id(i) for i in range(15)]
+    assert manifest[track_id(3)] == {'id': track_id(3), 'frames': ['sections', 'segments']}
+
+    stub.analysed.clear()
+    assert sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS) == {'PL A': 0, 'PL B': 0}
+    assert stub.analysed == []
+
+    tmp_path.joinpath('PL B', track_id(4) + '_segments.parquet').unlink()
+    assert sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS) == {'PL A': 0, 'PL B': 1}
+    assert stub.analysed == [track_id(4)]
+
+
+def test_update_dataset_adds_frames(stub, tmp_path):
+
+    sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS[:1], sections=False)
+    assert sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS[:1]) == {'PL A': 15}
+
+    manifest = sc.load_manifest(tmp_path.joinpath('PL A'))
+    assert manifest[track_id(0)]['frames'] == ['sections', 'segments']
+
+
+def test_update_dataset_prune(stub, tmp_path):
+
+    sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS)
+    stub.n_tracks = 10
+
+    sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS[:1])
+    assert tmp_path.joinpath('PL A', track_id(12) + '_segments.parquet').exists()
+
+    assert sc.update_dataset(stub, tmp_path, pl_name_id=PLAYLISTS[:1], prune=True) == {'PL A': 0}
+    assert sorted(sc.load_manifest(tmp_path.joinpath('PL A'))) == [track_id(i) for i in range(10)]
+    assert len(list(tmp_path.joinpath('PL A').glob('*_segments.parquet'))) == 10
+
+    # tracks table follows the current tracks of every playlist
+    tracks = ds.read_tracks(tmp_path)
+    assert (tracks['playlist'] == 'PL A').sum() == 10
+    assert (tracks['playlist'] == 'PL B').sum() == 15
+
+
+def test_stream_dataset_matches_update_dataset(stub, tmp_path):
+
+    tmp_path.joinpath('stream').mkdir()
+    tmp_path.joinpath('update').mkdir()
+    sc.stream_dataset(stub, tmp_path.joinpath('stream'), pl_name_id=PLAYLISTS, workers=2)
+    sc.update_dataset(stub, tmp_path.joinpath('update'), pl_name_id=PLAYLISTS)
+
+    for pl, _ in PLAYLISTS:
+        streamed = sc.load_manifest(tmp_path.joinpath('stream', pl))
+        assert streamed == sc.load_manifest(tmp_path.joinpath('update', pl))
+
+    file = '{}/{}_segments.parquet'.format('PL B', track_id(5))
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path.joinpath('stream', file)),
+                                  pd.read_parquet(tmp_path.joinpath('update', file)))
+
+
+def test_index_dataset_round_trip(stub, tmp_path):
+
+    index = sc.build_track_index(stub, pl_name_id=PLAYLISTS)
+    analysis = sc.get_index_analysis(stub, index)
+    sc.create_index_dataset(analysis, index, tmp_path, df_names=sc.frame_names(tempo=False, sections=True))
+
+    # shared tracks are fetched and stored once
+    assert sorted(stub.analysed) == [track_id(i) for i in range(15)]
+    assert len(list(tmp_path.joinpath(ds.TRACKS_DIR).glob('*_segments.parquet'))) == 15
+
+    membership = ds.read_membership(tmp_path)
+    assert len(membership) == 30
+    assert membership['track_id'].tolist() == [track_id(i) for i in range(15)] * 2
+
+    dataset = rt.read_dataset(tmp_path, sections=True)
+    assert [pl for pl, _, _ in dataset] == ['PL A', 'PL B']
+    assert [t for t, _ in dataset[0][1]] == [sc.track_key('Track {}'.format(i), 'Artist {}'.format(i % 17))
+                                             for i in range(15)]
+    assert dataset[0][1][3][1] is dataset[1][1][3][1]
+
+
+def test_index_dataset_same_name_tracks(stub, tmp_path):
+
+    # two different tracks of one playlist share a name
+    same = pd.DataFrame({'id': [track_id(1), track_id(2)], 'name': ['Same', 'Same'],
+                         'artists_name': ['Artist', 'Artist']})
+    other = pd.DataFrame({'id': [track_id(3), track_id(1)], 'name': ['Other', 'Same'],
+                          'artists_name': ['Band', 'Artist']})
+    index = sc.track_index([('PL A', same), ('PL B', other)])
+    analysis = sc.get_index_analysis(stub, index, sections=False)
+    sc.create_index_dataset(analysis, index, tmp_path, df_names=['segments'])
+
+    for i in (1, 2, 3):
+        expected = sc.get_segments(stub.audio_analysis(track_id(i)), tempo=False)[0]
+        stored = pd.read_parquet(tmp_path.joinpath(ds.TRACKS_DIR, track_id(i) + '_segments.parquet'))
+        pd.testing.assert_frame_equal(stored, expected)
+
+    tracks = list(rt.iter_dataset(tmp_path))
+    assert [(pl, t) for pl, t, _ in tracks] == [('PL A', 'Same_Art'), ('PL A', 'Same_Art'), ('PL B', 'Other_Ban'),
+                                                ('PL B', 'Same_Art')]
+    assert not tracks[0][2].equals(tracks[1][2])
+    assert tracks[0][2].equals(tracks[3][2])
+
+
+def test_tracks_table(tmp_path):
+
+    tracks = pd.DataFrame({'id': [track_id(2), track_id(1)], 'name': ['B', 'A'], 'artists_name': ['X', 'Y']})
+    ds.write_tracks(sc.tracks_table('PL A', tracks), tmp_path)
+    ds.write_tracks(sc.tracks_table('PL B', tracks.iloc[:1]), tmp_path)
+
+    table = ds.read_tracks(tmp_path)
+    assert table.index.tolist() == [track_id(1), track_id(2), track_id(2)]
+    assert table['playlist'].tolist() == ['PL A', 'PL A', 'PL B']
+    assert table.loc[track_id(1), 'track'] == 'A_Y'
+
+    # rows of a playlist are replaced, other playlists are kept
+    ds.write_tracks(sc.tracks_table('PL A', tracks.iloc[1:]), tmp_path)
+    table = ds.read_tracks(tmp_path)
+    assert table.index.tolist() == [track_id(1), track_id(2)]
+    assert table['playlist'].tolist() == ['PL A', 'PL B']
+    assert ds.read_tracks(tmp_path, playlists=['PL B']).index.tolist() == [track_id(2)]
+
+    tmp_path.joinpath('PL A').mkdir()
+    assert [p.name for p in ds.playlist_folders(tmp_path)] == ['PL A']
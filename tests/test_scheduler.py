@@ -0,0 +1,109 @@
+'''
+ RequestScheduler retries, 429 handling and ScheduledSpotify.
+'''
+import time
+
+import pytest
+import spotipy
+
+from cap_package import RequestScheduler as rs
+
+
+class Flaky:
+    '''
+    Endpoint failing with the given errors, one per call, before answering.
+    '''
+
+    def __init__(self, *errors):
+
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, track_id):
+
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return {'id': track_id}
+
+
+def http_error(status, headers=None):
+
+    return spotipy.SpotifyException(status, -1, 'error {}'.format(status), headers=headers)
+
+
+def test_retry_after():
+
+    assert rs.retry_after(http_error(429, {'Retry-After': '2'})) == 2.0
+    assert rs.retry_after(http_error(429, {'retry-after': '0.5'})) == 0.5
+    assert rs.retry_after(http_error(429, {'Retry-After': 'soon'})) is None
+    assert rs.retry_after(http_error(429)) is None
+
+
+def test_throttled_request_waits_retry_after():
+
+    scheduler = rs.RequestScheduler(rate=1000, backoff=0.01)
+    endpoint = Flaky(http_error(429, {'Retry-After': '0.2'}))
+
+    start = time.monotonic()
+    assert scheduler.call(endpoint, 'a') == {'id': 'a'}
+
+    assert time.monotonic() - start >= 0.2
+    assert endpoint.calls == 2
+    assert scheduler.stats() == {'requests': 2, 'throttled': 1, 'retried': 1, 'failed': 0}
+
+
+def test_server_errors_are_retried():
+
+    scheduler = rs.RequestScheduler(rate=1000, backoff=0.001)
+    endpoint = Flaky(http_error(503), http_error(500), http_error(429))
+
+    assert scheduler.call(endpoint, 'a') == {'id': 'a'}
+    assert endpoint.calls == 4
+    assert scheduler.stats()['retried'] == 3
+
+
+def test_client_error_is_not_retried():
+
+    scheduler = rs.RequestScheduler(rate=1000, backoff=0.001)
+    endpoint = Flaky(http_error(404))
+
+    with pytest.raises(spotipy.SpotifyException):
+        scheduler.call(endpoint, 'a')
+
+    assert endpoint.calls == 1
+    assert scheduler.stats()['failed'] == 1
+
+
+def test_retries_are_bounded():
+
+    scheduler = rs.RequestScheduler(rate=1000, backoff=0.001, max_retries=2)
+    endpoint = Flaky(*[http_error(502)] * 5)
+
+    with pytest.raises(spotipy.SpotifyException):
+        scheduler.call(endpoint, 'a')
+
+    assert endpoint.calls == 3
+    assert scheduler.stats() == {'requests': 3, 'throttled': 0, 'retried': 2, 'failed': 1}
+
+
+def test_token_bucket_rate():
+
+    scheduler = rs.RequestScheduler(rate=50, burst=1)
+
+    start = time.monotonic()
+    for _ in range(11):
+        scheduler.acquire()
+
+    assert time.monotonic() - start >= 0.18
+
+
+def test_scheduled_spotify(stub):
+
+    scheduler = rs.RequestScheduler(rate=1000)
+    sp = rs.ScheduledSpotify(stub, scheduler)
+
+    assert sp.audio_analysis('track000000000000000001')['track']['tempo'] == 126.0
+    assert sp.n_tracks == stub.n_tracks
+    assert scheduler.stats()['requests'] == 1
@@ -0,0 +1,74 @@
+'''
+ get_segments and select_segments against the segment selection loop they replaced.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import synthetic_analysis
+from cap_package import SpotipyCollect as sc
+
+
+def loop_select(confidence, duration, min_conf=0.5, min_dur=0.25):
+    '''
+    Segment selection of the original get_segments. Never ends for tracks of fewer than 100 segments.
+    '''
+    mask = (confidence > min_conf) & (duration > min_dur)
+
+    while mask.sum() < 100:
+        min_conf = min_conf - 0.05
+        min_dur = min_dur - 0.05
+        mask = (confidence > min_conf) & (duration > min_dur)
+
+    return mask
+
+
+@pytest.mark.parametrize('min_conf, min_dur', [(0.5, 0.25), (0.9, 0.5), (0.2, 0.1), (1.0, 1.0)])
+@pytest.mark.parametrize('seed', range(5))
+def test_select_segments_matches_loop(seed, min_conf, min_dur):
+
+    rng = np.random.default_rng(seed)
+    # few confident segments, so thresholds are relaxed several times
+    confidence = rng.random(400) ** 3
+    duration = rng.uniform(0.05, 0.6, 400)
+
+    mask = sc.select_segments(confidence, duration, min_conf=min_conf, min_dur=min_dur)
+
+    np.testing.assert_array_equal(mask, loop_select(confidence, duration, min_conf, min_dur))
+
+
+@pytest.mark.parametrize('n_segments', [1, 40, 99])
+def test_select_segments_short_track(n_segments):
+
+    rng = np.random.default_rng(n_segments)
+    mask = sc.select_segments(rng.random(n_segments), rng.uniform(0.05, 0.6, n_segments))
+
+    assert mask.all()
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_get_segments_matches_loop(seed):
+
+    analysis = synthetic_analysis(seed, n_segments=300)
+    tempo_df, segments_df, sections_df = sc.get_segments(analysis, sections=True)
+
+    expected = pd.DataFrame(analysis['segments'])
+    expected = expected[loop_select(expected['confidence'].to_numpy(), expected['duration'].to_numpy())]
+
+    assert tempo_df['tempo'].tolist() == [analysis['track']['tempo']]
+    assert list(segments_df.columns) == ['start', 'start_minute', 'duration', 'confidence', 'pitches', 'timbre']
+    np.testing.assert_array_equal(segments_df.index, expected.index)
+    for c in ['start', 'duration', 'confidence']:
+        np.testing.assert_array_equal(segments_df[c], expected[c])
+    assert segments_df['start_minute'].tolist() == expected['start'].map(sc.convert_time).tolist()
+    np.testing.assert_array_equal(np.stack(segments_df['timbre']), np.array(expected['timbre'].tolist()))
+    np.testing.assert_array_equal(np.stack(segments_df['pitches']), np.array(expected['pitches'].tolist()))
+    assert len(sections_df) == len(analysis['sections'])
+
+
+def test_get_segments_short_track():
+
+    analysis = synthetic_analysis(7, n_segments=40)
+    segments_df = sc.get_segments(analysis, tempo=False)[0]
+
+    assert len(segments_df) == 40